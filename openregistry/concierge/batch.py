@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+from .lag import seq_number
+from .utils import continuous_changes_feed, lot_from_doc
+
+logger = logging.getLogger(__name__)
+
+
+def changes_between(worker, since=0, until=None):
+    """Lots changed after ``since`` and up to ``until`` (inclusive), from the changes feed."""
+    position = {'seq': since}
+
+    def progress(seq):
+        position['seq'] = seq
+
+    worker.design_synced.wait()
+    for lot in continuous_changes_feed(worker.db, logger, filter_doc=worker.config['db']['filter'],
+                                       progress=progress, since=since):
+        if until is not None and seq_number(position['seq']) > until:
+            break
+        yield lot
+
+
+def lots_by_id(worker, lot_ids, missing):
+    """Lots read from the lots database in one request. Ids not found are appended to ``missing``."""
+    rows = worker.db.view('_all_docs', keys=list(lot_ids), include_docs=True)
+    for row in rows:
+        if row.doc is None:
+            logger.warning('Lot %s not found in the database', row.key, extra={'lot_id': row.key})
+            missing.append(row.key)
+        else:
+            yield lot_from_doc(row.doc)
+
+
+def run_batch(worker, lots, dry_run=False):
+    """Process ``lots`` with the worker's scheduler and pool, then return a summary."""
+    started = time.time()
+    worker.dry_run = dry_run
+    # Nor are the progress, errors and checkpoint documents written
+    worker.errors_writer.dry_run = dry_run
+    count = 0
+    for lot in lots:
+        count += 1
+        worker.scheduler.push(lot)
+        worker.dispatch(worker.scheduler.window - 1)
+        worker.errors_writer.flush_if_due()
+    worker.dispatch(0)
+    worker.pool.join()
+    worker.errors_writer.flush()
+    if worker.records is not None:
+        worker.records.close()
+    stats = worker.stats()
+    return {
+        'lots': count,
+        'outcomes': stats['outcomes'],
+        'api_calls': stats['api_calls'],
+        'skipped_patches': stats['skipped_patches'],
+        'elapsed': time.time() - started,
+        'dry_run': dry_run
+    }
+
+
+def format_summary(summary):
+    lines = ['{}Processed {} lots in {:.1f} seconds'.format(
+        'Dry run: ' if summary['dry_run'] else '', summary['lots'], summary['elapsed']
+    )]
+    lines.append('Outcomes:')
+    lines.extend('  {}: {}'.format(outcome, count) for outcome, count in sorted(summary['outcomes'].items()))
+    lines.append('API calls:')
+    lines.extend('  {}: {}'.format(key, count) for key, count in sorted(summary['api_calls'].items()))
+    lines.append('Skipped asset patches: {}'.format(summary['skipped_patches']))
+    return '\n'.join(lines)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+
+
+class ErrorsCompactor(object):
+    """Move old resolved entries out of the errors doc into archive docs.
+
+    Entries resolved more than ``retention`` seconds ago are moved to an
+    archive doc per ``bucket`` period of their resolution time, named
+    ``<errors doc>_archive_<period>``, so the errors doc only holds broken
+    and recently resolved lots. Runs every ``interval`` seconds in a
+    background thread, writing through the worker's BulkDocsWriter.
+    """
+
+    def __init__(self, db, writer, doc, logger, retention=7 * 24 * 3600, interval=3600, bucket='%Y-%m'):
+        self.db = db
+        self.writer = writer
+        self.doc = doc
+        self.logger = logger
+        self.retention = retention
+        self.interval = interval
+        self.bucket = bucket
+        self.archived = 0
+        self.report = self.size()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def archive_id(self, resolved_at):
+        return '{}_archive_{}'.format(self.doc['_id'], time.strftime(self.bucket, time.gmtime(resolved_at)))
+
+    def compact(self, now=None):
+        """Archive the old resolved entries. Returns the number of entries archived."""
+        now = time.time() if now is None else now
+        archives = {}
+        archived = 0
+        with self.writer.lock:
+            for key, entry in self.doc.items():
+                if key.startswith('_') or not isinstance(entry, dict) or not entry.get('resolved', False):
+                    continue
+                if 'resolved_at' not in entry:
+                    # Resolved before resolution times were stored
+                    entry['resolved_at'] = now
+                    self.writer.set_item(self.doc, key, entry)
+                    continue
+                if now - entry['resolved_at'] < self.retention:
+                    continue
+                archive_id = self.archive_id(entry['resolved_at'])
+                if archive_id not in archives:
+                    archives[archive_id] = self.db.get(archive_id) or {'_id': archive_id}
+                self.writer.set_item(archives[archive_id], key, entry)
+                self.writer.del_item(self.doc, key)
+                archived += 1
+            self.writer.flush()
+        self.archived += archived
+        self.report = self.size()
+        return archived
+
+    def size(self):
+        entries = [entry for key, entry in self.doc.items() if not key.startswith('_')]
+        return {
+            'entries': len(entries),
+            'unresolved': len([entry for entry in entries if not entry.get('resolved', False)]),
+            'bytes': len(json.dumps(self.doc)),
+            'archived': self.archived
+        }
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            started = time.time()
+            try:
+                archived = self.compact()
+            except Exception:
+                self.logger.exception('Failed to compact %s', self.doc['_id'])
+                continue
+            self.logger.info('Archived %s resolved lots from %s in %.3f seconds, %s entries (%s bytes) left',
+                             archived, self.doc['_id'], time.time() - started,
+                             self.report['entries'], self.report['bytes'])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='errors-compaction')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=10):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import inspect
+from urlparse import urlparse
+
+from .compaction import ErrorsCompactor
+from .metrics import LatencySLO
+from .records import LotRecordWriter
+from .retry import RetryScheduler
+from .scheduler import LotScheduler, PriorityClass
+from .sources import SOURCES
+from .status import StatusServer
+from .throttling import AIMDLimiter, Hedger, TokenBucket
+from .utils import BulkDocsWriter, LRUCache
+
+REQUIRED = (
+    ('db', 'host'),
+    ('db', 'port'),
+    ('db', 'name'),
+    ('db', 'filter'),
+    ('errors_doc',),
+    ('time_to_sleep',),
+    ('lots', 'api', 'url'),
+    ('lots', 'api', 'token'),
+    ('lots', 'api', 'version'),
+    ('assets', 'api', 'url'),
+    ('assets', 'api', 'token'),
+    ('assets', 'api', 'version'),
+    ('version',),
+)
+
+# Optional sections passed as keyword arguments to these classes
+OPTIONS = {
+    'asset_cache': LRUCache,
+    'bulk_writes': BulkDocsWriter,
+    'compaction': ErrorsCompactor,
+    'negative_cache': LRUCache,
+    'records': LotRecordWriter,
+    'retry': RetryScheduler,
+    'scheduler': LotScheduler,
+    'slo': LatencySLO,
+    'status': StatusServer,
+}
+
+
+def lookup(config, path):
+    for key in path:
+        if not isinstance(config, dict) or key not in config:
+            return None
+        config = config[key]
+    return config
+
+
+def check_options(name, options, cls, required=()):
+    """Problems with ``options`` given as keyword arguments to ``cls``."""
+    if not isinstance(options, dict):
+        return ['{}: expected a mapping'.format(name)]
+    args = inspect.getargspec(cls.__init__).args
+    errors = ['{}: unknown option "{}"'.format(name, key) for key in sorted(options) if key not in args]
+    errors.extend('{}: missing option "{}"'.format(name, key) for key in required if key not in options)
+    return errors
+
+
+def check_api(name, api_config):
+    errors = []
+    url = urlparse(str(api_config['url']))
+    if url.scheme not in ('http', 'https') or not url.netloc:
+        errors.append('{}.api.url: "{}" is not an http(s) URL'.format(name, api_config['url']))
+    for op, options in sorted((api_config.get('rate_limits') or {}).items()):
+        if op not in ('GET', 'PATCH'):
+            errors.append('{}.api.rate_limits: unknown operation "{}"'.format(name, op))
+        errors.extend(check_options('{}.api.rate_limits.{}'.format(name, op), options, TokenBucket, ('rate',)))
+    if api_config.get('concurrency'):
+        errors.extend(check_options('{}.api.concurrency'.format(name), api_config['concurrency'], AIMDLimiter))
+    if api_config.get('hedging'):
+        errors.extend(check_options('{}.api.hedging'.format(name), api_config['hedging'], Hedger))
+    return errors
+
+
+def check_config(config):
+    """Validate a loaded concierge.yaml without touching the network.
+
+    Returns a list of problems, empty if the config looks usable.
+    """
+    if not isinstance(config, dict):
+        return ['config: expected a mapping']
+    errors = ['{}: missing'.format('.'.join(path)) for path in REQUIRED if lookup(config, path) is None]
+    if errors:
+        return errors
+
+    if not isinstance(config['time_to_sleep'], (int, float)) or config['time_to_sleep'] < 0:
+        errors.append('time_to_sleep: expected a non-negative number')
+    workers = config.get('workers', 1)
+    if not isinstance(workers, int) or workers < 1:
+        errors.append('workers: expected a positive integer')
+    for name in ('lots', 'assets'):
+        errors.extend(check_api(name, config[name]['api']))
+    for name, cls in sorted(OPTIONS.items()):
+        if config.get(name) is not None:
+            errors.extend(check_options(name, config[name], cls))
+    for index, options in enumerate(lookup(config, ('scheduler', 'classes')) or []):
+        errors.extend(check_options('scheduler.classes[{}]'.format(index), options, PriorityClass, ('name',)))
+    source = config.get('source') or {}
+    source_type = source.get('type', 'couchdb') if isinstance(source, dict) else None
+    if source_type not in SOURCES:
+        errors.append('source.type: unknown lot source "{}"'.format(source_type))
+    else:
+        options = dict((key, value) for key, value in source.items() if key not in ('type', 'db', 'filter_doc'))
+        errors.extend(check_options('source', options, SOURCES[source_type]))
+    for index, threshold in enumerate(lookup(config, ('feed_lag', 'thresholds')) or []):
+        name = 'feed_lag.thresholds[{}]'.format(index)
+        if not isinstance(threshold, dict):
+            errors.append('{}: expected a mapping'.format(name))
+        elif not isinstance(threshold.get('workers'), int) or threshold['workers'] < 1:
+            errors.append('{}: "workers" must be a positive integer'.format(name))
+        elif 'distance' not in threshold and 'behind' not in threshold:
+            errors.append('{}: expected "distance" or "behind"'.format(name))
+    return errors
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import threading
+
+
+class AssetIndex(object):
+    """Which lot owns and which lot is being processed with each asset.
+
+    Owners are read from ``states``, the cache of ``(status, relatedLot)``
+    filled from fetched assets and successful patches. The cache may be
+    stale, so its owners only tell which assets of a lot to check first.
+    In-flight assets are taken by acquire() for all assets of a lot at once,
+    so lots sharing assets, and two changes of the same lot, are processed
+    one after another.
+    """
+
+    def __init__(self, states):
+        self.states = states
+        self.in_flight = {}
+        self.cond = threading.Condition()
+        self.waits = 0
+
+    def owner(self, asset_id):
+        state = self.states.get(asset_id)
+        return state[1] if state is not None else None
+
+    def conflicts(self, lot):
+        """Assets of ``lot`` known to belong to another lot, with their owners."""
+        owners = {}
+        for asset_id in lot.get('assets') or []:
+            owner = self.owner(asset_id)
+            if owner is not None and owner != lot['id']:
+                owners[asset_id] = owner
+        return owners
+
+    def busy(self, lot):
+        return [asset_id for asset_id in lot.get('assets') or [] if asset_id in self.in_flight]
+
+    def acquire(self, lot):
+        """Wait until no other lot is processed with the assets of ``lot``, then take them.
+
+        Returns the number of times it had to wait.
+        """
+        waited = 0
+        with self.cond:
+            while self.busy(lot):
+                waited += 1
+                self.cond.wait()
+            for asset_id in lot.get('assets') or []:
+                self.in_flight[asset_id] = lot['id']
+            self.waits += waited
+        return waited
+
+    def release(self, lot):
+        with self.cond:
+            for asset_id in lot.get('assets') or []:
+                if self.in_flight.get(asset_id) == lot['id']:
+                    del self.in_flight[asset_id]
+            self.cond.notify_all()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import deque
+
+
+def seq_number(seq):
+    """Numeric part of a CouchDB update sequence ("123-g1AAA..." in CouchDB 2)."""
+    if isinstance(seq, (int, long)):
+        return seq
+    try:
+        return int(str(seq).split('-', 1)[0])
+    except ValueError:
+        return 0
+
+
+class FeedLag(object):
+    """How far the feed position is behind the head of the database.
+
+    ``update_seq`` is called with the sequence of every change read from the
+    feed and ``update_head`` with the database ``update_seq`` now and then.
+    The distance is the number of changes between them. The time behind is
+    estimated from the recorded heads: it is the time since the head first
+    went past the feed position, or since the oldest recorded head if that
+    one is already past it.
+    """
+
+    def __init__(self, history=1000):
+        self.seq = 0
+        self.head = 0
+        self.heads = deque(maxlen=history)
+        self.lock = threading.Lock()
+
+    def update_seq(self, seq):
+        with self.lock:
+            self.seq = max(self.seq, seq_number(seq))
+
+    def update_head(self, head, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.head = seq_number(head)
+            self.heads.append((now, self.head))
+
+    @property
+    def distance(self):
+        return max(self.head - self.seq, 0)
+
+    def behind(self, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.head <= self.seq:
+                return 0.0
+            for recorded, head in self.heads:
+                if head > self.seq:
+                    return now - recorded
+        return 0.0
+
+    def status(self, now=None):
+        return {
+            'seq': self.seq,
+            'head': self.head,
+            'distance': self.distance,
+            'behind': round(self.behind(now), 3)
+        }
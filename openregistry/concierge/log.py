@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import logging.config
+import threading
+import time
+
+from Queue import Queue, Full, Empty
+
+STRUCTURED_FIELDS = ('lot_id', 'asset_id', 'phase', 'MESSAGE_ID')
+
+
+class JSONFormatter(logging.Formatter):
+    """Render records as one JSON object per line.
+
+    Structured fields passed through ``extra`` (lot_id, asset_id, phase,
+    MESSAGE_ID) are emitted as separate keys, so they can be indexed
+    without parsing the message text.
+    """
+
+    def format(self, record):
+        data = {
+            'timestamp': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field.lower()] = value
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            data['suppressed'] = suppressed
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data)
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per message template.
+
+    Records are keyed by their unformatted ``msg``, so every
+    "Successfully patched asset %s to %s" line shares a single bucket.
+    Records at ``level`` or above and audit records carrying a
+    ``MESSAGE_ID`` (patches) are never limited. The number of dropped
+    records is attached to the next record that passes as ``suppressed``.
+    """
+
+    def __init__(self, rate=10, per=1.0, level='WARNING'):
+        logging.Filter.__init__(self)
+        self.rate = float(rate)
+        self.per = float(per)
+        self.level = logging.getLevelName(level) if isinstance(level, basestring) else level
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= self.level or getattr(record, 'MESSAGE_ID', None) is not None:
+            return True
+        now = time.time()
+        with self.lock:
+            tokens, updated, suppressed = self.buckets.get(record.msg, (self.rate, now, 0))
+            tokens = min(self.rate, tokens + (now - updated) * self.rate / self.per)
+            if tokens < 1:
+                self.buckets[record.msg] = (tokens, now, suppressed + 1)
+                return False
+            self.buckets[record.msg] = (tokens - 1, now, 0)
+        record.suppressed = suppressed
+        return True
+
+
+class QueueHandler(logging.Handler):
+    """Hand records over to a QueueListener without blocking the caller.
+
+    When the queue is full the record is dropped and counted in
+    ``dropped`` instead of stalling lot processing.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Merge args here so that later mutations of the logged objects
+        # don't leak into the output; formatting and I/O stay in the listener.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """Drain a queue in a background thread and pass records to handlers."""
+
+    _sentinel = None
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor, name='log-listener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def _monitor(self):
+        while True:
+            try:
+                record = self.queue.get(True, 1)
+            except Empty:
+                continue
+            if record is self._sentinel:
+                break
+            self.handle(record)
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self.queue.put(self._sentinel)
+        self._thread.join()
+        self._thread = None
+        for handler in self.handlers:
+            handler.flush()
+
+
+def configure_logging(config):
+    """Apply the logging part of the config.
+
+    If ``log_queue.enabled`` is set, the handlers of the configured loggers
+    are moved behind a QueueListener, so the worker only pays for putting a
+    record into an in-memory queue. Returns the started listeners, which
+    must be stopped on exit to flush pending records. Loggers created
+    before, like the module loggers, stay enabled unless the config sets
+    ``disable_existing_loggers``.
+    """
+    config = dict(config)
+    config.setdefault('disable_existing_loggers', False)
+    logging.config.dictConfig(config)
+    queue_config = config.get('log_queue') or {}
+    if not queue_config.get('enabled', False):
+        return []
+
+    loggers = [logging.getLogger()]
+    loggers.extend(logging.getLogger(name) for name in config.get('loggers', {}) if name)
+    listeners = {}
+    for log in loggers:
+        if not log.handlers:
+            continue
+        handlers = tuple(log.handlers)
+        if handlers not in listeners:
+            queue = Queue(queue_config.get('size', 10000))
+            listeners[handlers] = (QueueListener(queue, *handlers), QueueHandler(queue))
+        log.handlers = [listeners[handlers][1]]
+
+    for listener, _ in listeners.values():
+        listener.start()
+    return [listener for listener, _ in listeners.values()]
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import math
+import threading
+import time
+
+from .utils import LRUCache
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+class LatencyHistogram(object):
+    """Streaming percentiles of latencies in bounded memory.
+
+    Values are counted in logarithmic buckets, each ``precision`` wider than
+    the previous one (like an HDR histogram), so a percentile is off by at
+    most ``precision`` of its value and the number of buckets only depends
+    on the range of the values, not on how many were recorded.
+    """
+
+    def __init__(self, precision=0.02, minimum=0.001):
+        self.precision = precision
+        self.minimum = minimum
+        self.log_base = math.log(1 + precision)
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def index(self, value):
+        if value <= self.minimum:
+            return 0
+        return int(math.ceil(math.log(value / self.minimum) / self.log_base))
+
+    def record(self, value):
+        index = self.index(value)
+        with self.lock:
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        """Upper bound of the bucket holding the ``percent`` percentile, None if nothing was recorded."""
+        with self.lock:
+            if not self.count:
+                return None
+            rank = max(int(math.ceil(percent / 100.0 * self.count)), 1)
+            seen = 0
+            for index in sorted(self.buckets):
+                seen += self.buckets[index]
+                if seen >= rank:
+                    return min(self.minimum * (1 + self.precision) ** index, self.max)
+
+    def stats(self):
+        stats = dict(('p{}'.format(percent), self.percentile(percent)) for percent in PERCENTILES)
+        with self.lock:
+            stats.update(count=self.count, total=self.total, max=self.max,
+                         avg=self.total / self.count if self.count else None)
+        return stats
+
+
+class PhaseTimings(object):
+    """Latency histogram of each lot processing phase."""
+
+    def __init__(self):
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def record(self, phase, duration):
+        with self.lock:
+            histogram = self.phases.get(phase)
+            if histogram is None:
+                histogram = self.phases[phase] = LatencyHistogram()
+        histogram.record(duration)
+
+    def stats(self):
+        with self.lock:
+            phases = self.phases.items()
+        return dict((phase, histogram.stats()) for phase, histogram in phases)
+
+
+class LatencySLO(object):
+    """Time from the first sight of a lot in a status to its outcome, against objectives.
+
+    ``objectives`` maps outcomes to the number of seconds a lot may take to
+    reach them. Start times are kept for at most ``max_tracked`` lots.
+    """
+
+    def __init__(self, objectives=None, max_tracked=100000, precision=0.02):
+        self.objectives = objectives or {}
+        self.started = LRUCache(size=max_tracked)
+        self.precision = precision
+        self.histograms = {}
+        self.violations = {}
+        self.lock = threading.Lock()
+
+    @property
+    def max_tracked(self):
+        return self.started.size
+
+    @max_tracked.setter
+    def max_tracked(self, size):
+        self.started.size = size
+
+    def start(self, lot, now=None):
+        key = (lot['id'], lot['status'])
+        if self.started.get(key) is None:
+            self.started.set(key, time.time() if now is None else now)
+
+    def finish(self, lot, outcome, now=None):
+        """Record the latency of a lot that reached ``outcome``.
+
+        Returns the latency and whether it is over the objective, or None if
+        the start of the lot wasn't seen.
+        """
+        started = self.started.pop((lot['id'], lot['status']))
+        if started is None:
+            return None
+        latency = (time.time() if now is None else now) - started
+        objective = self.objectives.get(outcome)
+        violated = objective is not None and latency > objective
+        with self.lock:
+            histogram = self.histograms.get(outcome)
+            if histogram is None:
+                histogram = self.histograms[outcome] = LatencyHistogram(self.precision)
+            if violated:
+                self.violations[outcome] = self.violations.get(outcome, 0) + 1
+        histogram.record(latency)
+        return latency, violated
+
+    def stats(self):
+        with self.lock:
+            histograms = self.histograms.items()
+            violations = dict(self.violations)
+        return dict((outcome, dict(histogram.stats(), objective=self.objectives.get(outcome),
+                                   violations=violations.get(outcome, 0)))
+                    for outcome, histogram in histograms)
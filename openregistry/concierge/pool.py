@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from Queue import Queue
+
+_STOP = object()
+
+
+class WorkerPool(object):
+    """Call ``func`` for submitted items in at most ``size`` threads.
+
+    submit() blocks while all workers are busy, so items that are not taken
+    yet stay in the scheduler and keep their priority. With ``size`` 1 items
+    are processed inline in the calling thread.
+    """
+
+    def __init__(self, func, logger, size=1):
+        self.func = func
+        self.logger = logger
+        self.size = size
+        self.busy = 0
+        self.cond = threading.Condition()
+        self.queue = Queue()
+        self.threads = []
+
+    @property
+    def in_flight(self):
+        return self.busy
+
+    def submit(self, item):
+        with self.cond:
+            while self.busy >= self.size:
+                self.cond.wait()
+            self.busy += 1
+        if self.size <= 1:
+            self._call(item)
+            return
+        self.threads = [thread for thread in self.threads if thread.is_alive()]
+        if len(self.threads) < self.size:
+            thread = threading.Thread(target=self._work, name='lot-worker-{}'.format(len(self.threads)))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self.queue.put(item)
+
+    def join(self, timeout=None):
+        """Wait for submitted items to be processed. Returns False on timeout."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while self.busy:
+                if deadline is None:
+                    self.cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def resize(self, size):
+        with self.cond:
+            self.threads = [thread for thread in self.threads if thread.is_alive()]
+            for _ in range(len(self.threads) - size):
+                self.queue.put(_STOP)
+            self.size = size
+            self.cond.notify_all()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            self._call(item)
+
+    def _call(self, item):
+        try:
+            self.func(item)
+        except Exception:
+            self.logger.exception('Failed to process %s', item.get('id'), extra={'lot_id': item.get('id')})
+        finally:
+            with self.cond:
+                self.busy -= 1
+                self.cond.notify_all()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+import glob
+import json
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+
+from .transitions import LOT_TRANSITIONS
+
+# File layout: MAGIC, the length of a JSON header naming the phases and
+# outcomes, the header, then blocks. A block is BLOCK, the number of
+# records, their lot ids padded to ID_SIZE bytes, then each column of
+# COLUMNS and each phase latency column, little-endian. A block is written
+# at once, so a file only ends with a partial block if the worker crashed
+# while writing it, and the reader leaves that block out.
+MAGIC = 'CLR1'
+BLOCK = 'BLK1'
+ID_SIZE = 32
+MAX_COUNT = 0xffff
+UNKNOWN_OUTCOME = 0xff
+
+OUTCOMES = ('skipped', 'deferred', 'rejected', 'failed', 'rolled back', 'broken', 'active.salable', 'dissolved',
+            'interrupted')
+PHASES = ('check_lot', 'check_assets') + tuple(
+    step['name'] for status in sorted(LOT_TRANSITIONS) for step in LOT_TRANSITIONS[status]['steps']
+)
+COLUMNS = (
+    ('time', 'd'),
+    ('assets', 'H'),
+    ('retries', 'H'),
+    ('api_calls', 'H'),
+    ('outcome', 'B'),
+    ('total', 'f'),
+)
+
+
+def columns(phases):
+    return COLUMNS + tuple((phase, 'f') for phase in phases)
+
+
+def to_little_endian(column):
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column
+
+
+class LotRecordWriter(object):
+    """Append a record of every processed lot to binary columnar files.
+
+    Records are buffered per column and written as one block every
+    ``block_size`` records or on flush(), so memory only holds one block.
+    Files are named ``<prefix>-<day>-<pid>-<index>.rec`` by the UTC day of
+    their records, so worker processes never share a file, and a new one is
+    started when a file would grow over ``max_bytes``.
+    """
+
+    def __init__(self, directory, prefix='lots', max_bytes=64 * 1024 * 1024, block_size=1000):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.columns = columns(PHASES)
+        self.outcome_codes = dict((outcome, code) for code, outcome in enumerate(OUTCOMES))
+        self.file = None
+        self.file_day = None
+        self.size = 0
+        self.written = 0
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.ids = []
+        self.block = dict((name, array(typecode)) for name, typecode in self.columns)
+        self.day = None
+
+    def append(self, lot_id, assets, outcome, retries, api_calls, phases, finished=None):
+        """Buffer the record of a lot, ``phases`` maps phase names to seconds."""
+        finished = time.time() if finished is None else finished
+        day = time.strftime('%Y-%m-%d', time.gmtime(finished))
+        with self.lock:
+            if self.ids and day != self.day:
+                self._flush()
+            self.day = day
+            self.ids.append(unicode(lot_id).encode('utf-8')[:ID_SIZE].ljust(ID_SIZE, '\0'))
+            self.block['time'].append(finished)
+            self.block['assets'].append(min(assets, MAX_COUNT))
+            self.block['retries'].append(min(retries, MAX_COUNT))
+            self.block['api_calls'].append(min(api_calls, MAX_COUNT))
+            self.block['outcome'].append(self.outcome_codes.get(outcome, UNKNOWN_OUTCOME))
+            self.block['total'].append(sum(phases.values()))
+            for phase in PHASES:
+                self.block[phase].append(phases.get(phase, float('nan')))
+            if len(self.ids) >= self.block_size:
+                self._flush()
+
+    def _open(self, block_size):
+        if self.file is not None and self.file_day == self.day and self.size + block_size <= self.max_bytes:
+            return
+        if self.file is not None:
+            self.file.close()
+        name = '{}-{}-{}'.format(self.prefix, self.day, os.getpid())
+        index = len(glob.glob(os.path.join(self.directory, name + '-*.rec')))
+        path = os.path.join(self.directory, '{}-{:04d}.rec'.format(name, index))
+        header = json.dumps({'phases': PHASES, 'outcomes': OUTCOMES})
+        self.file = open(path, 'ab')
+        self.file.write(MAGIC + struct.pack('<I', len(header)) + header)
+        self.file_day = self.day
+        self.size = self.file.tell()
+
+    def _flush(self):
+        if not self.ids:
+            return
+        data = [BLOCK, struct.pack('<I', len(self.ids))] + self.ids
+        data.extend(to_little_endian(self.block[name]).tostring() for name, _ in self.columns)
+        data = ''.join(data)
+        self._open(len(data))
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+        self.written += len(self.ids)
+        self.reset()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_records(path):
+    """Load a records file into a dict of arrays, one per column.
+
+    Lot ids are in the ``id`` list and ``outcome`` holds indexes into the
+    ``outcomes`` list. Phase latencies are NaN for phases a lot didn't go
+    through.
+    """
+    with open(path, 'rb') as records_file:
+        data = records_file.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('{} is not a lot records file'.format(path))
+    offset = len(MAGIC) + 4
+    header_size = struct.unpack_from('<I', data, len(MAGIC))[0]
+    header = json.loads(data[offset:offset + header_size])
+    offset += header_size
+    file_columns = columns(header['phases'])
+    record_size = ID_SIZE + sum(array(typecode).itemsize for _, typecode in file_columns)
+
+    records = dict((name, array(typecode)) for name, typecode in file_columns)
+    records['id'] = []
+    records['outcomes'] = header['outcomes']
+    records['phases'] = header['phases']
+    while offset + 8 <= len(data):
+        tag, count = struct.unpack_from('<4sI', data, offset)
+        if tag != BLOCK or offset + 8 + count * record_size > len(data):
+            break
+        offset += 8
+        records['id'].extend(data[start:start + ID_SIZE].rstrip('\0')
+                             for start in xrange(offset, offset + count * ID_SIZE, ID_SIZE))
+        offset += count * ID_SIZE
+        for name, typecode in file_columns:
+            column = array(typecode)
+            column.fromstring(data[offset:offset + count * column.itemsize])
+            records[name].extend(to_little_endian(column))
+            offset += count * column.itemsize
+    return records
+
+
+def load_day(directory, day, prefix='lots'):
+    """Load the records of a UTC day (``YYYY-MM-DD``) from all its files, like read_records."""
+    paths = sorted(glob.glob(os.path.join(directory, '{}-{}-*.rec'.format(prefix, day))))
+    day_records = {'id': [], 'outcomes': list(OUTCOMES), 'phases': list(PHASES)}
+    for name, typecode in columns(PHASES):
+        day_records[name] = array(typecode)
+    for path in paths:
+        records = read_records(path)
+        count = len(records['id'])
+        # Outcome codes and phases of files written by other versions
+        codes = dict((code, day_records['outcomes'].index(outcome) if outcome in day_records['outcomes']
+                      else UNKNOWN_OUTCOME) for code, outcome in enumerate(records['outcomes']))
+        if any(code != new_code for code, new_code in codes.items()):
+            records['outcome'] = array('B', (codes.get(code, UNKNOWN_OUTCOME) for code in records['outcome']))
+        day_records['outcome'].extend(records['outcome'])
+        day_records['id'].extend(records['id'])
+        for name, typecode in columns(PHASES):
+            if name == 'outcome':
+                continue
+            if name in records:
+                day_records[name].extend(records[name])
+            else:
+                day_records[name].extend(array(typecode, [float('nan')] * count))
+    return day_records
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import heapq
+import threading
+import time
+
+
+class RetryScheduler(object):
+    """Time-ordered heap of broken lots waiting for another attempt.
+
+    A lot that failed ``retries`` times is due after
+    ``base_delay * 2 ** retries`` seconds, capped at ``max_delay``. Lots
+    that already failed ``max_attempts`` times are not scheduled and wait
+    for a new revision in the feed, as before.
+    """
+
+    def __init__(self, base_delay=30, max_delay=3600, max_attempts=10):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.heap = []
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def delay(self, retries):
+        return min(self.base_delay * 2 ** retries, self.max_delay)
+
+    def schedule(self, lot, now=None):
+        retries = lot.get('retries', 0)
+        if retries >= self.max_attempts:
+            self.discard(lot['id'])
+            return None
+        now = time.time() if now is None else now
+        next_attempt = now + self.delay(retries)
+        with self.lock:
+            self.entries[lot['id']] = next_attempt
+            heapq.heappush(self.heap, (next_attempt, lot['id'], lot))
+        return next_attempt
+
+    def discard(self, lot_id):
+        with self.lock:
+            self.entries.pop(lot_id, None)
+
+    def due(self, now=None):
+        now = time.time() if now is None else now
+        lots = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                next_attempt, lot_id, lot = heapq.heappop(self.heap)
+                # Entries rescheduled or discarded since are left in the heap
+                if self.entries.get(lot_id) == next_attempt:
+                    del self.entries[lot_id]
+                    lots.append(lot)
+        return lots
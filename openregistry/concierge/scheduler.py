@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import deque, OrderedDict
+
+DEFAULT_CLASS = 'default'
+
+
+class PriorityClass(object):
+    """A group of lots sharing one queue and one fair-share weight.
+
+    A lot belongs to the class if its status is in ``statuses``, its retry
+    count is within ``min_retries``..``max_retries`` and the time since the
+    scheduler first saw it is within ``min_age``..``max_age`` seconds.
+    Criteria that are not set match every lot.
+    """
+
+    def __init__(self, name, statuses=None, min_retries=0, max_retries=None,
+                 min_age=0, max_age=None, weight=1):
+        self.name = name
+        self.statuses = set(statuses) if statuses else None
+        self.min_retries = min_retries
+        self.max_retries = max_retries
+        self.min_age = min_age
+        self.max_age = max_age
+        self.weight = float(weight)
+        self.queue = deque()
+        self.pass_value = 0.0
+        self.served = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def matches(self, lot, age):
+        if self.statuses is not None and lot.get('status') not in self.statuses:
+            return False
+        retries = lot.get('retries', 0)
+        if retries < self.min_retries or (self.max_retries is not None and retries > self.max_retries):
+            return False
+        if age < self.min_age or (self.max_age is not None and age > self.max_age):
+            return False
+        return True
+
+    def stats(self, now):
+        return {
+            'depth': len(self.queue),
+            'served': self.served,
+            'avg_wait': self.total_wait / self.served if self.served else 0.0,
+            'max_wait': self.max_wait,
+            'oldest_wait': now - self.queue[0][0] if self.queue else 0.0
+        }
+
+
+class LotScheduler(object):
+    """Order lots from the feed before they are passed to process_lots.
+
+    Lots are put into the first matching priority class and classes are
+    served by stride scheduling, so each non-empty class gets a share of
+    turns proportional to its weight. A lot that has waited longer than
+    ``max_wait`` seconds is served next whatever its class, so low-weight
+    classes can't starve. With no classes configured lots are served in
+    feed order.
+    """
+
+    def __init__(self, classes=None, max_wait=300, window=100, first_seen_size=100000):
+        self.classes = [PriorityClass(**options) for options in (classes or [])]
+        defaults = [cls for cls in self.classes if cls.name == DEFAULT_CLASS]
+        if defaults:
+            self.default = defaults[0]
+        else:
+            self.default = PriorityClass(DEFAULT_CLASS)
+            self.classes.append(self.default)
+        self.max_wait = max_wait
+        self.window = window
+        self.first_seen = OrderedDict()
+        self.first_seen_size = first_seen_size
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def classify(self, lot, now):
+        first_seen = self.first_seen.setdefault(lot['id'], now)
+        if len(self.first_seen) > self.first_seen_size:
+            self.first_seen.popitem(last=False)
+        for cls in self.classes:
+            if cls.matches(lot, now - first_seen):
+                return cls
+        return self.default
+
+    def push(self, lot, now=None):
+        now = time.time() if now is None else now
+        cls = self.classify(lot, now)
+        if not cls.queue:
+            # Don't let a class bank turns while it was idle
+            active = [c.pass_value for c in self.classes if c.queue]
+            cls.pass_value = max(cls.pass_value, min(active) if active else 0.0)
+        cls.queue.append((now, lot))
+        self.length += 1
+
+    def pop(self, now=None):
+        now = time.time() if now is None else now
+        active = [cls for cls in self.classes if cls.queue]
+        if not active:
+            raise IndexError('pop from an empty scheduler')
+        oldest = min(active, key=lambda cls: cls.queue[0][0])
+        if now - oldest.queue[0][0] >= self.max_wait:
+            cls = oldest
+        else:
+            cls = min(active, key=lambda cls: cls.pass_value)
+        enqueued, lot = cls.queue.popleft()
+        cls.pass_value += 1 / cls.weight
+        cls.served += 1
+        cls.total_wait += now - enqueued
+        cls.max_wait = max(cls.max_wait, now - enqueued)
+        self.length -= 1
+        return lot
+
+    def stats(self, now=None):
+        now = time.time() if now is None else now
+        return dict((cls.name, cls.stats(now)) for cls in self.classes)
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import select
+import socket
+
+from .lag import seq_number
+from .utils import ConfigError, continuous_changes_feed
+
+logger = logging.getLogger(__name__)
+
+LOT_FIELDS = ('id', 'status', 'assets')
+
+
+def parse_lot(line):
+    """A lot from a JSON encoded event, None if the event is not a valid lot."""
+    try:
+        lot = json.loads(line)
+    except ValueError as e:
+        logger.warning('Skipping invalid lot event: %s', e)
+        return None
+    if not isinstance(lot, dict) or any(field not in lot for field in LOT_FIELDS):
+        logger.warning('Skipping lot event without %s: %s', ', '.join(LOT_FIELDS), line.strip())
+        return None
+    lot.setdefault('rev', None)
+    lot.setdefault('lotID', None)
+    return lot
+
+
+class LotSource(object):
+    """Where the worker gets changed lots from.
+
+    lots() yields the lots changed after the position ``since`` and ends
+    when there are no more changes for now. ``progress`` is called with the
+    position of every lot before it is yielded, so the worker can store it
+    as a checkpoint and pass it back as ``since``. head() returns the latest
+    position, used to tell how far behind the worker is.
+
+    Sources with ``blocking`` set wait for new lots in lots() themselves, so
+    the worker starts the next pass right away instead of sleeping.
+    """
+
+    blocking = False
+
+    def lots(self, since=0, progress=None):
+        raise NotImplementedError
+
+    def head(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class CouchDBSource(LotSource):
+    """Lots from the ``_changes`` feed of the lots database."""
+
+    def __init__(self, db, filter_doc='lots/status', limit=100):
+        self.db = db
+        self.filter_doc = filter_doc
+        self.limit = limit
+
+    def lots(self, since=0, progress=None):
+        return continuous_changes_feed(self.db, logger, limit=self.limit, filter_doc=self.filter_doc,
+                                       progress=progress, since=since)
+
+    def head(self):
+        return self.db.info()['update_seq']
+
+
+class RedisStreamSource(LotSource):
+    """Lots pushed to a Redis stream, one JSON encoded lot in the ``lot`` field of each entry.
+
+    Positions are stream entry ids, so the lag distance is in milliseconds.
+    """
+
+    blocking = True
+
+    def __init__(self, url='redis://localhost:6379/0', stream='lots', count=100, block=1000):
+        try:
+            import redis
+        except ImportError:
+            raise ConfigError('The redis package is required for the redis lot source')
+        self.redis = redis
+        self.client = redis.StrictRedis.from_url(url)
+        self.stream = stream
+        self.count = count
+        self.block = block
+
+    def lots(self, since=0, progress=None):
+        last_id = str(since or 0)
+        while True:
+            try:
+                response = self.client.xread({self.stream: last_id}, count=self.count, block=self.block)
+            except self.redis.RedisError as e:
+                logger.error('Failed to get lots from Redis: %s', e)
+                return
+            if not response:
+                return
+            for entry_id, fields in response[0][1]:
+                last_id = entry_id
+                lot = parse_lot(fields.get('lot', ''))
+                if progress is not None:
+                    progress(entry_id)
+                if lot is not None:
+                    yield lot
+
+    def head(self):
+        return seq_number(self.client.xinfo_stream(self.stream)['last-generated-id'])
+
+
+class FileSource(LotSource):
+    """Lots appended to a file as JSON lines. Positions are byte offsets."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def lots(self, since=0, progress=None):
+        offset = seq_number(since)
+        try:
+            lots_file = open(self.path)
+        except IOError as e:
+            logger.error('Failed to open %s: %s', self.path, e.strerror)
+            return
+        with lots_file:
+            lots_file.seek(offset)
+            for line in iter(lots_file.readline, ''):
+                if not line.endswith('\n'):
+                    # Still being written, read it on the next pass
+                    return
+                offset += len(line)
+                lot = parse_lot(line)
+                if progress is not None:
+                    progress(offset)
+                if lot is not None:
+                    yield lot
+
+    def head(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+
+class SocketSource(LotSource):
+    """Lots sent as JSON lines to a Unix socket the worker listens on.
+
+    A pass ends when nothing is received for ``timeout`` seconds. Events are
+    not stored, so positions only count events received by this process.
+    """
+
+    blocking = True
+
+    def __init__(self, path, timeout=1.0):
+        self.path = path
+        self.timeout = timeout
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(16)
+        self.buffers = {}
+        self.received = 0
+
+    def lots(self, since=0, progress=None):
+        while True:
+            readable, _, _ = select.select([self.server] + list(self.buffers), [], [], self.timeout)
+            if not readable:
+                return
+            for sock in readable:
+                if sock is self.server:
+                    connection, _ = self.server.accept()
+                    self.buffers[connection] = ''
+                    continue
+                data = sock.recv(65536)
+                if not data:
+                    sock.close()
+                    del self.buffers[sock]
+                    continue
+                lines = (self.buffers[sock] + data).split('\n')
+                self.buffers[sock] = lines.pop()
+                for line in lines:
+                    self.received += 1
+                    lot = parse_lot(line)
+                    if progress is not None:
+                        progress(self.received)
+                    if lot is not None:
+                        yield lot
+
+    def head(self):
+        return self.received
+
+    def close(self):
+        for sock in self.buffers:
+            sock.close()
+        self.buffers = {}
+        self.server.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+SOURCES = {
+    'couchdb': CouchDBSource,
+    'redis': RedisStreamSource,
+    'file': FileSource,
+    'socket': SocketSource,
+}
+
+
+def make_source(config, db):
+    """The lot source set in the ``source`` section, the lots database by default."""
+    options = dict(config.get('source') or {})
+    source_type = options.pop('type', 'couchdb')
+    if source_type not in SOURCES:
+        raise ConfigError('Unknown lot source "{}"'.format(source_type))
+    if source_type == 'couchdb':
+        return CouchDBSource(db, filter_doc=config['db']['filter'], **options)
+    return SOURCES[source_type](**options)
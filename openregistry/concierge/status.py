@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+logger = logging.getLogger(__name__)
+
+
+def write_status_file(path, status):
+    """Replace ``path`` with ``status`` as JSON, so readers never see a partial file."""
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'w') as status_file:
+        json.dump(status, status_file, sort_keys=True)
+    os.rename(tmp_path, path)
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        route = self.server.routes.get(self.path.split('?', 1)[0])
+        if route is None:
+            self.send_json(404, {'error': 'Not found'})
+            return
+        try:
+            code, body = route()
+        except Exception as e:
+            logger.exception('Failed to get status for %s', self.path)
+            code, body = 500, {'error': str(e)}
+        self.send_json(code, body)
+
+    def send_json(self, code, body):
+        data = json.dumps(body, sort_keys=True, default=str)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # address_string() would look the client up in DNS for every request
+        logger.debug('%s - ' + format, self.client_address[0], *args)
+
+
+class StatusServer(ThreadingMixIn, HTTPServer):
+    """JSON status endpoints served from a background thread.
+
+    Each route is a function returning an HTTP status code and a body, and
+    is called in the thread of the request.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=6060):
+        HTTPServer.__init__(self, (host, port), StatusHandler)
+        self.routes = {}
+        self.thread = None
+
+    def route(self, path, func):
+        self.routes[path] = func
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='status-server')
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info('Serving status on %s:%s', *self.server_address)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from Queue import Empty, Full
+
+from .lag import seq_number
+from .log import configure_logging
+from .sources import make_source
+from .utils import BulkDocsWriter, couchdb_url, install_signal_handler, prepare_couchdb, shard
+
+logger = logging.getLogger(__name__)
+
+
+def merge_stats(total, stats):
+    """Add up the numbers in ``stats`` into ``total``, nested dicts included."""
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            merge_stats(total.setdefault(key, {}), value)
+        elif isinstance(value, (int, long, float)):
+            total[key] = total.get(key, 0) + value
+    return total
+
+
+def run_child(worker_factory, config, index, processes, lots, reports):
+    # Listener threads of the parent don't survive the fork
+    listeners = configure_logging(config)
+    try:
+        worker = worker_factory(config, sync=False, shard=(index, processes))
+        worker.install_signal_handlers()
+        # Ctrl-C reaches the whole process group, the supervisor stops the processes with SIGTERM
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        worker.consume(lots, reports, index)
+    finally:
+        for listener in listeners:
+            listener.stop()
+
+
+class Supervisor(object):
+    """Read the feed in this process and shard lots between worker processes.
+
+    A lot always goes to the same process, so one lot is never handled by two
+    processes at once. Processes that die are restarted on the same queue,
+    and the stats they report are merged for logging.
+
+    SIGTERM and SIGINT stop reading the feed and stop the processes, which
+    finish or interrupt their lots in flight within ``shutdown_timeout``.
+    The checkpoint is then the position of the first lot that isn't done,
+    counting the lots taken back from the queues. It is only stored if no
+    process died or had to be killed, as their lots may be lost otherwise.
+    Reloading the config with SIGHUP is not supported in this mode; the
+    signal is logged and ignored, and changes need a restart.
+    """
+
+    def __init__(self, config, processes, worker_factory):
+        self.config = config
+        self.processes = processes
+        self.worker_factory = worker_factory
+        self.sleep = config['time_to_sleep']
+        self.db = prepare_couchdb(couchdb_url(config['db']), config['db']['name'], logger, config['errors_doc'])
+        self.source = make_source(config, self.db)
+        self.writer = BulkDocsWriter(self.db, logger)
+        checkpoint_doc = config.get('checkpoint_doc', 'concierge_checkpoint')
+        self.checkpoint_doc = self.db.get(checkpoint_doc) or {'_id': checkpoint_doc}
+        self.seq = self.previous_seq = self.checkpoint_doc.get('seq', 0)
+        self.rescanned = time.time() if self.seq else 0
+        self.undelivered = None
+        self.unfinished = {}
+        self.stopping = threading.Event()
+        queue_size = config.get('supervisor', {}).get('queue_size', 1000)
+        self.queues = [multiprocessing.Queue(queue_size) for _ in range(processes)]
+        self.reports = multiprocessing.Queue()
+        self.children = [None] * processes
+        self.child_stats = {}
+        self.restarts = 0
+
+    def start_child(self, index):
+        child = multiprocessing.Process(
+            target=run_child, name='concierge-worker-{}'.format(index),
+            args=(self.worker_factory, self.config, index, self.processes, self.queues[index], self.reports)
+        )
+        child.daemon = True
+        child.start()
+        self.children[index] = child
+
+    def check_children(self):
+        for index, child in enumerate(self.children):
+            if not child.is_alive():
+                self.restarts += 1
+                logger.warning('Worker process %s exited with code %s, restarting', index, child.exitcode)
+                self.start_child(index)
+
+    def put(self, lot):
+        """Queue ``lot`` with the feed position before it. Returns False if stopped before it fit in."""
+        queue = self.queues[shard(lot['id'], self.processes)]
+        while True:
+            try:
+                queue.put((self.previous_seq, lot), True, self.sleep)
+                return True
+            except Full:
+                if self.stopping.is_set():
+                    self.undelivered = self.previous_seq
+                    return False
+                self.check_children()
+
+    def install_signal_handlers(self):
+        install_signal_handler(signal.SIGHUP, self.refuse_reload)
+        install_signal_handler(signal.SIGTERM, self.request_stop)
+        install_signal_handler(signal.SIGINT, self.request_stop)
+
+    def request_stop(self, signum=None, frame=None):
+        self.stopping.set()
+
+    def refuse_reload(self, signum=None, frame=None):
+        logger.warning('Reloading the config is not supported with several worker processes, restart to apply it')
+
+    def feed_progress(self, seq):
+        self.previous_seq, self.seq = self.seq, seq
+
+    def since(self, now=None):
+        """Feed position to read from, the start of the feed every ``rescan_interval`` seconds.
+
+        Lots skipped or deferred by the worker processes are only seen again
+        on a full rescan, like with a single process.
+        """
+        now = time.time() if now is None else now
+        if now - self.rescanned >= self.config.get('rescan_interval', 3600):
+            self.seq = 0
+            self.rescanned = now
+        self.previous_seq = self.seq
+        return self.seq
+
+    def stats(self):
+        while True:
+            try:
+                index, stats = self.reports.get_nowait()
+            except Empty:
+                break
+            if 'unfinished' in stats:
+                self.unfinished[index] = stats.pop('unfinished')
+            self.child_stats[index] = stats
+        total = {'processes': self.processes, 'restarts': self.restarts}
+        for stats in self.child_stats.values():
+            merge_stats(total, stats)
+        return total
+
+    def run(self):
+        logger.info('Starting %s worker processes', self.processes)
+        for index in range(self.processes):
+            self.start_child(index)
+        try:
+            while not self.stopping.is_set():
+                logger.info('Getting Lots')
+                for lot in self.source.lots(self.since(), progress=self.feed_progress):
+                    if not self.put(lot) or self.stopping.is_set():
+                        break
+                self.check_children()
+                logger.debug('Worker stats: %s', self.stats())
+                if not self.source.blocking:
+                    self.stopping.wait(self.sleep)
+        finally:
+            self.source.close()
+            self.stop_children()
+
+    def stop_children(self):
+        """Stop the worker processes, take back the lots still queued and store the checkpoint."""
+        timeout = self.config.get('shutdown_timeout', 30)
+        logger.info('Stopping worker processes, waiting up to %s seconds for lots in flight', timeout)
+        for child in self.children:
+            if child is not None and child.is_alive():
+                child.terminate()
+        # The processes stop at their own deadline, this one leaves them time to report
+        deadline = time.time() + timeout + self.sleep
+        complete = self.restarts == 0
+        for index, child in enumerate(self.children):
+            if child is None:
+                continue
+            child.join(max(deadline - time.time(), 0))
+            if child.is_alive():
+                logger.warning('Worker process %s did not stop in time, killing it', index)
+                os.kill(child.pid, signal.SIGKILL)
+                child.join()
+        self.stats()
+
+        positions = [] if self.undelivered is None else [self.undelivered]
+        for queue in self.queues:
+            while True:
+                try:
+                    item = queue.get(True, 0.1)
+                except Empty:
+                    break
+                if item is not None:
+                    positions.append(item[0])
+        for index in range(self.processes):
+            if index not in self.unfinished:
+                complete = False
+            elif self.unfinished[index] is not None:
+                positions.append(self.unfinished[index])
+        if not complete:
+            logger.warning('Not storing the feed position, lots of worker processes that died may be lost')
+            return
+        self.save_checkpoint(min(positions, key=seq_number) if positions else self.seq)
+
+    def save_checkpoint(self, seq):
+        if seq != self.checkpoint_doc.get('seq'):
+            self.writer.set_item(self.checkpoint_doc, 'seq', seq)
+            self.writer.set_item(self.checkpoint_doc, 'updated', time.time())
+            self.writer.flush()
+        logger.info('Stopped at seq %s', seq)
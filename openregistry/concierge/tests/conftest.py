@@ -36,9 +36,12 @@ TEST_CONFIG = {
 
 @pytest.fixture(scope='function')
 def bot(mocker):
-    mocker.patch('openregistry.concierge.worker.LotsClient', autospec=True)
-    mocker.patch('openregistry.concierge.worker.AssetsClient', autospec=True)
-    return BotWorker(TEST_CONFIG)
+    mocker.patch('openprocurement_client.resources.lots.LotsClient', autospec=True)
+    mocker.patch('openprocurement_client.resources.assets.AssetsClient', autospec=True)
+    worker = BotWorker(TEST_CONFIG)
+    yield worker
+    # Progress updates are buffered until the worker flushes or shuts down
+    worker.errors_writer.flush(worker.progress.doc['_id'])
 
 
 class LogInterceptor(object):
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from couchdb.client import Row
+
+from openregistry.concierge.batch import changes_between, format_summary, lots_by_id, run_batch
+
+
+def make_lot(lot_id):
+    return {'id': lot_id, 'rev': '1-a', 'status': 'pending.dissolution', 'assets': [], 'lotID': lot_id}
+
+
+def test_changes_between(bot, mocker):
+    def feed(db, logger, filter_doc, progress, since):
+        for seq in range(since + 1, since + 6):
+            progress('{}-abc'.format(seq))
+            yield make_lot(str(seq))
+
+    mock_feed = mocker.patch('openregistry.concierge.batch.continuous_changes_feed', side_effect=feed)
+
+    lots = list(changes_between(bot, since=10, until=13))
+
+    assert [lot['id'] for lot in lots] == ['11', '12', '13']
+    assert mock_feed.call_args[1]['since'] == 10
+
+
+def test_lots_by_id(bot, mocker):
+    mock_db = mocker.patch.object(bot, 'db')
+    doc = {'_id': 'lot_1', '_rev': '2-b', 'status': 'verification', 'assets': ['asset_1'], 'lotID': 'UA-1'}
+    mock_db.view.return_value = [Row(key='lot_1', doc=doc), Row(key='lot_2', doc=None)]
+    missing = []
+
+    lots = list(lots_by_id(bot, ['lot_1', 'lot_2'], missing))
+
+    assert lots == [{'id': 'lot_1', 'rev': '2-b', 'status': 'verification', 'assets': ['asset_1'], 'lotID': 'UA-1'}]
+    assert missing == ['lot_2']
+
+
+def test_run_batch(bot, mocker):
+    mock_process_lots = mocker.patch.object(bot, 'process_lots', autospec=True)
+    mock_process_lots.side_effect = ['dissolved', 'skipped', 'dissolved']
+
+    summary = run_batch(bot, (make_lot(lot_id) for lot_id in ('1', '2', '3')), dry_run=True)
+
+    assert mock_process_lots.call_count == 3
+    assert bot.dry_run is True
+    assert summary['lots'] == 3
+    assert summary['outcomes'] == {'dissolved': 2, 'skipped': 1}
+    assert summary['dry_run'] is True
+
+    summary['elapsed'] = 1.5
+    summary['api_calls'] = {'GET lots.example.com': 4}
+    assert format_summary(summary) == '\n'.join([
+        'Dry run: Processed 3 lots in 1.5 seconds',
+        'Outcomes:',
+        '  dissolved: 2',
+        '  skipped: 1',
+        'API calls:',
+        '  GET lots.example.com: 4',
+        'Skipped asset patches: 0'
+    ])
+
+
+def test_run_batch_closes_records(bot, mocker):
+    mocker.patch.object(bot, 'process_lots', autospec=True, return_value='dissolved')
+    mock_records = mocker.patch.object(bot, 'records')
+
+    run_batch(bot, [make_lot('1')])
+
+    assert mock_records.append.call_count == 1
+    mock_records.close.assert_called_once_with()
+
+
+def test_dry_run_patches(bot):
+    bot.dry_run = True
+    lot = make_lot('lot_1')
+    lot['assets'] = ['asset_1', 'asset_2']
+
+    assert bot.patch_lot(lot, 'active.salable') is True
+    assert bot.patch_assets(lot, 'active', lot['id']) == (True, ['asset_1', 'asset_2'])
+    assert bot.lots_client.patch_lot.call_count == 0
+    assert bot.assets_client.patch_asset.call_count == 0
+
+
+def test_dry_run_writes_nothing(bot, mocker):
+    def process_lots(lot):
+        bot.count_api_call('GET', 'lots')
+        bot.progress.save(lot, 1)
+        bot.mark_broken(lot, 'Failed to patch')
+        return 'broken'
+
+    mocker.patch.object(bot, 'process_lots', autospec=True, side_effect=process_lots)
+    mock_update = mocker.patch.object(bot.db, 'update', autospec=True)
+
+    summary = run_batch(bot, (make_lot(lot_id) for lot_id in ('dry_1', 'dry_2')), dry_run=True)
+
+    assert summary['api_calls'] == {'GET lots': 2}
+    assert summary['outcomes'] == {'broken': 2}
+    assert bot.progress.doc['dry_1']['step'] == 1
+    assert bot.errors_doc['dry_2']['message'] == 'Failed to patch'
+    assert len(bot.errors_writer) == 0
+    assert not mock_update.called
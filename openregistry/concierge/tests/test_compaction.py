@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from openregistry.concierge.compaction import ErrorsCompactor
+from openregistry.concierge.utils import BulkDocsWriter
+
+DAY = 24 * 3600
+NOW = 1540000000  # 2018-10-20
+
+
+def test_compact_resolved_lots(mocker):
+    db = mocker.MagicMock()
+    db.get.side_effect = lambda doc_id: {'_id': doc_id, '_rev': '1-a', 'old_lot': {}} if doc_id.endswith('09') else None
+    db.update.side_effect = lambda docs: [(True, doc['_id'], '2-b') for doc in docs]
+    logger = mocker.MagicMock()
+    doc = {
+        '_id': 'broken_lots',
+        '_rev': '5-e',
+        'broken': {'id': 'broken', 'resolved': False, 'message': 'patching lot to active.salable'},
+        'recent': {'id': 'recent', 'resolved': True, 'resolved_at': NOW - DAY},
+        'september': {'id': 'september', 'resolved': True, 'resolved_at': NOW - 30 * DAY},
+        'august': {'id': 'august', 'resolved': True, 'resolved_at': NOW - 60 * DAY},
+        'legacy': {'id': 'legacy', 'resolved': True}
+    }
+    compactor = ErrorsCompactor(db, BulkDocsWriter(db, logger), doc, logger, retention=7 * DAY)
+
+    assert compactor.compact(now=NOW) == 2
+
+    assert sorted(key for key in doc if not key.startswith('_')) == ['broken', 'legacy', 'recent']
+    assert doc['legacy']['resolved_at'] == NOW
+    saved = dict((saved_doc['_id'], saved_doc) for saved_doc in db.update.call_args[0][0])
+    assert sorted(saved) == ['broken_lots', 'broken_lots_archive_2018-08', 'broken_lots_archive_2018-09']
+    assert saved['broken_lots_archive_2018-09']['september']['resolved_at'] == NOW - 30 * DAY
+    assert 'old_lot' in saved['broken_lots_archive_2018-09']
+    assert saved['broken_lots_archive_2018-08']['august']['id'] == 'august'
+
+    report = compactor.report
+    assert report['entries'] == 3
+    assert report['unresolved'] == 1
+    assert report['archived'] == 2
+    assert report['bytes'] > 0
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+import yaml
+
+from openregistry.concierge.config import check_config
+
+CONFIG = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'concierge.yaml')
+
+
+def load_config():
+    with open(CONFIG) as config_file:
+        return yaml.load(config_file.read())
+
+
+def test_check_config_valid():
+    assert check_config(load_config()) == []
+
+
+def test_check_config_missing():
+    config = load_config()
+    del config['db']['name']
+    del config['assets']['api']
+
+    assert check_config(config) == [
+        'db.name: missing',
+        'assets.api.url: missing',
+        'assets.api.token: missing',
+        'assets.api.version: missing'
+    ]
+
+
+def test_check_config_options():
+    config = load_config()
+    config['workers'] = 0
+    config['lots']['api']['url'] = 'lots.example.com'
+    config['lots']['api']['rate_limits'] = {'POST': {'rate': 1}, 'GET': {'burst': 5}}
+    config['retry']['max_retry'] = 3
+    config['scheduler']['classes'].append({'statuses': ['pending']})
+
+    assert check_config(config) == [
+        'workers: expected a positive integer',
+        'lots.api.url: "lots.example.com" is not an http(s) URL',
+        'lots.api.rate_limits.GET: missing option "rate"',
+        'lots.api.rate_limits: unknown operation "POST"',
+        'retry: unknown option "max_retry"',
+        'scheduler.classes[3]: missing option "name"'
+    ]
+
+
+def test_check_config_command(mocker, capsys, tmpdir):
+    from openregistry.concierge.worker import main
+    config_file = tmpdir.join('concierge.yaml')
+
+    mocker.patch('sys.argv', ['concierge_worker', str(config_file), '--check-config'])
+    with pytest.raises(SystemExit) as exit_info:
+        main()
+    assert exit_info.value.code == 1
+    assert capsys.readouterr()[1].startswith('Failed to load {}: '.format(config_file))
+
+    config_file.write('db: [')
+    with pytest.raises(SystemExit) as exit_info:
+        main()
+    assert exit_info.value.code == 1
+
+    config_file.write('db: {}')
+    with pytest.raises(SystemExit) as exit_info:
+        main()
+    assert exit_info.value.code == 1
+    assert capsys.readouterr()[0].startswith('db.host: missing')
+
+    config_file.write(yaml.safe_dump(load_config()))
+    main()
+    assert capsys.readouterr()[0] == '{}: OK\n'.format(config_file)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from openregistry.concierge.conflicts import AssetIndex
+from openregistry.concierge.utils import LRUCache
+
+
+def test_asset_index_conflicts():
+    states = LRUCache()
+    states.set('asset_1', ('active', 'lot_a'))
+    states.set('asset_2', ('pending', None))
+    index = AssetIndex(states)
+
+    assert index.conflicts({'id': 'lot_a', 'assets': ['asset_1', 'asset_2']}) == {}
+    assert index.conflicts({'id': 'lot_b', 'assets': ['asset_1', 'asset_2', 'asset_3']}) == {'asset_1': 'lot_a'}
+
+
+def test_asset_index_serializes_lots():
+    index = AssetIndex(LRUCache())
+    lot_a = {'id': 'lot_a', 'assets': ['asset_1', 'asset_2']}
+    lot_b = {'id': 'lot_b', 'assets': ['asset_2', 'asset_3']}
+    lot_c = {'id': 'lot_c', 'assets': ['asset_4']}
+    order = []
+
+    assert index.acquire(lot_a) == 0
+    assert index.acquire(lot_c) == 0
+
+    def process_lot_b():
+        index.acquire(lot_b)
+        order.append('lot_b')
+        index.release(lot_b)
+
+    thread = threading.Thread(target=process_lot_b)
+    thread.start()
+    time.sleep(0.1)
+    order.append('lot_a')
+    index.release(lot_a)
+    thread.join(1)
+
+    assert order == ['lot_a', 'lot_b']
+    assert index.waits == 1
+    assert index.in_flight == {'asset_4': 'lot_c'}
+
+
+def test_asset_index_serializes_changes_of_a_lot():
+    index = AssetIndex(LRUCache())
+    lot = {'id': 'lot_a', 'assets': ['asset_1']}
+    order = []
+
+    assert index.acquire(lot) == 0
+    assert index.busy(lot) == ['asset_1']
+
+    def process_next_change():
+        index.acquire(dict(lot, rev='2-b'))
+        order.append('2-b')
+        index.release(lot)
+
+    thread = threading.Thread(target=process_next_change)
+    thread.start()
+    time.sleep(0.1)
+    order.append('1-a')
+    index.release(lot)
+    thread.join(1)
+
+    assert order == ['1-a', '2-b']
+    assert index.in_flight == {}
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import json
+import urllib2
+
+from openregistry.concierge.lag import FeedLag, seq_number
+from openregistry.concierge.status import StatusHandler, StatusServer
+
+
+def test_seq_number():
+    assert seq_number(42) == 42
+    assert seq_number('42-g1AAAAG7eJzLYWBgYMlgTmHgz8tPSTV0MDQy') == 42
+    assert seq_number('now') == 0
+
+
+def test_feed_lag():
+    lag = FeedLag()
+    lag.update_head(100, now=0)
+    lag.update_head(150, now=10)
+    lag.update_head(200, now=20)
+
+    lag.update_seq('120-abc')
+    assert lag.distance == 80
+    assert lag.behind(now=30) == 20
+
+    lag.update_seq(90)
+    assert lag.seq == 120
+
+    lag.update_seq(50000)
+    assert lag.status(now=30) == {'seq': 50000, 'head': 200, 'distance': 0, 'behind': 0.0}
+
+
+def test_status_server():
+    server = StatusServer(port=0)
+    server.route('/lag', lambda: (200, {'distance': 3}))
+    server.start()
+    try:
+        url = 'http://{}:{}'.format(*server.server_address)
+        assert json.load(urllib2.urlopen(url + '/lag')) == {'distance': 3}
+        try:
+            urllib2.urlopen(url + '/missing')
+        except urllib2.HTTPError as e:
+            assert e.code == 404
+        else:
+            assert False, 'expected 404'
+    finally:
+        server.stop()
+
+
+def test_status_server_request_log(mocker):
+    mock_logger = mocker.patch('openregistry.concierge.status.logger')
+    mock_address = mocker.patch.object(StatusHandler, 'address_string')
+    server = StatusServer(port=0)
+    server.route('/lag', lambda: (200, {'distance': 3}))
+    server.start()
+    try:
+        urllib2.urlopen('http://{}:{}/lag'.format(*server.server_address)).read()
+    finally:
+        server.stop()
+
+    # The message is only formatted if DEBUG is enabled
+    assert mock_logger.debug.call_args[0] == ('%s - "%s" %s %s', '127.0.0.1', 'GET /lag HTTP/1.1', '200', '-')
+    assert not mock_address.called
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import logging
+from json import loads
+from Queue import Queue
+
+from openregistry.concierge.log import (
+    JSONFormatter,
+    QueueHandler,
+    QueueListener,
+    RateLimitFilter,
+    configure_logging
+)
+
+
+def make_record(msg, args=(), level=logging.INFO, **extra):
+    record = logging.LogRecord('openregistry.concierge.worker', level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_json_formatter():
+    record = make_record('Successfully patched asset %s to %s', ('e519404fd0b94305b3b19ec60add05e7', 'active'),
+                         lot_id='9ee8f769438e403ebfb17b2240aedcf1', asset_id='e519404fd0b94305b3b19ec60add05e7',
+                         phase='patch_assets', MESSAGE_ID='patch_asset')
+
+    data = loads(JSONFormatter().format(record))
+
+    assert data['message'] == 'Successfully patched asset e519404fd0b94305b3b19ec60add05e7 to active'
+    assert data['level'] == 'INFO'
+    assert data['lot_id'] == '9ee8f769438e403ebfb17b2240aedcf1'
+    assert data['asset_id'] == 'e519404fd0b94305b3b19ec60add05e7'
+    assert data['phase'] == 'patch_assets'
+    assert data['message_id'] == 'patch_asset'
+
+
+def test_rate_limit_filter(mocker):
+    mock_time = mocker.patch('openregistry.concierge.log.time.time')
+    mock_time.return_value = 100.0
+    rate_limit = RateLimitFilter(rate=2, per=1)
+
+    assert rate_limit.filter(make_record('Processing lot %s', ('1',))) is True
+    assert rate_limit.filter(make_record('Processing lot %s', ('2',))) is True
+    assert rate_limit.filter(make_record('Processing lot %s', ('3',))) is False
+    assert rate_limit.filter(make_record('Skipping lot %s', ('3',))) is True
+    assert rate_limit.filter(make_record('Processing lot %s', ('4',), level=logging.ERROR)) is True
+
+    mock_time.return_value = 101.0
+    record = make_record('Processing lot %s', ('5',))
+    assert rate_limit.filter(record) is True
+    assert record.suppressed == 1
+
+
+def test_rate_limit_filter_keeps_audit_records():
+    rate_limit = RateLimitFilter(rate=1, per=1)
+
+    for asset_id in ('e519404fd0b94305b3b19ec60add05e7', '64099f8259c64215b3bd290bc12ec73a'):
+        record = make_record('Successfully patched asset %s to %s', (asset_id, 'active'), MESSAGE_ID='patch_asset')
+        assert rate_limit.filter(record) is True
+    assert rate_limit.filter(make_record('Successfully got asset %s', ('1',))) is True
+    assert rate_limit.filter(make_record('Successfully got asset %s', ('2',))) is False
+
+
+def test_queue_handler_and_listener():
+    queue = Queue(1)
+    handler = QueueHandler(queue)
+    patched_assets = ['e519404fd0b94305b3b19ec60add05e7']
+
+    handler.handle(make_record("Assets %s will be repatched to 'pending'", (patched_assets,)))
+    handler.handle(make_record('Skipping lot %s', ('dropped',)))
+    patched_assets.append('64099f8259c64215b3bd290bc12ec73a')
+
+    assert handler.dropped == 1
+
+    records = []
+    target = logging.Handler()
+    target.emit = records.append
+    listener = QueueListener(queue, target)
+    listener.start()
+    listener.stop()
+
+    assert len(records) == 1
+    assert records[0].getMessage() == "Assets ['e519404fd0b94305b3b19ec60add05e7'] will be repatched to 'pending'"
+
+
+def test_configure_logging_keeps_module_loggers():
+    module_logger = logging.getLogger('openregistry.concierge.status')
+    assert configure_logging({'version': 1, 'loggers': {'openregistry.concierge.tests': {'level': 'INFO'}}}) == []
+    assert not module_logger.disabled
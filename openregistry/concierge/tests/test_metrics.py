@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from openregistry.concierge.metrics import LatencyHistogram, LatencySLO, PhaseTimings
+
+
+def test_latency_histogram():
+    histogram = LatencyHistogram(precision=0.01)
+    assert histogram.percentile(95) is None
+
+    for value in range(1, 1001):
+        histogram.record(value / 100.0)
+    assert histogram.count == 1000
+    assert histogram.max == 10.0
+    assert abs(histogram.percentile(50) - 5.0) <= 0.05
+    assert abs(histogram.percentile(95) - 9.5) <= 0.095
+    assert histogram.percentile(100) == 10.0
+    # Memory depends on the range of the values, not their number
+    assert len(histogram.buckets) < 700
+
+    stats = histogram.stats()
+    assert stats['count'] == 1000
+    assert abs(stats['avg'] - 5.005) < 1e-9
+    assert set(stats) == {'count', 'total', 'max', 'avg', 'p50', 'p90', 'p95', 'p99'}
+
+
+def test_latency_histogram_small_values():
+    histogram = LatencyHistogram()
+    histogram.record(0)
+    histogram.record(0.0001)
+    assert histogram.percentile(99) == 0.0001
+
+
+def test_phase_timings():
+    timings = PhaseTimings()
+    timings.record('check_lot', 0.5)
+    timings.record('check_lot', 1.5)
+    stats = timings.stats()
+    assert list(stats) == ['check_lot']
+    assert stats['check_lot']['count'] == 2
+    assert stats['check_lot']['total'] == 2.0
+    assert stats['check_lot']['max'] == 1.5
+
+
+def test_latency_slo():
+    slo = LatencySLO(objectives={'active.salable': 60}, max_tracked=2)
+    lot = {'id': 'lot_1', 'status': 'verification'}
+
+    slo.start(lot, now=100)
+    slo.start(lot, now=150)
+    assert slo.finish(lot, 'active.salable', now=130) == (30, False)
+    assert slo.finish(lot, 'active.salable', now=140) is None
+
+    slo.start(lot, now=200)
+    assert slo.finish(lot, 'active.salable', now=300) == (100, True)
+    slo.start(dict(lot, status='pending.dissolution'), now=200)
+    assert slo.finish(dict(lot, status='pending.dissolution'), 'dissolved', now=1000) == (800, False)
+
+    stats = slo.stats()
+    assert stats['active.salable']['count'] == 2
+    assert stats['active.salable']['violations'] == 1
+    assert stats['active.salable']['objective'] == 60
+    assert stats['dissolved']['objective'] is None
+    assert stats['dissolved']['violations'] == 0
+
+    for index in range(3):
+        slo.start({'id': 'lot_{}'.format(index), 'status': 'verification'})
+    assert len(slo.started) == 2
+    slo.max_tracked = 1
+    assert slo.started.size == 1
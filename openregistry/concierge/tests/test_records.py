@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import math
+import os
+
+from openregistry.concierge.records import OUTCOMES, LotRecordWriter, load_day, read_records
+
+# 2018-03-01 12:00:00 UTC
+NOON = 1519905600
+
+
+def test_write_and_read_records(tmpdir):
+    writer = LotRecordWriter(str(tmpdir), block_size=2)
+    writer.append('e519404fd0b94305b3b19ec60add05e7', 2, 'active.salable', 1, 6,
+                  {'check_lot': 0.25, 'assets to verification': 0.5}, finished=NOON)
+    assert len(tmpdir.listdir()) == 0
+
+    writer.append('lot_2', 0, 'skipped', 0, 1, {'check_lot': 0.125}, finished=NOON + 1)
+    writer.append('lot_3', 1, 'something new', 0, 70000, {}, finished=NOON + 2)
+    assert writer.written == 2
+    writer.close()
+
+    paths = tmpdir.listdir()
+    assert len(paths) == 1
+    assert paths[0].basename == 'lots-2018-03-01-{}-0000.rec'.format(os.getpid())
+
+    records = read_records(str(paths[0]))
+    assert records['id'] == ['e519404fd0b94305b3b19ec60add05e7', 'lot_2', 'lot_3']
+    assert list(records['time']) == [NOON, NOON + 1, NOON + 2]
+    assert list(records['assets']) == [2, 0, 1]
+    assert list(records['retries']) == [1, 0, 0]
+    assert list(records['api_calls']) == [6, 1, 65535]
+    assert [records['outcomes'][code] if code < len(OUTCOMES) else None for code in records['outcome']] == \
+        ['active.salable', 'skipped', None]
+    assert list(records['total']) == [0.75, 0.125, 0]
+    assert list(records['check_lot'])[:2] == [0.25, 0.125]
+    assert math.isnan(records['check_lot'][2])
+    assert math.isnan(records['check_assets'][0])
+
+
+def test_load_day(tmpdir):
+    writer = LotRecordWriter(str(tmpdir), max_bytes=1024, block_size=1)
+    for index in range(20):
+        writer.append('lot_{}'.format(index), 1, 'dissolved', 0, 2, {'check_lot': 0.1}, finished=NOON + index)
+    writer.append('next_day', 1, 'dissolved', 0, 2, {}, finished=NOON + 24 * 3600)
+    writer.close()
+
+    paths = sorted(path.basename for path in tmpdir.listdir())
+    assert len(paths) > 2
+    assert all(os.path.getsize(str(tmpdir.join(path))) <= 1024 for path in paths)
+
+    records = load_day(str(tmpdir), '2018-03-01')
+    assert records['id'] == ['lot_{}'.format(index) for index in range(20)]
+    assert set(records['outcome']) == {OUTCOMES.index('dissolved')}
+    assert load_day(str(tmpdir), '2018-03-02')['id'] == ['next_day']
+    assert load_day(str(tmpdir), '2018-03-03')['id'] == []
+
+
+def test_read_records_partial_block(tmpdir):
+    writer = LotRecordWriter(str(tmpdir), block_size=1)
+    writer.append('lot_1', 1, 'rejected', 0, 2, {}, finished=NOON)
+    writer.append('lot_2', 1, 'rejected', 0, 2, {}, finished=NOON)
+    writer.close()
+
+    path = tmpdir.listdir()[0]
+    data = path.read('rb')
+    path.write(data[:-10], 'wb')
+    assert read_records(str(path))['id'] == ['lot_1']
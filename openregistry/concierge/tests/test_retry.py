@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from openregistry.concierge.retry import RetryScheduler
+
+
+def test_retry_backoff():
+    retries = RetryScheduler(base_delay=10, max_delay=60, max_attempts=5)
+
+    assert retries.delay(0) == 10
+    assert retries.delay(2) == 40
+    assert retries.delay(4) == 60
+
+    assert retries.schedule({'id': 'lot_1', 'retries': 1}, now=0) == 20
+    assert retries.schedule({'id': 'lot_2'}, now=0) == 10
+    assert retries.schedule({'id': 'lot_3', 'retries': 5}, now=0) is None
+    assert len(retries) == 2
+
+    assert retries.due(now=5) == []
+    assert [lot['id'] for lot in retries.due(now=10)] == ['lot_2']
+    assert [lot['id'] for lot in retries.due(now=30)] == ['lot_1']
+    assert len(retries) == 0
+
+
+def test_retry_reschedule_and_discard():
+    retries = RetryScheduler(base_delay=10)
+    lot = {'id': 'lot_1'}
+
+    retries.schedule(lot, now=0)
+    lot['retries'] = 1
+    retries.schedule(lot, now=5)
+    assert retries.due(now=15) == []
+    assert retries.due(now=25) == [lot]
+
+    retries.schedule(lot, now=30)
+    retries.discard('lot_1')
+    assert retries.due(now=100) == []
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from openregistry.concierge.scheduler import LotScheduler
+
+CLASSES = [
+    {'name': 'verification', 'statuses': ['verification'], 'max_retries': 0, 'weight': 2},
+    {'name': 'dissolution', 'statuses': ['pending.dissolution'], 'max_retries': 0},
+    {'name': 'retries', 'min_retries': 1}
+]
+
+
+def make_lot(lot_id, status='verification', retries=0):
+    return {'id': lot_id, 'status': status, 'retries': retries}
+
+
+def test_scheduler_fifo_without_classes():
+    scheduler = LotScheduler()
+    for lot_id in ('1', '2', '3'):
+        scheduler.push(make_lot(lot_id), now=0)
+
+    assert len(scheduler) == 3
+    assert [scheduler.pop(now=1)['id'] for _ in range(3)] == ['1', '2', '3']
+
+    with pytest.raises(IndexError):
+        scheduler.pop()
+
+
+def test_scheduler_fair_share():
+    scheduler = LotScheduler(classes=CLASSES, max_wait=300)
+    for i in range(4):
+        scheduler.push(make_lot('d{}'.format(i), 'pending.dissolution'), now=0)
+    for i in range(4):
+        scheduler.push(make_lot('v{}'.format(i)), now=0)
+    scheduler.push(make_lot('r0', retries=2), now=0)
+
+    order = [scheduler.pop(now=1)['id'] for _ in range(9)]
+
+    assert order[:4] == ['v0', 'd0', 'r0', 'v1']
+    assert order[4:] == ['v2', 'd1', 'v3', 'd2', 'd3']
+
+    stats = scheduler.stats(now=1)
+    assert stats['verification']['served'] == 4
+    assert stats['verification']['depth'] == 0
+    assert stats['retries']['avg_wait'] == 1
+    assert stats['default']['served'] == 0
+
+
+def test_scheduler_aging():
+    scheduler = LotScheduler(classes=CLASSES, max_wait=10)
+    scheduler.push(make_lot('r0', retries=1), now=0)
+    for i in range(3):
+        scheduler.push(make_lot('v{}'.format(i)), now=5)
+    scheduler.pop(now=6)
+
+    assert scheduler.pop(now=11)['id'] == 'r0'
+    assert scheduler.stats(now=11)['retries']['max_wait'] == 11
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import json
+import socket
+import threading
+
+import pytest
+
+from openregistry.concierge.sources import CouchDBSource, FileSource, SocketSource, make_source, parse_lot
+from openregistry.concierge.utils import ConfigError
+
+
+def lot_event(lot_id):
+    return json.dumps({'id': lot_id, 'rev': '1-a', 'status': 'verification', 'assets': ['asset_1']}) + '\n'
+
+
+def test_parse_lot():
+    assert parse_lot(lot_event('lot_1')) == {
+        'id': 'lot_1', 'rev': '1-a', 'status': 'verification', 'assets': ['asset_1'], 'lotID': None
+    }
+    assert parse_lot('{"id": "lot_1"}') is None
+    assert parse_lot('not json') is None
+
+
+def test_file_source(tmpdir):
+    lots_file = tmpdir.join('lots.jsonl')
+    lots_file.write(lot_event('lot_1') + 'not json\n' + lot_event('lot_2') + '{"id": "lot_3"')
+    source = FileSource(str(lots_file))
+    positions = []
+
+    lots = list(source.lots(0, progress=positions.append))
+
+    assert [lot['id'] for lot in lots] == ['lot_1', 'lot_2']
+    assert len(positions) == 3
+    assert source.head() > positions[-1]
+
+    lots_file.write(', "status": "verification", "assets": []}\n', mode='a')
+    assert [lot['id'] for lot in source.lots(positions[-1])] == ['lot_3']
+
+
+def test_socket_source(tmpdir):
+    source = SocketSource(str(tmpdir.join('lots.sock')), timeout=0.2)
+
+    def send():
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(source.path)
+        event = lot_event('lot_1') + lot_event('lot_2')
+        client.sendall(event[:20])
+        client.sendall(event[20:])
+        client.close()
+
+    sender = threading.Thread(target=send)
+    sender.start()
+    try:
+        lots = list(source.lots())
+    finally:
+        sender.join()
+        source.close()
+
+    assert [lot['id'] for lot in lots] == ['lot_1', 'lot_2']
+    assert source.head() == 2
+
+
+def test_make_source(tmpdir):
+    config = {'db': {'filter': 'lots/status'}}
+    source = make_source(config, 'db')
+    assert isinstance(source, CouchDBSource)
+    assert source.filter_doc == 'lots/status'
+
+    config['source'] = {'type': 'file', 'path': str(tmpdir.join('lots.jsonl'))}
+    assert isinstance(make_source(config, 'db'), FileSource)
+
+    config['source'] = {'type': 'kafka'}
+    with pytest.raises(ConfigError):
+        make_source(config, 'db')
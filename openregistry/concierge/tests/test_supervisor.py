@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+from collections import Counter
+from Queue import Queue
+
+import pytest
+
+from openregistry.concierge.supervisor import Supervisor, merge_stats, shard
+
+
+def test_shard_is_stable():
+    lot_ids = ['{:032x}'.format(i) for i in range(1000)]
+    shards = [shard(lot_id, 4) for lot_id in lot_ids]
+
+    assert shards == [shard(lot_id, 4) for lot_id in lot_ids]
+    assert set(shards) == {0, 1, 2, 3}
+    assert min(Counter(shards).values()) > 150
+
+
+def test_merge_stats():
+    total = {'restarts': 1}
+    merge_stats(total, {'outcomes': {'dissolved': 2}, 'in_flight': 1, 'api': {'GET host': {'calls': 3}}})
+    merge_stats(total, {'outcomes': {'dissolved': 1, 'skipped': 4}, 'in_flight': 2,
+                        'api': {'GET host': {'calls': 1}}})
+
+    assert total == {
+        'restarts': 1,
+        'outcomes': {'dissolved': 3, 'skipped': 4},
+        'in_flight': 3,
+        'api': {'GET host': {'calls': 4}}
+    }
+
+
+CONFIG = {'db': {'host': '127.0.0.1', 'port': 5984, 'name': 'lots_db'}, 'errors_doc': 'broken_lots',
+          'time_to_sleep': 1, 'rescan_interval': 60, 'shutdown_timeout': 1}
+
+
+@pytest.fixture
+def mock_db(mocker):
+    mock_prepare_couchdb = mocker.patch('openregistry.concierge.supervisor.prepare_couchdb', autospec=True)
+    mocker.patch('openregistry.concierge.supervisor.make_source', autospec=True)
+    mock_prepare_couchdb.return_value.get.return_value = None
+    return mock_prepare_couchdb.return_value
+
+
+def test_supervisor_feed_position(mock_db):
+    supervisor = Supervisor(CONFIG, 2, worker_factory=None)
+    assert supervisor.since() == 0
+
+    supervisor.feed_progress('5-a')
+    supervisor.feed_progress('6-b')
+    assert supervisor.since(now=supervisor.rescanned + 1) == '6-b'
+    assert supervisor.since(now=supervisor.rescanned + 60) == 0
+
+
+def test_supervisor_starts_from_checkpoint(mock_db):
+    mock_db.get.return_value = {'_id': 'concierge_checkpoint', 'seq': '9-i'}
+    supervisor = Supervisor(CONFIG, 2, worker_factory=None)
+
+    assert supervisor.since() == '9-i'
+    assert supervisor.since(now=supervisor.rescanned + 60) == 0
+
+
+@pytest.mark.parametrize('reports, checkpoint', [
+    ([(0, {'unfinished': '7-g'}), (1, {'unfinished': None})], '5-e'),
+    ([(0, {'unfinished': '3-c'}), (1, {'unfinished': None})], '3-c'),
+    ([(0, {'unfinished': '7-g'})], None),
+])
+def test_stop_children(mock_db, mocker, reports, checkpoint):
+    supervisor = Supervisor(CONFIG, 2, worker_factory=None)
+    mock_save_checkpoint = mocker.patch.object(supervisor, 'save_checkpoint', autospec=True)
+    supervisor.children = [mocker.Mock(**{'is_alive.return_value': False}) for _ in range(2)]
+    supervisor.reports = Queue()
+    for report in reports:
+        supervisor.reports.put(report)
+    supervisor.queues = [Queue(), Queue()]
+    supervisor.queues[1].put(('5-e', {'id': '1'}))
+    supervisor.queues[1].put(('8-h', {'id': '2'}))
+
+    supervisor.stop_children()
+
+    for child in supervisor.children:
+        assert child.terminate.called is False
+        child.join.assert_called_once()
+    assert all(queue.empty() for queue in supervisor.queues)
+    if checkpoint is None:
+        # A process that didn't report may have lost its lots
+        assert mock_save_checkpoint.called is False
+    else:
+        mock_save_checkpoint.assert_called_once_with(checkpoint)
+
+
+def test_supervisor_refuses_reload(mock_db, mocker):
+    supervisor = Supervisor(CONFIG, 2, worker_factory=None)
+    mock_logger = mocker.patch('openregistry.concierge.supervisor.logger', autospec=True)
+
+    supervisor.refuse_reload()
+
+    assert supervisor.stopping.is_set() is False
+    mock_logger.warning.assert_called_once()
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import pytest
+from munch import munchify
+
+from openregistry.concierge.throttling import AIMDLimiter, Hedger, Throttle, TokenBucket
+
+API_CONFIG = {
+    'url': 'http://192.168.50.9',
+    'rate_limits': {'GET': {'rate': 100, 'burst': 2}},
+    'concurrency': {'initial': 2, 'max_limit': 4, 'latency_threshold': 1.0, 'cooldown': 0}
+}
+
+
+class RequestFailed(Exception):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def test_token_bucket(mocker):
+    mock_sleep = mocker.patch('openregistry.concierge.throttling.time.sleep')
+    bucket = TokenBucket(rate=10, burst=2)
+
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    assert bucket.acquire() > 0
+    assert mock_sleep.call_count >= 1
+
+
+def test_aimd_limiter():
+    limiter = AIMDLimiter(initial=2, min_limit=1, max_limit=4, latency_threshold=1.0, cooldown=0)
+
+    limiter.acquire()
+    limiter.release(False, 0.1)
+    assert limiter.limit == 2.5
+
+    limiter.acquire()
+    limiter.release(True, 0.1)
+    assert limiter.limit == 1.25
+
+    limiter.acquire()
+    limiter.release(False, 2.0)
+    assert limiter.limit == 1
+
+    assert limiter.in_flight == 0
+
+
+def test_throttle_wraps_get_and_patch(mocker):
+    client = mocker.MagicMock()
+    client.get_asset.return_value = munchify({'data': {'id': 'e519404fd0b94305b3b19ec60add05e7'}})
+    client.patch_asset.side_effect = RequestFailed(502)
+    throttle = Throttle()
+
+    assert throttle.wrap(client, {'url': 'http://192.168.50.9'}) is client
+
+    throttled = throttle.wrap(client, API_CONFIG)
+    assert throttled.get_asset('e519404fd0b94305b3b19ec60add05e7').data.id == 'e519404fd0b94305b3b19ec60add05e7'
+    with pytest.raises(RequestFailed):
+        throttled.patch_asset('e519404fd0b94305b3b19ec60add05e7', {})
+
+    assert throttle.stats['GET 192.168.50.9']['calls'] == 1
+    assert throttle.stats['GET 192.168.50.9']['errors'] == 0
+    assert throttle.stats['PATCH 192.168.50.9']['errors'] == 1
+    assert throttle.limits() == {'192.168.50.9': 1.25}
+
+
+def slow_then_fast(release, fail_first=False):
+    calls = []
+
+    def send(sent):
+        sent.set()
+        calls.append(len(calls))
+        if len(calls) == 1:
+            release.wait(5)
+            if fail_first:
+                raise RequestFailed(502)
+            return 'slow'
+        return 'fast'
+    return send, calls
+
+
+def test_hedger():
+    hedger = Hedger(budget=0.5, min_delay=0.01, min_samples=2)
+    assert hedger.delay() is None
+    assert hedger.call(lambda sent: 'first') == 'first'
+    hedger.record(0.01)
+    assert hedger.delay() is None
+    hedger.record(0.01)
+    assert hedger.delay() == 0.01
+
+    release = threading.Event()
+    send, calls = slow_then_fast(release)
+    assert hedger.call(send) == 'fast'
+    release.set()
+    assert len(calls) == 2
+    assert hedger.stats() == {'calls': 2, 'hedged': 1, 'wins': 1, 'over_budget': 0, 'delay': 0.01}
+
+    # Over budget, the slow request is waited for
+    release = threading.Event()
+    send, calls = slow_then_fast(release)
+    threading.Timer(0.05, release.set).start()
+    assert hedger.call(send) == 'slow'
+    assert len(calls) == 1
+    assert hedger.over_budget == 1
+
+
+def test_hedger_errors():
+    hedger = Hedger(budget=1, min_delay=0.01, min_samples=1)
+    hedger.record(0.01)
+
+    release = threading.Event()
+    send, calls = slow_then_fast(release, fail_first=True)
+    assert hedger.call(send) == 'fast'
+    release.set()
+
+    def fail(sent):
+        raise RequestFailed(404)
+    with pytest.raises(RequestFailed):
+        hedger.call(fail)
+
+
+def test_throttle_hedges_only_gets(mocker):
+    client = mocker.MagicMock()
+    client.get_asset.return_value = munchify({'data': {'id': 'e519404fd0b94305b3b19ec60add05e7'}})
+    throttle = Throttle()
+    throttled = throttle.wrap(client, {'url': 'http://192.168.50.9', 'hedging': {'min_samples': 0}})
+
+    assert throttled.get_asset('e519404fd0b94305b3b19ec60add05e7').data.id == 'e519404fd0b94305b3b19ec60add05e7'
+    throttled.patch_asset('e519404fd0b94305b3b19ec60add05e7', {})
+    assert throttle.hedging()['192.168.50.9']['calls'] == 1
+    assert client.patch_asset.call_count == 1
+    assert throttle.stats['PATCH 192.168.50.9']['calls'] == 1
+
+
+def test_throttle_hedger_latency(mocker):
+    client = mocker.MagicMock()
+    hedges = []
+    throttle = Throttle()
+    throttled = throttle.wrap(client, {
+        'url': 'http://192.168.50.9',
+        'rate_limits': {'GET': {'rate': 20, 'burst': 1}},
+        'hedging': {'budget': 1, 'min_delay': 0.01, 'min_samples': 2}
+    }, on_hedge=lambda: hedges.append(threading.current_thread()))
+    hedger = throttle.hedgers['192.168.50.9']
+
+    # Waiting for the rate limit is not part of the latency
+    throttled.get_asset('asset_1')
+    throttled.get_asset('asset_1')
+    assert throttle.stats['GET 192.168.50.9']['throttled'] >= 0.04
+    assert hedger.latencies.count == 2
+    assert hedger.latencies.max < 0.04
+    assert hedges == []
+
+    release = threading.Event()
+    send, calls = slow_then_fast(release)
+    client.get_asset.side_effect = lambda asset_id: send(threading.Event())
+    assert throttled.get_asset('asset_1') == 'fast'
+    release.set()
+    assert hedges == [threading.current_thread()]
+
+
+def test_throttle_hedges_after_rate_limit(mocker):
+    client = mocker.MagicMock()
+    hedges = []
+    throttle = Throttle()
+    throttled = throttle.wrap(client, {
+        'url': 'http://192.168.50.9',
+        'rate_limits': {'GET': {'rate': 2, 'burst': 1}},
+        'hedging': {'budget': 1, 'min_delay': 0.01, 'min_samples': 1}
+    }, on_hedge=lambda: hedges.append(1))
+    throttle.hedgers['192.168.50.9'].record(0.01)
+
+    # Each GET waits about 0.5 seconds for a token, far over the hedge delay
+    for _ in range(4):
+        throttled.get_asset('asset_1')
+
+    assert throttle.stats['GET 192.168.50.9']['throttled'] >= 1
+    assert hedges == []
+    assert client.get_asset.call_count == 4
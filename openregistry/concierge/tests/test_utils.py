@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from socket import error
+
+from couchdb.http import ResourceConflict
+
+from openregistry.concierge.utils import BulkDocsWriter, log_broken_lot, resolve_broken_lot
+
+
+def test_bulk_docs_writer_buffers_changes(mocker):
+    db = mocker.MagicMock()
+    db.update.return_value = [(True, 'broken_lots', '2-b')]
+    logger = mocker.MagicMock()
+    writer = BulkDocsWriter(db, logger, max_size=2, max_delay=60)
+    doc = {'_id': 'broken_lots', '_rev': '1-a'}
+
+    log_broken_lot(writer, logger, doc, {'id': 'lot_1', 'rev': '1'}, 'patching lot to active.salable')
+    writer.flush_if_due()
+    assert db.update.call_count == 0
+    assert len(writer) == 1
+
+    resolve_broken_lot(writer, logger, doc, {'id': 'lot_1', 'rev': '2'})
+    writer.flush_if_due()
+    assert db.update.call_count == 1
+    assert db.update.call_args[0][0] == [doc]
+    assert doc['_rev'] == '2-b'
+    assert doc['lot_1']['resolved'] is True
+    assert len(writer) == 0
+
+    writer.flush()
+    assert db.update.call_count == 1
+
+
+def test_bulk_docs_writer_flush_one_doc(mocker):
+    db = mocker.MagicMock()
+    db.update.return_value = [(True, 'lots_progress', '2-b')]
+    writer = BulkDocsWriter(db, mocker.MagicMock(), max_size=10, max_delay=60)
+    progress = {'_id': 'lots_progress', '_rev': '1-a'}
+    errors = {'_id': 'broken_lots', '_rev': '1-a'}
+
+    writer.set_item(errors, 'lot_1', {'id': 'lot_1', 'resolved': False})
+    writer.set_item(progress, 'lot_2', {'step': 1})
+    writer.flush('lots_progress')
+    assert db.update.call_args[0][0] == [progress]
+    assert progress['_rev'] == '2-b'
+    assert list(writer.docs) == ['broken_lots']
+    assert len(writer) == 2
+
+    writer.flush('lots_progress')
+    assert db.update.call_count == 1
+
+
+def test_bulk_docs_writer_conflict(mocker):
+    db = mocker.MagicMock()
+    db.update.side_effect = [
+        [(False, 'broken_lots', ResourceConflict('conflict'))],
+        [(True, 'broken_lots', '3-c')]
+    ]
+    db.get.return_value = {
+        '_id': 'broken_lots', '_rev': '2-b',
+        'lot_2': {'id': 'lot_2', 'resolved': False}
+    }
+    writer = BulkDocsWriter(db, mocker.MagicMock(), max_size=1, max_delay=60)
+    doc = {'_id': 'broken_lots', '_rev': '1-a', 'lot_3': {'id': 'lot_3', 'resolved': True}}
+
+    writer.set_item(doc, 'lot_1', {'id': 'lot_1', 'resolved': False})
+    writer.flush()
+
+    assert doc['_rev'] == '2-b'
+    assert doc['lot_1'] == {'id': 'lot_1', 'resolved': False}
+    assert doc['lot_2'] == {'id': 'lot_2', 'resolved': False}
+    assert 'lot_3' not in doc
+    assert len(writer) == 1
+
+    writer.flush()
+    assert doc['_rev'] == '3-c'
+    assert len(writer) == 0
+
+
+def test_bulk_docs_writer_conflict_merge_fails(mocker):
+    db = mocker.MagicMock()
+    db.update.side_effect = [
+        [(False, 'broken_lots', ResourceConflict('conflict'))],
+        [(False, 'broken_lots', ResourceConflict('conflict'))],
+        [(True, 'broken_lots', '3-c')]
+    ]
+    db.get.side_effect = [error(111, 'Connection refused'), {'_id': 'broken_lots', '_rev': '2-b'}]
+    writer = BulkDocsWriter(db, mocker.MagicMock(), max_size=1, max_delay=60)
+    doc = {'_id': 'broken_lots', '_rev': '1-a'}
+
+    writer.set_item(doc, 'lot_1', {'id': 'lot_1', 'resolved': False})
+    writer.flush()
+    assert len(writer) == 1
+    assert doc['_rev'] == '1-a'
+    assert not writer.is_due()
+
+    writer.flush()
+    assert doc['_rev'] == '2-b'
+    writer.flush()
+    assert doc['_rev'] == '3-c'
+    assert doc['lot_1'] == {'id': 'lot_1', 'resolved': False}
+    assert len(writer) == 0
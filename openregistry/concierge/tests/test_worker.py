@@ -1,9 +1,19 @@
 # -*- coding: utf-8 -*-
 import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
 from copy import deepcopy
 from json import load
+from Queue import Queue
+from socket import error
 
 import pytest
+from couchdb.client import Row
+import yaml
 from munch import munchify
 
 from openregistry.concierge.worker import logger as LOGGER
@@ -18,7 +28,7 @@ ROOT = os.path.dirname(__file__) + '/data/'
 
 
 def test_get_lot(bot, logger, mocker):
-    mock_continuous_changes_feed = mocker.patch('openregistry.concierge.worker.continuous_changes_feed', autospec=True)
+    mock_continuous_changes_feed = mocker.patch('openregistry.concierge.sources.continuous_changes_feed', autospec=True)
     with open(ROOT + 'lots.json') as lots:
         lots = load(lots)
     mock_continuous_changes_feed.return_value = (lot['data'] for lot in lots)
@@ -89,6 +99,19 @@ def test_run(bot, logger, mocker, almost_always_true):
     assert mock_process_lots.call_args_list[3][0][0] == error_lots[1]['data']
 
 
+@pytest.mark.parametrize('blocking, sleeps', [(False, 2), (True, 0)])
+def test_run_sleeps_between_passes(bot, mocker, almost_always_true, blocking, sleeps):
+    bot._source = mocker.Mock(blocking=blocking)
+    mocker.patch.object(bot, 'get_lot', autospec=True, return_value=iter([]))
+    mocker.patch.object(bot, 'stopping', wraps=bot.stopping)
+    mocker.patch('openregistry.concierge.worker.True', almost_always_true(2))
+
+    bot.run()
+
+    # A blocking source already waited for new lots in the pass
+    assert bot.stopping.wait.call_count == sleeps
+
+
 def test_patch_lot(bot, logger, mocker):
     with open(ROOT + 'lots.json') as lots:
         lots = load(lots)
@@ -202,12 +225,14 @@ def test_patch_assets_pending_fail(bot, logger, mocker):
         munchify(assets[7])
     ]
 
+    # 8034c43e2d764006ad6e655e339e5fec is already 'pending', so no request is sent for it
     result, patched_assets = bot.patch_assets(lot=lot, status=status)
     assert result is False
-    assert patched_assets == []
+    assert patched_assets == ['8034c43e2d764006ad6e655e339e5fec']
+    assert bot.skipped_patches == 1
 
     log_strings = logger.log_capture_string.getvalue().split('\n')
-    assert log_strings[2] == 'Failed to patch asset 8034c43e2d764006ad6e655e339e5fec to pending (Operation is forbidden.)'
+    assert log_strings[2] == 'Failed to patch asset 5545b519045a4637ab880f032960e034 to pending (Operation is forbidden.)'
 
     assert bot.assets_client.patch_asset.call_count == 3
 
@@ -442,7 +467,7 @@ def test_process_lots_broken(bot, logger, mocker):
 
     assert mock_log_broken_lot.call_count == 1
     assert mock_log_broken_lot.call_args_list[0][0] == (
-        bot.db, LOGGER, bot.errors_doc, lot, 'patching assets to verification'
+        bot.errors_writer, LOGGER, bot.errors_doc, lot, 'patching assets to verification'
     )
 
     log_strings = logger.log_capture_string.getvalue().split('\n')
@@ -459,7 +484,7 @@ def test_process_lots_broken(bot, logger, mocker):
 
     assert mock_log_broken_lot.call_count == 2
     assert mock_log_broken_lot.call_args_list[1][0] == (
-        bot.db, LOGGER, bot.errors_doc, lot, 'patching assets to active'
+        bot.errors_writer, LOGGER, bot.errors_doc, lot, 'patching assets to active'
     )
 
     log_strings = logger.log_capture_string.getvalue().split('\n')
@@ -477,7 +502,7 @@ def test_process_lots_broken(bot, logger, mocker):
 
     assert mock_log_broken_lot.call_count == 3
     assert mock_log_broken_lot.call_args_list[2][0] == (
-        bot.db, LOGGER, bot.errors_doc, lot, 'patching lot to active.salable'
+        bot.errors_writer, LOGGER, bot.errors_doc, lot, 'patching lot to active.salable'
     )
 
     log_strings = logger.log_capture_string.getvalue().split('\n')
@@ -562,3 +587,755 @@ def test_check_lot(bot, logger, mocker):
     assert log_strings[2] == "Successfully got lot 9ee8f769438e403ebfb17b2240aedcf1"
     assert log_strings[3] == "Successfully got lot 9ee8f769438e403ebfb17b2240aedcf1"
     assert log_strings[4] == "Lot 9ee8f769438e403ebfb17b2240aedcf1 can not be processed in current status ('pending')"
+
+
+def test_retry_broken_lot(bot, logger, mocker):
+    mock_log_broken_lot = mocker.patch('openregistry.concierge.worker.log_broken_lot', autospec=True)
+    mock_resolve_broken_lot = mocker.patch('openregistry.concierge.worker.resolve_broken_lot', autospec=True)
+
+    with open(ROOT + 'lots.json') as lots:
+        lots = load(lots)
+
+    lot = deepcopy(lots[0]['data'])
+    lot['rev'] = '123'
+    bot.retries.base_delay = 0
+
+    bot.mark_broken(lot, 'patching lot to active.salable')
+
+    assert mock_log_broken_lot.call_args[0] == (
+        bot.errors_writer, LOGGER, bot.errors_doc, lot, 'patching lot to active.salable'
+    )
+    assert lot['id'] in bot.retries.entries
+
+    bot.schedule_retries()
+
+    assert lot['id'] not in bot.retries.entries
+    # Resolved once the retry reaches an outcome
+    assert mock_resolve_broken_lot.call_count == 0
+    assert bot.scheduler.pop() == lot
+    assert lot['retries'] == 1
+
+    log_strings = logger.log_capture_string.getvalue().split('\n')
+    assert log_strings[0] == 'Retrying broken lot 9ee8f769438e403ebfb17b2240aedcf1 (attempt 1)'
+
+    lot['retries'] = bot.retries.max_attempts
+    bot.mark_broken(lot, 'patching lot to active.salable')
+
+    assert lot['id'] not in bot.retries.entries
+    log_strings = logger.log_capture_string.getvalue().split('\n')
+    assert log_strings[1] == 'Lot 9ee8f769438e403ebfb17b2240aedcf1 will not be retried until it is changed (10 attempts)'
+
+
+def test_retry_until_final_outcome(bot, mocker):
+    lot = {'id': 'retried_lot', 'rev': '1-a', 'status': 'verification', 'assets': [], 'lotID': 'LOT-1'}
+    bot.retries.base_delay = 0
+    bot.mark_broken(dict(lot), 'patching lot to active.salable')
+
+    bot.schedule_retries()
+    retried = bot.scheduler.pop()
+    bot.lots_client.get_lot.side_effect = RequestFailed(response=munchify({"text": "Bad Gateway", "status_code": 502}))
+    assert bot.handle_lot(retried) == 'skipped'
+    assert bot.errors_doc['retried_lot']['resolved'] is False
+    assert 'retried_lot' in bot.retries.entries
+    assert bot.schedule_lot(dict(lot)) is None
+
+    bot.schedule_retries()
+    retried = bot.scheduler.pop()
+    assert retried['retries'] == 2
+    bot.lots_client.get_lot.side_effect = None
+    bot.lots_client.get_lot.return_value = munchify({'data': {'status': 'verification'}})
+    assert bot.handle_lot(retried) == 'active.salable'
+    assert bot.errors_doc['retried_lot']['resolved'] is True
+    assert 'retried_lot' not in bot.retries.entries
+
+    # Resolved entries don't hide the lot from the feed
+    assert bot.schedule_lot(dict(lot)) is not None
+
+
+def test_retry_failed_request(bot, mocker):
+    lot = {'id': 'deferred_lot', 'rev': '1-a', 'status': 'verification', 'assets': [], 'lotID': 'LOT-3'}
+    bot.retries.base_delay = 0
+    bot.pending['deferred_lot'] = '10'
+    mocker.patch.object(bot, 'process_lots', autospec=True, return_value='deferred')
+
+    # The lot leaves the checkpoint but is retried soon, not on the next rescan
+    assert bot.handle_lot(dict(lot)) == 'deferred'
+    assert 'deferred_lot' not in bot.pending
+    assert bot.errors_doc['deferred_lot']['resolved'] is False
+    assert bot.errors_doc['deferred_lot']['message'] == 'Lot deferred after a failed request'
+    bot.schedule_retries()
+    assert bot.scheduler.pop()['id'] == 'deferred_lot'
+
+    bot.process_lots.return_value = 'active.salable'
+    assert bot.handle_lot(dict(lot)) == 'active.salable'
+    assert bot.errors_doc['deferred_lot']['resolved'] is True
+
+    # Lots that are not actionable are not retried
+    bot.process_lots.return_value = 'skipped'
+    bot.mark_not_actionable(lot, "status 'draft'")
+    assert bot.handle_lot(dict(lot)) == 'skipped'
+    assert bot.errors_doc['deferred_lot']['resolved'] is True
+    assert 'deferred_lot' not in bot.retries.entries
+
+
+def test_broken_lot_changed(bot, mocker):
+    lot = {'id': 'changed_lot', 'rev': '1-a', 'status': 'verification', 'assets': [], 'lotID': 'LOT-2'}
+    bot.mark_broken(dict(lot, retries=3), 'patching lot to active.salable')
+
+    changed = bot.schedule_lot(dict(lot, rev='2-b', status='pending.dissolution'))
+    assert changed['rev'] == '2-b'
+    assert changed['status'] == 'pending.dissolution'
+    assert changed['retries'] == 0
+    assert 'changed_lot' not in bot.retries.entries
+
+    bot.lots_client.get_lot.return_value = munchify({'data': {'status': 'draft'}})
+    assert bot.handle_lot(bot.scheduler.pop()) == 'skipped'
+    assert bot.errors_doc['changed_lot']['resolved'] is True
+    assert bot.errors_doc['changed_lot']['rev'] == '2-b'
+
+
+def test_retries_of_shard(bot):
+    from openregistry.concierge.tests.conftest import TEST_CONFIG
+    from openregistry.concierge.worker import BotWorker
+    lot_ids = set('{:032x}'.format(i) for i in range(10))
+    for lot_id in lot_ids:
+        bot.errors_doc[lot_id] = {'id': lot_id, 'rev': '1-a', 'status': 'verification', 'assets': [],
+                                  'resolved': False}
+    bot.db.save(bot.errors_doc)
+
+    try:
+        shards = [set(BotWorker(TEST_CONFIG, sync=False, shard=(index, 2)).retries.entries) & lot_ids
+                  for index in range(2)]
+    finally:
+        for lot_id in lot_ids:
+            del bot.errors_doc[lot_id]
+        bot.db.save(bot.errors_doc)
+    assert shards[0] and shards[1]
+    assert shards[0] | shards[1] == lot_ids
+    assert not shards[0] & shards[1]
+
+
+def test_check_assets_from_replica(bot, logger, mocker):
+    with open(ROOT + 'assets.json') as assets:
+        assets = load(assets)
+
+    with open(ROOT + 'lots.json') as lots:
+        lots = load(lots)
+
+    lot = deepcopy(lots[0]['data'])
+    lot['assets'] = ['e519404fd0b94305b3b19ec60add05e7', '64099f8259c64215b3bd290bc12ec73a']
+
+    replica_asset = dict(assets[0]['data'], _id=assets[0]['data']['id'])
+    bot.assets_db = mocker.MagicMock()
+    bot.assets_db.view.return_value = [
+        Row(key=replica_asset['_id'], id=replica_asset['_id'], doc=replica_asset),
+        Row(key='64099f8259c64215b3bd290bc12ec73a', error='not_found')
+    ]
+    mock_get_asset = mocker.MagicMock()
+    mock_get_asset.return_value = munchify(dict(assets[1], data=dict(assets[1]['data'], relatedLot=lot['id'])))
+    bot.assets_client.get_asset = mock_get_asset
+
+    result = bot.check_assets(lot)
+    assert result is True
+
+    assert bot.assets_db.view.call_args == mocker.call('_all_docs', keys=lot['assets'], include_docs=True)
+    assert mock_get_asset.call_count == 1
+    assert mock_get_asset.call_args[0] == ('64099f8259c64215b3bd290bc12ec73a',)
+
+    log_strings = logger.log_capture_string.getvalue().split('\n')
+    assert log_strings[0] == "Successfully got asset 64099f8259c64215b3bd290bc12ec73a"
+
+    bot.assets_db.view.side_effect = error(111, 'Connection refused')
+    mock_get_asset.return_value = munchify(assets[0])
+    lot['assets'] = ['e519404fd0b94305b3b19ec60add05e7']
+
+    result = bot.check_assets(lot)
+    assert result is True
+    assert mock_get_asset.call_count == 2
+
+    log_strings = logger.log_capture_string.getvalue().split('\n')
+    assert log_strings[1] == "Failed to get assets from the replica: Connection refused"
+
+
+def test_check_lot_from_replica(bot, logger, mocker):
+    with open(ROOT + 'lots.json') as lots:
+        lots = load(lots)
+
+    lot = deepcopy(lots[0]['data'])
+    lot['rev'] = '2-b'
+
+    mock_db = mocker.patch.object(bot, 'db')
+    mock_db.get.side_effect = [
+        dict(lot, _rev='2-b'),
+        dict(lot, _rev='3-c'),
+        dict(lot, _rev='2-b', status='active.salable')
+    ]
+    bot.read_lots_from_db = True
+
+    mock_get_lot = mocker.MagicMock()
+    mock_get_lot.return_value = munchify({'data': lot})
+    bot.lots_client.get_lot = mock_get_lot
+
+    result = bot.check_lot(lot)
+    assert result is True
+    assert mock_get_lot.call_count == 0
+
+    result = bot.check_lot(lot)
+    assert result is True
+    assert mock_get_lot.call_count == 1
+
+    result = bot.check_lot(lot)
+    assert result is False
+    assert mock_get_lot.call_count == 1
+
+    log_strings = logger.log_capture_string.getvalue().split('\n')
+    assert log_strings[0] == "Successfully got lot 9ee8f769438e403ebfb17b2240aedcf1"
+    assert log_strings[1] == "Lot 9ee8f769438e403ebfb17b2240aedcf1 can not be processed in current status ('active.salable')"
+
+
+def test_process_lots_resume(bot, logger, mocker):
+    mock_check_lot = mocker.patch.object(bot, 'check_lot', autospec=True)
+    mock_check_lot.return_value = True
+
+    mock_check_assets = mocker.patch.object(bot, 'check_assets', autospec=True)
+    mock_check_assets.return_value = True
+
+    mock_patch_assets = mocker.patch.object(bot, 'patch_assets', autospec=True)
+    mock_patch_assets.return_value = (True, [])
+
+    mock_patch_lot = mocker.patch.object(bot, 'patch_lot', autospec=True)
+    mock_patch_lot.side_effect = [Exception('Worker killed'), True, True]
+
+    with open(ROOT + 'lots.json') as lots:
+        lots = load(lots)
+
+    lot = deepcopy(lots[0]['data'])
+    lot['rev'] = '1-a'
+
+    # interrupted before patching lot to active.salable
+    with pytest.raises(Exception):
+        bot.process_lots(lot)
+
+    assert mock_patch_assets.call_count == 2
+    assert bot.progress.doc[lot['id']]['step'] == 2
+    assert bot.progress.doc[lot['id']]['rev'] == '1-a'
+
+    bot.asset_states.items.clear()
+    result = bot.process_lots(lot)
+    assert result == 'active.salable'
+
+    assert mock_check_assets.call_count == 1
+    # The states of the assets are fetched again for the resumed step
+    assert len(bot.asset_states) == len(lot['assets'])
+    assert mock_patch_assets.call_count == 2
+    assert mock_patch_lot.call_count == 2
+    assert mock_patch_lot.call_args[0] == (lot, 'active.salable')
+    assert lot['id'] not in bot.progress.doc
+
+    log_strings = logger.log_capture_string.getvalue().split('\n')
+    assert log_strings[1] == 'Processing lot 9ee8f769438e403ebfb17b2240aedcf1'
+    assert log_strings[2] == "Resuming lot 9ee8f769438e403ebfb17b2240aedcf1 at step 'lot to active.salable'"
+
+    # lot was changed since the progress was saved
+    bot.progress.doc[lot['id']] = {'rev': '0-z', 'status': 'verification', 'step': 1, 'updated': 0}
+
+    result = bot.process_lots(lot)
+    assert result == 'active.salable'
+
+    assert mock_check_assets.call_count == 2
+    assert mock_patch_assets.call_count == 4
+
+    log_strings = logger.log_capture_string.getvalue().split('\n')
+    assert log_strings[4] == "Lot 9ee8f769438e403ebfb17b2240aedcf1 was changed since step 1, starting over"
+
+
+def test_progress_writes(bot, mocker):
+    lot = {'id': 'progress_lot', 'rev': '1-a', 'status': 'verification', 'assets': []}
+    flush = mocker.spy(bot.errors_writer, 'flush')
+    bot.errors_writer.set_item(bot.errors_doc, 'other_lot', {'id': 'other_lot', 'resolved': True})
+
+    # Every step is written at once, without the other buffered documents
+    bot.progress.save(lot, 1)
+    assert bot.db.get(bot.progress.doc['_id'])['progress_lot']['step'] == 1
+    bot.progress.save(lot, 2)
+    assert bot.db.get(bot.progress.doc['_id'])['progress_lot']['step'] == 2
+    bot.progress.finish(lot)
+    assert 'progress_lot' not in bot.db.get(bot.progress.doc['_id'])
+    assert flush.call_args_list == [mocker.call(bot.progress.doc['_id'])] * 3
+    assert bot.errors_doc['_id'] in bot.errors_writer.docs
+
+
+def test_asset_cache_expires_by_default(bot):
+    assert 'asset_cache' not in bot.config
+    assert bot.asset_states.ttl == 300
+
+
+def test_resume_refreshes_asset_states(bot, mocker):
+    lot = {'id': 'resumed_lot', 'rev': '1-a', 'status': 'verification', 'assets': ['asset_1', 'asset_2']}
+    bot.assets_client.get_asset.side_effect = [
+        munchify({'data': {'status': 'verification', 'relatedLot': 'resumed_lot'}}),
+        munchify({'data': {'status': 'pending'}})
+    ]
+    bot.assets_client.patch_asset = mocker.MagicMock()
+
+    bot.refresh_asset_states(lot)
+    assert bot.patch_assets(lot, 'verification', 'resumed_lot') == (True, ['asset_1', 'asset_2'])
+    assert [call[0][0] for call in bot.assets_client.patch_asset.call_args_list] == ['asset_2']
+
+
+def test_patch_assets_skips_known_state(bot, logger, mocker):
+    mock_patch_asset = mocker.MagicMock()
+    bot.assets_client.patch_asset = mock_patch_asset
+
+    with open(ROOT + 'lots.json') as lots:
+        lots = load(lots)
+
+    lot = lots[0]['data']
+    bot.asset_states.set('e519404fd0b94305b3b19ec60add05e7', ('verification', lot['id']))
+    bot.asset_states.set('64099f8259c64215b3bd290bc12ec73a', ('pending', None))
+
+    result, patched_assets = bot.patch_assets(lot, 'verification', lot['id'])
+    assert result is True
+    assert patched_assets == lot['assets']
+    assert mock_patch_asset.call_count == 3
+    assert [call[0][0] for call in mock_patch_asset.call_args_list] == lot['assets'][1:]
+    assert bot.skipped_patches == 1
+
+    result, patched_assets = bot.patch_assets(lot, 'verification', lot['id'])
+    assert result is True
+    assert patched_assets == lot['assets']
+    assert mock_patch_asset.call_count == 3
+    assert bot.skipped_patches == 5
+
+    mock_patch_asset.side_effect = RequestFailed(response=munchify({"text": "Request failed.", "status_code": 502}))
+    result, patched_assets = bot.patch_assets({'assets': lot['assets'][:1]}, 'pending')
+    assert result is False
+    assert bot.asset_states.get('e519404fd0b94305b3b19ec60add05e7') is None
+
+    log_strings = logger.log_capture_string.getvalue().split('\n')
+    assert log_strings[0] == 'Successfully patched asset 64099f8259c64215b3bd290bc12ec73a to verification'
+    assert log_strings[3] == 'Failed to patch asset e519404fd0b94305b3b19ec60add05e7 to pending (Server error: 502)'
+
+
+def test_consume(bot, logger, mocker):
+    mock_process_lots = mocker.patch.object(bot, 'process_lots', autospec=True)
+    mock_process_lots.side_effect = ['dissolved', 'skipped', 'dissolved']
+
+    lots = Queue()
+    for lot_id in ('1', '2', '3'):
+        lots.put(('{}-a'.format(lot_id), {'id': lot_id, 'rev': '1-a', 'status': 'pending.dissolution'}))
+    lots.put(None)
+    reports = Queue()
+
+    bot.consume(lots, reports, index=2)
+
+    assert [call[0][0]['id'] for call in mock_process_lots.call_args_list] == ['1', '2', '3']
+    index, stats = reports.get_nowait()
+    assert index == 2
+    assert stats['outcomes'] == {'dissolved': 2, 'skipped': 1}
+    assert stats['queued'] == 0
+    assert stats['unfinished'] is None
+
+
+def test_consume_stopping(bot, mocker):
+    def process_lots(lot):
+        if lot['id'] == '1':
+            bot.request_stop()
+            return 'interrupted'
+        return 'dissolved'
+
+    mocker.patch.object(bot, 'process_lots', side_effect=process_lots)
+    lots = Queue()
+    lots.put(('4-d', {'id': '1', 'rev': '1-a', 'status': 'pending.dissolution'}))
+    lots.put(('5-e', {'id': '2', 'rev': '1-a', 'status': 'pending.dissolution'}))
+    reports = Queue()
+
+    bot.consume(lots, reports)
+
+    # No None was sent, the worker stopped on its own and reported where to resume
+    index, stats = reports.get_nowait()
+    assert stats['unfinished'] == '4-d'
+    assert reports.empty()
+
+
+def test_clients_created_on_first_use(bot, mocker):
+    from openprocurement_client.resources.assets import AssetsClient
+    from openprocurement_client.resources.lots import LotsClient
+
+    assert not LotsClient.called
+    assert not AssetsClient.called
+    # Neither is the lot source, which worker processes don't use
+    assert bot._source is None
+
+    assert bot.lots_client is bot.lots_client
+    assert LotsClient.call_count == 1
+    assert not AssetsClient.called
+
+
+def test_hedged_gets_counted(bot, mocker):
+    mock_wrap = mocker.patch.object(bot.throttle, 'wrap', autospec=True)
+    assert bot.assets_client is mock_wrap.return_value
+
+    bot.lot_context.api_calls = 0
+    mock_wrap.call_args[1]['on_hedge']()
+    assert bot.lot_context.api_calls == 1
+    assert bot.stats()['api_calls'] == {'GET assets': 1}
+
+
+def test_client_imported_on_first_use():
+    script = "import sys; import openregistry.concierge.worker; print('openprocurement_client' in sys.modules)"
+    assert subprocess.check_output([sys.executable, '-c', script]).strip() == 'False'
+
+
+def test_check_lag(bot, logger, mocker, tmpdir):
+    status_file = str(tmpdir.join('status.json'))
+    bot.config = dict(bot.config, feed_lag={
+        'interval': 10,
+        'status_file': status_file,
+        'thresholds': [{'distance': 100, 'workers': 4}, {'behind': 60, 'workers': 8}]
+    })
+    mock_head = mocker.patch.object(bot.source, 'head', autospec=True)
+    mock_head.side_effect = [150, '160-abc', 170]
+
+    bot.lag.update_seq(10)
+    bot.check_lag(now=1000)
+    assert bot.pool.size == 4
+    with open(status_file) as status:
+        assert load(status) == {'seq': 10, 'head': 150, 'distance': 140, 'behind': 0.0, 'workers': 4}
+
+    bot.check_lag(now=1005)
+    assert mock_head.call_count == 1
+
+    bot.check_lag(now=1070)
+    assert bot.pool.size == 8
+
+    bot.lag.update_seq(170)
+    bot.check_lag(now=1080)
+    assert bot.pool.size == 1
+
+    log_strings = logger.log_capture_string.getvalue().split('\n')
+    assert log_strings[0] == 'Feed is 140 changes (0 seconds) behind, using 4 workers instead of 1'
+    assert log_strings[1] == 'Feed is 150 changes (70 seconds) behind, using 8 workers instead of 4'
+    assert log_strings[2] == 'Feed is 0 changes (0 seconds) behind, using 1 workers instead of 8'
+
+
+def test_status_endpoints(bot, mocker):
+    bot.heartbeat = 1000
+    assert bot.health(now=1010) == (200, {'healthy': True, 'heartbeat_age': 10})
+    assert bot.health(now=2000) == (503, {'healthy': False, 'heartbeat_age': 1000})
+
+    # Lots finished by the pool keep a worker that isn't reading the feed healthy
+    mocker.patch.object(bot, 'process_lots', return_value='skipped')
+    bot.handle_lot({'id': 'lot_1', 'rev': '1-a', 'status': 'verification', 'assets': []})
+    assert bot.health(now=bot.heartbeat + 10)[0] == 200
+    assert bot.heartbeat > 1000
+
+    mock_db = mocker.patch.object(bot, 'db')
+    mock_head = mocker.patch('openregistry.concierge.worker.requests.head', autospec=True)
+    mock_head.return_value.status_code = 200
+    assert bot.ready() == (200, {'couchdb': True, 'lots_api': True, 'assets_api': True, 'ready': True})
+
+    mock_db.info.side_effect = error(111, 'Connection refused')
+    mock_head.return_value.status_code = 502
+    assert bot.ready() == (503, {'couchdb': False, 'lots_api': False, 'assets_api': False, 'ready': False})
+
+
+def test_status_server_port_in_use(bot, logger):
+    from openregistry.concierge.status import StatusServer
+    server = StatusServer(port=0)
+    try:
+        bot.config = dict(bot.config, status={'host': '127.0.0.1', 'port': server.server_address[1]})
+        bot.start_status_server()
+    finally:
+        server.server_close()
+    assert bot.status_server is None
+    log_strings = logger.log_capture_string.getvalue().split('\n')
+    assert log_strings[0] == 'Failed to start the status server: Address already in use'
+
+
+def test_live_stats(bot, mocker):
+    lot = {'id': 'lot_1', 'rev': '1-a', 'status': 'pending.dissolution', 'assets': []}
+    seen = {}
+
+    def check_lot(lot):
+        seen.update(bot.live_stats()['in_flight_lots'])
+        return True
+
+    mocker.patch.object(bot, 'check_lot', side_effect=check_lot)
+    mocker.patch.object(bot, 'check_assets', return_value=False)
+
+    assert bot.handle_lot(lot) == 'rejected'
+    assert seen['lot_1']['phase'] == 'check_lot'
+    assert seen['lot_1']['status'] == 'pending.dissolution'
+
+    stats = bot.live_stats()
+    assert stats['in_flight_lots'] == {}
+    assert stats['timings']['check_lot']['count'] == 1
+    assert stats['timings']['check_assets']['count'] == 1
+
+    mocker.patch.object(bot, 'check_lot', side_effect=ValueError('boom'))
+    with pytest.raises(ValueError):
+        bot.handle_lot(lot)
+    assert bot.live_stats()['last_error']['lot_id'] == 'lot_1'
+    assert bot.live_stats()['last_error']['message'] == "ValueError('boom',)"
+
+
+def test_lot_error_moves_checkpoint(bot, mocker):
+    lot = {'id': 'error_lot', 'rev': '1-a', 'status': 'verification', 'assets': []}
+    bot.pending['error_lot'] = '10'
+    bot.pending['next_lot'] = '11'
+    mocker.patch.object(bot, 'process_lots', side_effect=ValueError('boom'))
+    retries = len(bot.retries)
+
+    with pytest.raises(ValueError):
+        bot.handle_lot(lot)
+    assert list(bot.pending) == ['next_lot']
+    assert bot.outcomes['broken'] == 1
+    assert bot.errors_doc['error_lot']['message'] == "ValueError('boom',)"
+    assert bot.errors_doc['error_lot']['resolved'] is False
+    assert len(bot.retries) == retries + 1
+
+
+def test_scheduler_stats(bot):
+    from openregistry.concierge.scheduler import LotScheduler
+    bot.scheduler = LotScheduler(classes=[{'name': 'verification', 'statuses': ['verification']}])
+    bot.schedule_lot({'id': 'lot_1', 'rev': '1-a', 'status': 'verification', 'assets': []})
+
+    stats = bot.live_stats()['scheduler']
+    assert stats['verification']['depth'] == 1
+    assert stats['default']['depth'] == 0
+    assert 'avg_wait' in stats['verification']
+
+
+def test_lot_latency_slo(bot, logger, mocker):
+    lot = {'id': 'lot_1', 'rev': '1-a', 'status': 'pending.dissolution', 'assets': []}
+    bot.slo.objectives = {'rejected': 60}
+    mocker.patch.object(bot, 'check_lot', return_value=True)
+    mocker.patch.object(bot, 'check_assets', return_value=False)
+    mock_time = mocker.patch('openregistry.concierge.metrics.time.time', return_value=1000)
+
+    bot.schedule_lot(lot)
+    bot.scheduler.pop()
+    mock_time.return_value = 1100
+    assert bot.handle_lot(lot) == 'rejected'
+
+    stats = bot.live_stats()['slo']
+    assert stats['rejected']['count'] == 1
+    assert stats['rejected']['violations'] == 1
+    log_strings = logger.log_capture_string.getvalue().split('\n')
+    assert 'Lot lot_1 took 100.0 seconds to be rejected, the objective is 60 seconds' in log_strings
+
+    # Retried lots keep the time they were first seen at
+    bot.schedule_lot(lot)
+    bot.scheduler.pop()
+    mocker.patch.object(bot, 'process_lots', return_value='deferred')
+    assert bot.handle_lot(lot) == 'deferred'
+    assert bot.slo.started.get(('lot_1', 'pending.dissolution')) == 1100
+
+
+def test_lot_records(bot, mocker, tmpdir):
+    from openregistry.concierge.records import LotRecordWriter, read_records
+    lot = {'id': 'lot_1', 'rev': '1-a', 'status': 'pending.dissolution', 'assets': [], 'retries': 2}
+    bot.records = LotRecordWriter(str(tmpdir))
+    bot.lots_client.get_lot.return_value = munchify({'data': {'status': 'pending.dissolution'}})
+
+    assert bot.handle_lot(lot) == 'dissolved'
+    bot.records.close()
+
+    records = read_records(str(tmpdir.listdir()[0]))
+    assert records['id'] == ['lot_1']
+    assert records['outcomes'][records['outcome'][0]] == 'dissolved'
+    assert list(records['retries']) == [2]
+    assert list(records['api_calls']) == [2]
+    assert records['check_lot'][0] >= 0
+    assert records['lot to dissolved'][0] >= 0
+
+
+def test_negative_cache(bot, mocker):
+    lot = {'id': 'lot_1', 'rev': '1-a', 'status': 'verification', 'assets': []}
+    bot.lots_client.get_lot.return_value = munchify({'data': {'status': 'draft'}})
+
+    assert bot.schedule_lot(lot) == lot
+    assert bot.process_lots(bot.scheduler.pop()) == 'skipped'
+    assert bot.not_actionable.get('lot_1') == ('1-a', "status 'draft'")
+
+    assert bot.schedule_lot(lot) is None
+    assert len(bot.scheduler) == 0
+    assert bot.lots_client.get_lot.call_count == 1
+    assert bot.stats()['negative_cache_hits'] == 1
+
+    # A new rev invalidates the entry
+    lot = dict(lot, rev='2-b')
+    assert bot.schedule_lot(lot) == lot
+    assert bot.not_actionable.get('lot_1') is None
+    bot.scheduler.pop()
+
+    bot.lots_client.get_lot.side_effect = RequestFailed(response=munchify({"text": "Bad Gateway", "status_code": 502}))
+    assert bot.check_lot(lot) is False
+    assert bot.not_actionable.get('lot_1') is None
+
+    bot.lots_client.get_lot.side_effect = ResourceNotFound(response=munchify({"text": "Not Found"}))
+    assert bot.check_lot(lot) is False
+    assert bot.not_actionable.get('lot_1') == ('2-b', 'not found')
+    assert bot.schedule_lot(lot) is None
+
+    # Lots without a rev can't be told apart from their later changes
+    assert bot.check_lot(dict(lot, id='lot_2', rev=None)) is False
+    assert bot.not_actionable.get('lot_2') is None
+
+
+def test_signals_dont_interrupt_requests(bot):
+    signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
+    handlers = [signal.getsignal(signum) for signum in signals]
+    left, right = socket.socketpair()
+
+    def reload_during_request():
+        time.sleep(0.1)
+        os.kill(os.getpid(), signal.SIGHUP)
+        time.sleep(0.1)
+        right.sendall('data')
+
+    bot.install_signal_handlers()
+    try:
+        threading.Thread(target=reload_during_request).start()
+        assert left.recv(4) == 'data'
+        assert bot.reload_requested is True
+    finally:
+        for signum, handler in zip(signals, handlers):
+            signal.signal(signum, handler)
+        left.close()
+        right.close()
+
+
+def test_reload_config(bot, logger, mocker, tmpdir):
+    from openregistry.concierge.tests.test_config import load_config
+    mocker.patch('openregistry.concierge.worker.configure_logging', autospec=True, return_value=[])
+    config = load_config()
+    config['db'] = bot.config['db']
+    config['errors_doc'] = bot.config['errors_doc']
+    for key in ('progress_doc', 'checkpoint_doc', 'source'):
+        del config[key]
+    config['reload'] = {'watch': True, 'interval': 5}
+    config_file = tmpdir.join('concierge.yaml')
+    config_file.write(yaml.safe_dump(config))
+
+    bot.config_path = str(config_file)
+    bot.config_mtime = os.path.getmtime(bot.config_path)
+    bot.config = dict(bot.config, reload=config['reload'])
+    lots_client = bot.lots_client
+    bot.asset_states.set('asset_1', ('pending', None))
+
+    config['workers'] = 4
+    config['time_to_sleep'] = 7
+    config['retry']['max_attempts'] = 3
+    config['db'] = dict(config['db'], name='other_db')
+    config_file.write(yaml.safe_dump(config))
+    os.utime(bot.config_path, (bot.config_mtime + 10, bot.config_mtime + 10))
+
+    bot.check_reload(now=bot.config_checked + 1)
+    assert bot.sleep == 2
+
+    bot.check_reload(now=bot.config_checked + 5)
+    assert bot.sleep == 7
+    assert bot.pool.size == 4
+    assert bot.retries.max_attempts == 3
+    assert bot.config['db']['name'] == 'lots_db'
+    assert bot.lots_client is not lots_client
+    assert bot.asset_states.get('asset_1') == ('pending', None)
+
+    config_file.write('workers: [')
+    bot.request_reload()
+    bot.check_reload()
+    assert bot.pool.size == 4
+
+    log_strings = logger.log_capture_string.getvalue().split('\n')
+    assert log_strings[0] == 'Changes of "db" are only applied on restart'
+    assert log_strings[1] == 'Reloaded config from {}'.format(bot.config_path)
+    assert log_strings[2].startswith('Failed to reload config from {}'.format(bot.config_path))
+
+
+def test_graceful_shutdown(bot, logger, mocker):
+    mocker.patch.object(bot, 'check_lag', autospec=True)
+    mock_process_lots = mocker.patch.object(bot, 'process_lots', autospec=True, return_value='dissolved')
+    lots = [{'id': 'stop_lot_{}'.format(i), 'rev': '1-a', 'status': 'pending.dissolution'} for i in range(1, 4)]
+
+    def feed(window):
+        bot.scheduler.window = window
+        for seq, lot in enumerate(lots, 1):
+            bot.feed_progress(seq)
+            if seq == 2:
+                bot.request_stop()
+            yield lot
+
+    mock_get_lot = mocker.patch.object(bot, 'get_lot', autospec=True)
+    mock_get_lot.return_value = feed(window=1)
+    bot.run()
+
+    assert mock_process_lots.call_count == 2
+    assert bot.checkpoint() == 2
+    assert bot.db.get('concierge_checkpoint')['seq'] == 2
+
+    bot.stopping.clear()
+    bot.feed_seq = bot.previous_seq = 0
+    mock_get_lot.return_value = feed(window=100)
+    bot.run()
+
+    # Lots read but not processed yet are read again after a restart
+    assert mock_process_lots.call_count == 2
+    assert bot.checkpoint() == 0
+    assert bot.db.get('concierge_checkpoint')['seq'] == 0
+
+    log_strings = logger.log_capture_string.getvalue().split('\n')
+    assert log_strings[1] == 'Stopping, waiting up to 30 seconds for lots in flight'
+    assert log_strings[2] == 'Stopped worker at seq 2'
+
+
+def test_process_lots_interrupted(bot, logger, mocker):
+    with open(ROOT + 'lots.json') as lots:
+        lot = deepcopy(load(lots)[0]['data'])
+    lot['id'] = 'interrupted_lot'
+    lot['rev'] = '1-a'
+    lot['status'] = 'verification'
+    mocker.patch.object(bot, 'check_lot', autospec=True, return_value=True)
+    mocker.patch.object(bot, 'check_assets', autospec=True, return_value=True)
+    mock_run_step = mocker.patch.object(bot, 'run_step', autospec=True, return_value=None)
+    bot.pending[lot['id']] = 5
+
+    bot.stopping.set()
+    bot.stop_deadline = 0
+    assert bot.handle_lot(lot) == 'interrupted'
+    assert mock_run_step.call_count == 1
+    assert bot.progress.resume(lot) == 1
+    assert bot.pending[lot['id']] == 5
+
+    log_strings = logger.log_capture_string.getvalue().split('\n')
+    assert log_strings[1] == ("Lot interrupted_lot stopped before step 'assets to active', "
+                              "it will be resumed after restart")
+    bot.progress.finish(lot)
+
+
+def test_process_lots_known_asset_owner(bot, logger, mocker):
+    with open(ROOT + 'lots.json') as lots:
+        lot = deepcopy(load(lots)[0]['data'])
+    lot['status'] = 'verification'
+    assets = lot['assets']
+    mocker.patch.object(bot, 'check_lot', autospec=True, return_value=True)
+    mock_check_assets = mocker.patch.object(bot, 'check_assets', autospec=True, return_value=False)
+    mock_patch_lot = mocker.patch.object(bot, 'patch_lot', autospec=True, return_value=True)
+    bot.asset_states.set(assets[2], ('active', 'other_lot'))
+
+    # The cached owner is confirmed by fetching the conflicting asset first
+    assert bot.process_lots(lot) == 'rejected'
+    assert mock_check_assets.call_args[0][0]['assets'] == [assets[2], assets[0], assets[1], assets[3]]
+    assert mock_patch_lot.call_args[0] == (lot, 'pending')
+    assert bot.stats()['asset_conflicts'] == 1
+
+    log_strings = logger.log_capture_string.getvalue().split('\n')
+    assert log_strings[1] == 'Assets of lot {} may belong to other lots: {} (other_lot)'.format(lot['id'], assets[2])
+
+    # A stale owner doesn't reject the lot
+    mock_check_assets.return_value = True
+    mock_patch_lot.reset_mock()
+    mocker.patch.object(bot, 'run_step', autospec=True, return_value=None)
+    assert bot.process_lots(lot) == 'active.salable'
+    assert not mock_patch_lot.called
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+import sys
+import threading
+import time
+from Queue import Empty, Queue
+from urlparse import urlparse
+
+from requests.exceptions import ConnectionError, Timeout
+
+from .metrics import LatencyHistogram
+
+
+def operation(method_name):
+    if method_name.startswith('get_'):
+        return 'GET'
+    if method_name.startswith('patch_'):
+        return 'PATCH'
+
+
+class TokenBucket(object):
+    """Allow ``rate`` calls per second with bursts of up to ``burst`` calls."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available. Returns the time waited."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class AIMDLimiter(object):
+    """Adaptive limit on concurrent calls to one API host.
+
+    The limit grows by ``increase`` per ``limit`` successful calls (about one
+    step per round of calls) and is multiplied by ``decrease`` when a call
+    gets a 429 or 5xx answer, fails to connect or takes longer than
+    ``latency_threshold`` seconds. It is cut at most once per ``cooldown``
+    seconds, so one burst of failures doesn't collapse it to the minimum.
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=32, increase=1, decrease=0.5,
+                 latency_threshold=5.0, cooldown=1.0):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_threshold = latency_threshold
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.decreased_at = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, overloaded, latency):
+        with self.cond:
+            self.in_flight -= 1
+            now = time.time()
+            if overloaded or latency > self.latency_threshold:
+                if now - self.decreased_at >= self.cooldown:
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                    self.decreased_at = now
+            else:
+                self.limit = min(self.max_limit, self.limit + float(self.increase) / self.limit)
+            self.cond.notify_all()
+
+
+class Hedger(object):
+    """Send a second GET when the first hasn't answered within the usual latency.
+
+    The hedge is sent once a GET has taken longer than the ``percentile``
+    latency of this host's GETs, and the first successful response wins.
+    Hedging starts after ``min_samples`` GETs and hedges are only sent while
+    they stay under ``budget`` of the GETs, so a slow API doesn't get twice
+    the load. PATCHes are never hedged. Latencies are recorded by the caller,
+    as they should only cover the request, not rate limiting. For the same
+    reason the hedge delay starts when the request is sent: ``send`` gets an
+    event to set once it has passed the rate limits.
+    """
+
+    def __init__(self, percentile=95, budget=0.05, min_delay=0.05, min_samples=20):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.latencies = LatencyHistogram()
+        self.calls = 0
+        self.hedged = 0
+        self.wins = 0
+        self.over_budget = 0
+        self.lock = threading.Lock()
+
+    def record(self, latency):
+        with self.lock:
+            self.latencies.record(latency)
+
+    def delay(self):
+        """Seconds to wait for a GET before hedging it, None if there are not enough samples yet."""
+        if self.latencies.count < max(self.min_samples, 1):
+            return None
+        return max(self.latencies.percentile(self.percentile), self.min_delay)
+
+    def allow(self):
+        with self.lock:
+            if self.hedged + 1 > self.budget * self.calls:
+                self.over_budget += 1
+                return False
+            self.hedged += 1
+            return True
+
+    def attempt(self, send, index, results, sent):
+        try:
+            response = send(sent)
+        except Exception:
+            results.put((index, False, sys.exc_info()))
+        else:
+            results.put((index, True, response))
+        finally:
+            sent.set()
+
+    def start(self, send, index, results):
+        sent = threading.Event()
+        thread = threading.Thread(target=self.attempt, args=(send, index, results, sent), name='hedged-get')
+        thread.daemon = True
+        thread.start()
+        return sent
+
+    def call(self, send, on_hedge=None):
+        """Call ``send`` and hedge it if it is slow. Returns the first successful response.
+
+        ``on_hedge`` is called in the calling thread when a second request is sent.
+        """
+        with self.lock:
+            self.calls += 1
+            delay = self.delay()
+        if delay is None:
+            return send(threading.Event())
+
+        results = Queue()
+        # Time spent waiting for a token or a concurrency slot doesn't count
+        self.start(send, 0, results).wait()
+        attempts = 1
+        try:
+            index, success, result = results.get(timeout=delay)
+        except Empty:
+            if self.allow():
+                if on_hedge is not None:
+                    on_hedge()
+                self.start(send, 1, results)
+                attempts = 2
+            index, success, result = results.get()
+        if not success and attempts == 2:
+            # The other request may still succeed
+            error = result
+            index, success, result = results.get()
+            if not success:
+                result = error
+        if not success:
+            raise result[0], result[1], result[2]
+        if index == 1:
+            with self.lock:
+                self.wins += 1
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {'calls': self.calls, 'hedged': self.hedged, 'wins': self.wins,
+                    'over_budget': self.over_budget, 'delay': self.delay()}
+
+
+class ThrottledClient(object):
+    """Proxy an API client through the rate limits and limiter of its host.
+
+    Methods named ``get_*`` and ``patch_*`` are counted as GET and PATCH
+    calls, everything else is passed through untouched. GETs are hedged if
+    the host has a Hedger, and ``on_hedge`` is called for every hedge sent.
+    """
+
+    def __init__(self, client, throttle, host, on_hedge=None):
+        self._client = client
+        self._throttle = throttle
+        self._host = host
+        self._on_hedge = on_hedge
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        op = operation(name)
+        if op is None or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self._throttle.call(self._host, op, attr, args, kwargs, on_hedge=self._on_hedge)
+        return call
+
+
+class Throttle(object):
+    """Rate limits, concurrency limiters and hedgers shared by all clients of a host."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.limiters = {}
+        self.hedgers = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def wrap(self, client, api_config, on_hedge=None):
+        rate_limits = api_config.get('rate_limits')
+        concurrency = api_config.get('concurrency')
+        hedging = api_config.get('hedging')
+        if not rate_limits and not concurrency and not hedging:
+            return client
+        host = urlparse(api_config['url']).netloc
+        with self.lock:
+            for op, options in (rate_limits or {}).items():
+                self.buckets.setdefault((host, op), TokenBucket(**options))
+            if concurrency:
+                self.limiters.setdefault(host, AIMDLimiter(**concurrency))
+            if hedging:
+                self.hedgers.setdefault(host, Hedger(**hedging))
+        return ThrottledClient(client, self, host, on_hedge)
+
+    def _record(self, host, op, waited, latency, overloaded):
+        with self.lock:
+            stats = self.stats.setdefault('{} {}'.format(op, host), {
+                'calls': 0, 'errors': 0, 'throttled': 0.0, 'latency': 0.0
+            })
+            stats['calls'] += 1
+            stats['errors'] += int(overloaded)
+            stats['throttled'] += waited
+            stats['latency'] += latency
+
+    def call(self, host, op, method, args=(), kwargs=None, on_hedge=None):
+        hedger = self.hedgers.get(host) if op == 'GET' else None
+        if hedger is not None:
+            return hedger.call(lambda sent: self._call(host, op, method, args, kwargs or {}, hedger, sent),
+                               on_hedge)
+        return self._call(host, op, method, args, kwargs or {})
+
+    def _call(self, host, op, method, args, kwargs, hedger=None, sent=None):
+        waited = 0.0
+        bucket = self.buckets.get((host, op))
+        if bucket is not None:
+            waited = bucket.acquire()
+        limiter = self.limiters.get(host)
+        if limiter is not None:
+            limiter.acquire()
+        overloaded = False
+        started = time.time()
+        if sent is not None:
+            sent.set()
+        try:
+            return method(*args, **kwargs)
+        except (ConnectionError, Timeout):
+            overloaded = True
+            raise
+        except Exception as e:
+            status_code = getattr(e, 'status_code', None) or 0
+            overloaded = status_code == 429 or status_code >= 500
+            raise
+        finally:
+            latency = time.time() - started
+            if limiter is not None:
+                limiter.release(overloaded, latency)
+            if hedger is not None:
+                hedger.record(latency)
+            self._record(host, op, waited, latency, overloaded)
+
+    def limits(self):
+        return dict((host, limiter.limit) for host, limiter in self.limiters.items())
+
+    def hedging(self):
+        return dict((host, hedger.stats()) for host, hedger in self.hedgers.items())
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import time
+
+# What the concierge does with a lot in each status it handles.
+#
+# ``check_assets`` holds extra arguments for BotWorker.check_assets. If the
+# assets don't pass the check, the lot is patched to ``rejected_status``, or
+# just reported when there is none. Otherwise ``steps`` are run in order:
+# each patches either all assets of the lot or the lot itself to ``status``
+# (passing the lot id as relatedLot if ``related_lot`` is set). When a step
+# fails, ``rollback`` tells which assets go back to 'pending': the ones
+# patched by this step ('patched') or all of them ('all'). If the rollback
+# fails too, or there is nothing to roll back to, the lot is logged as
+# broken with the ``broken`` message. Steps without ``broken`` ignore
+# failures.
+LOT_TRANSITIONS = {
+    'verification': {
+        'check_assets': (),
+        'rejected_status': 'pending',
+        'steps': (
+            {
+                'name': 'assets to verification',
+                'patch': 'assets',
+                'status': 'verification',
+                'related_lot': True,
+                'rollback': 'patched',
+                'broken': 'patching assets to verification'
+            },
+            {
+                'name': 'assets to active',
+                'patch': 'assets',
+                'status': 'active',
+                'related_lot': True,
+                'rollback': 'all',
+                'broken': 'patching assets to active'
+            },
+            {
+                'name': 'lot to active.salable',
+                'patch': 'lot',
+                'status': 'active.salable',
+                'broken': 'patching lot to active.salable'
+            },
+        ),
+        'outcome': 'active.salable'
+    },
+    'pending.dissolution': {
+        'check_assets': ('active',),
+        'rejected_status': None,
+        'steps': (
+            {
+                'name': 'assets to pending',
+                'patch': 'assets',
+                'status': 'pending',
+                'message': "Assets %s from lot %s will be patched to 'pending'"
+            },
+            {
+                'name': 'lot to dissolved',
+                'patch': 'lot',
+                'status': 'dissolved'
+            },
+        ),
+        'outcome': 'dissolved'
+    }
+}
+
+
+class LotProgress(object):
+    """Steps completed for lots in flight, kept in a CouchDB document.
+
+    An entry is written after every completed step and removed when the lot
+    reaches an outcome, so a restarted worker picks up a lot at the first
+    step it hasn't completed. The entry is only used for the same lot
+    revision and status; if the lot was changed meanwhile it starts over.
+
+    Every update is written right away with a flush of this document only,
+    so a crash repeats at most the step that was running, and the resumed
+    step skips the patches it had already applied.
+    """
+
+    def __init__(self, db, writer, doc_id, logger):
+        self.writer = writer
+        self.logger = logger
+        self.doc = db.get(doc_id)
+        if self.doc is None:
+            self.doc = {'_id': doc_id}
+
+    def __len__(self):
+        return len([key for key in self.doc if not key.startswith('_')])
+
+    def resume(self, lot):
+        entry = self.doc.get(lot['id'])
+        if not entry:
+            return 0
+        if entry['rev'] != lot.get('rev') or entry['status'] != lot['status']:
+            self.logger.warning('Lot %s was changed since step %s, starting over', lot['id'], entry['step'],
+                                extra={'lot_id': lot['id'], 'phase': 'resume'})
+            self.writer.del_item(self.doc, lot['id'])
+            self.writer.flush(self.doc['_id'])
+            return 0
+        return entry['step']
+
+    def save(self, lot, step):
+        self.writer.set_item(self.doc, lot['id'], {
+            'rev': lot.get('rev'),
+            'status': lot['status'],
+            'step': step,
+            'updated': time.time()
+        })
+        self.writer.flush(self.doc['_id'])
+
+    def finish(self, lot):
+        if lot['id'] in self.doc:
+            self.writer.del_item(self.doc, lot['id'])
+            self.writer.flush(self.doc['_id'])
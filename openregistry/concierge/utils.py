@@ -1,5 +1,12 @@
 # -*- coding: utf-8 -*-
+import signal
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
 from couchdb import Server, Session
+from couchdb.http import ResourceConflict, ServerError
 from socket import error
 
 from .design import sync_design
@@ -11,7 +18,13 @@ class ConfigError(Exception):
     pass
 
 
-def prepare_couchdb(couch_url, db_name, logger, errors_doc):
+def couchdb_url(db_config):
+    if db_config.get('login', '') and db_config.get('password', ''):
+        return "http://{login}:{password}@{host}:{port}".format(**db_config)
+    return "http://{host}:{port}".format(**db_config)
+
+
+def prepare_couchdb(couch_url, db_name, logger, errors_doc=None, sync=True):
     server = Server(couch_url, session=Session(retry_delays=range(10)))
     try:
         if db_name not in server:
@@ -19,61 +32,248 @@ def prepare_couchdb(couch_url, db_name, logger, errors_doc):
         else:
             db = server[db_name]
 
-        broken_lots = db.get(errors_doc, None)
-        if broken_lots is None:
-            db[errors_doc] = {}
+        if errors_doc is not None:
+            broken_lots = db.get(errors_doc, None)
+            if broken_lots is None:
+                db[errors_doc] = {}
 
     except error as e:
-        logger.error('Database error: {}'.format(e.message))
+        logger.error('Database error: %s', e.message)
         raise ConfigError(e.strerror)
-    sync_design(db)
+    if sync:
+        sync_design(db)
     return db
 
 
-def continuous_changes_feed(db, logger, limit=100, filter_doc='lots/status'):
+def shard(lot_id, processes):
+    """Index of the worker process that handles ``lot_id``, stable across restarts."""
+    return (zlib.crc32(lot_id) & 0xffffffff) % processes
+
+
+def install_signal_handler(signum, handler):
+    """Handle ``signum`` without interrupting blocking system calls, like a request in flight.
+
+    Python 2 makes signal.signal() interrupt them, so a signal would make
+    the pending API request fail with EINTR.
+    """
+    signal.signal(signum, handler)
+    signal.siginterrupt(signum, False)
+
+
+def lot_from_doc(doc):
+    """The lot fields the concierge works with, from a lots database document."""
+    return {
+        'id': doc['_id'],
+        'rev': doc['_rev'],
+        'status': doc['status'],
+        'assets': doc['assets'],
+        'lotID': doc['lotID']
+    }
+
+
+def continuous_changes_feed(db, logger, limit=100, filter_doc='lots/status', progress=None, since=0):
 
-    last_seq_id = 0
+    last_seq_id = since
     while CONTINUOUS_CHANGES_FEED_FLAG:
         try:
             data = db.changes(include_docs=True, since=last_seq_id, limit=limit, filter=filter_doc)
         except error as e:
-            logger.error('Failed to get lots from DB: [Errno {}] {}'.format(e.errno, e.strerror))
+            logger.error('Failed to get lots from DB: [Errno %s] %s', e.errno, e.strerror)
             break
         last_seq_id = data['last_seq']
         if len(data['results']) != 0:
             for row in data['results']:
-                item = {
-                    'id': row['doc']['_id'],
-                    'rev': row['doc']['_rev'],
-                    'status': row['doc']['status'],
-                    'assets': row['doc']['assets'],
-                    'lotID': row['doc']['lotID']
-                }
+                item = lot_from_doc(row['doc'])
+                if progress is not None:
+                    progress(row['seq'])
                 yield item
+            if progress is not None:
+                progress(last_seq_id)
         else:
             break
 
 
-def log_broken_lot(db, logger, doc, lot, message):
+class LRUCache(object):
+    """Thread-safe mapping that keeps at most ``size`` recently set items.
+
+    Items older than ``ttl`` seconds, if it is set, are treated as missing.
+    """
+
+    def __init__(self, size=10000, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return default
+            value, stored = item
+            if self.ttl is not None and time.time() - stored > self.ttl:
+                del self.items[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (value, time.time())
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            item = self.items.pop(key, None)
+        return default if item is None else item[0]
+
+
+class BulkDocsWriter(object):
+    """Buffer document updates and write them through ``_bulk_docs``.
+
+    Updates are applied to the in-memory documents right away and the
+    touched keys are remembered, so the documents are written in one
+    request once ``max_size`` changes are pending or the oldest pending
+    change is ``max_delay`` seconds old. On a conflict the latest revision
+    is fetched, our pending keys are applied on top of it and the document
+    is written again on the next flush. Once ``dry_run`` is set, flushes
+    keep the changes in the documents and don't write anything.
+    """
+
+    def __init__(self, db, logger, max_size=50, max_delay=5):
+        self.db = db
+        self.logger = logger
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.dry_run = False
+        self.lock = threading.RLock()
+        self.docs = {}
+        self.keys = {}
+        self.changes = 0
+        self.first_change = None
+        self.failed_at = None
+
+    def __len__(self):
+        return self.changes
+
+    def _mark(self, doc, key):
+        with self.lock:
+            self.docs[doc['_id']] = doc
+            self.keys.setdefault(doc['_id'], set()).add(key)
+            self.changes += 1
+            if self.first_change is None:
+                self.first_change = time.time()
+
+    def set_item(self, doc, key, value):
+        with self.lock:
+            doc[key] = value
+            self._mark(doc, key)
+
+    def del_item(self, doc, key):
+        with self.lock:
+            doc.pop(key, None)
+            self._mark(doc, key)
+
+    def is_due(self):
+        if self.first_change is None:
+            return False
+        if self.failed_at is not None and time.time() - self.failed_at < self.max_delay:
+            return False
+        return self.changes >= self.max_size or time.time() - self.first_change >= self.max_delay
+
+    def flush_if_due(self):
+        if self.is_due():
+            self.flush()
+
+    def flush(self, doc_id=None):
+        """Write the pending changes, only those of ``doc_id`` if it is given."""
+        with self.lock:
+            if doc_id is None:
+                docs, keys = self.docs, self.keys
+            elif doc_id in self.docs:
+                docs, keys = {doc_id: self.docs[doc_id]}, {doc_id: self.keys[doc_id]}
+            else:
+                return
+            if not docs:
+                return
+            if self.dry_run:
+                results = []
+            else:
+                try:
+                    results = self.db.update(docs.values())
+                except error as e:
+                    self.logger.error('Database error: %s', e.strerror)
+                    self.failed_at = time.time()
+                    return
+            self.failed_at = None
+            if doc_id is None:
+                self.docs, self.keys = {}, {}
+            else:
+                del self.docs[doc_id]
+                del self.keys[doc_id]
+            if not self.docs:
+                self.changes = 0
+                self.first_change = None
+            for success, doc_id, rev_or_exc in results:
+                if success:
+                    docs[doc_id]['_rev'] = rev_or_exc
+                elif isinstance(rev_or_exc, ResourceConflict):
+                    self.logger.warning('Conflict on saving %s, merging with the latest revision', doc_id)
+                    self._merge(docs[doc_id], keys[doc_id])
+                else:
+                    self.logger.error('Failed to save %s: %s', doc_id, rev_or_exc)
+                    self.docs[doc_id] = docs[doc_id]
+                    self.keys[doc_id] = keys[doc_id]
+                    self.changes += 1
+                    self.first_change = time.time()
+
+    def _merge(self, doc, keys):
+        try:
+            latest = self.db.get(doc['_id'], {})
+        except (error, ServerError) as e:
+            # Keep our changes and merge again on the next flush
+            self.logger.error('Failed to get the latest revision of %s: %s', doc['_id'], e)
+            self.failed_at = time.time()
+            latest = None
+        if latest is None:
+            self._requeue(doc, keys)
+            return
+        for key in set(doc) - set(latest) - keys:
+            if not key.startswith('_'):
+                del doc[key]
+        for key, value in latest.items():
+            if key not in keys:
+                doc[key] = value
+        doc['_rev'] = latest.get('_rev')
+        self._requeue(doc, keys)
+
+    def _requeue(self, doc, keys):
+        self.docs[doc['_id']] = doc
+        self.keys[doc['_id']] = keys
+        self.changes += 1
+        if self.first_change is None:
+            self.first_change = time.time()
+
+
+def log_broken_lot(writer, logger, doc, lot, message):
     lot['resolved'] = False
     lot['message'] = message
-    try:
-        doc[lot['id']] = lot
-        db.save(doc)
-    except error as e:
-        logger.error('Database error: {}'.format(e.message))
-        raise ConfigError(e.strerror)
-    else:
-        return doc
+    lot.pop('resolved_at', None)
+    writer.set_item(doc, lot['id'], lot)
+    logger.debug('Lot %s marked as broken (%s)', lot['id'], message,
+                 extra={'lot_id': lot['id'], 'phase': 'broken_lots'})
+    return doc
 
 
-def resolve_broken_lot(db, logger, doc, lot):
-    try:
-        doc[lot['id']]['resolved'] = True
-        doc[lot['id']]['rev'] = lot['rev']
-        db.save(doc)
-    except error as e:
-        logger.error('Database error: {}'.format(e.message))
-        raise ConfigError(e.strerror)
-    else:
-        return doc
+def resolve_broken_lot(writer, logger, doc, lot):
+    broken_lot = doc[lot['id']]
+    broken_lot['resolved'] = True
+    broken_lot['resolved_at'] = time.time()
+    broken_lot['rev'] = lot['rev']
+    writer.set_item(doc, lot['id'], broken_lot)
+    logger.debug('Broken lot %s resolved', lot['id'], extra={'lot_id': lot['id'], 'phase': 'broken_lots'})
+    return doc
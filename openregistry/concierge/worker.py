@@ -1,196 +1,1016 @@
 # -*- coding: utf-8 -*-
 import argparse
 import logging
-import logging.config
 import os
+import signal
+import sys
+import threading
 import time
+import requests
 import yaml
 
-from openprocurement_client.resources.lots import LotsClient
-from openprocurement_client.resources.assets import AssetsClient
-from openprocurement_client.exceptions import (
-    Forbidden,
-    RequestFailed,
-    ResourceNotFound,
-    UnprocessableEntity
-)
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from Queue import Empty
+from socket import error
 
+from .compaction import ErrorsCompactor
+from .config import check_config
+from .conflicts import AssetIndex
+from .design import sync_design
+from .lag import FeedLag, seq_number
+from .log import configure_logging
+from .metrics import LatencySLO, PhaseTimings
+from .records import LotRecordWriter
+from .pool import WorkerPool
+from .retry import RetryScheduler
+from .scheduler import LotScheduler
+from .sources import make_source
+from .status import StatusServer, write_status_file
+from .throttling import Throttle
+from .transitions import LOT_TRANSITIONS, LotProgress
 from .utils import (
+    BulkDocsWriter,
+    LRUCache,
+    couchdb_url,
+    install_signal_handler,
     resolve_broken_lot,
-    continuous_changes_feed,
     log_broken_lot,
-    prepare_couchdb
+    prepare_couchdb,
+    shard as lot_shard
 )
 
 logger = logging.getLogger(__name__)
 
-EXCEPTIONS = (Forbidden, RequestFailed, ResourceNotFound, UnprocessableEntity)
+ASSET_CACHE = {'size': 10000, 'ttl': 300}
+# Outcomes after which the lot is processed again, so its latency isn't final yet
+UNFINISHED_OUTCOMES = ('deferred', 'interrupted', 'broken')
+
+
+def api_exceptions():
+    """openprocurement_client.exceptions, imported on first use like the clients are."""
+    from openprocurement_client import exceptions
+    return exceptions
 
 
 class BotWorker(object):
-    def __init__(self, config):
+    def __init__(self, config, sync=True, config_path=None, log_listeners=None, shard=None):
+        started = time.time()
         self.config = config
+        self.config_path = config_path
+        self.config_mtime = os.path.getmtime(config_path) if config_path else None
+        self.config_checked = time.time()
+        self.reload_requested = False
+        self.log_listeners = log_listeners if log_listeners is not None else []
         self.sleep = self.config['time_to_sleep']
-        self.lots_client = LotsClient(
-            key=self.config['lots']['api']['token'],
-            host_url=self.config['lots']['api']['url'],
-            api_version=self.config['lots']['api']['version']
-        )
-        self.assets_client = AssetsClient(
-            key=self.config['assets']['api']['token'],
-            host_url=self.config['assets']['api']['url'],
-            api_version=self.config['assets']['api']['version']
-        )
-        if self.config['db'].get('login', '') \
-                and self.config['db'].get('password', ''):
-            db_url = "http://{login}:{password}@{host}:{port}".format(
-                **self.config['db']
-            )
+        self.throttle = Throttle()
+        self.clients_lock = threading.Lock()
+        self._lots_client = None
+        self._assets_client = None
+        self.db = prepare_couchdb(couchdb_url(self.config['db']), self.config['db']['name'], logger,
+                                  self.config['errors_doc'], sync=False)
+        self._source = None
+        self.design_synced = threading.Event()
+        if sync:
+            design_sync = threading.Thread(target=self.sync_design, args=(self.db,), name='design-sync')
+            design_sync.daemon = True
+            design_sync.start()
         else:
-            db_url = "http://{host}:{port}".format(**self.config['db'])
-
-        self.db = prepare_couchdb(db_url, self.config['db']['name'], logger, self.config['errors_doc'])
+            self.design_synced.set()
+        # Cached states decide which patches and rollbacks are skipped, so they expire by default
+        self.asset_states = LRUCache(**dict(ASSET_CACHE, **self.config.get('asset_cache', {})))
+        self.asset_index = AssetIndex(self.asset_states)
+        self.skipped_patches = 0
+        self.asset_conflicts = 0
+        # Lot id -> (rev, reason) of lots check_lot found not actionable at that rev
+        self.not_actionable = LRUCache(**self.config.get('negative_cache', {}))
+        self.negative_cache_hits = 0
+        # Checks are done as usual, patches are only logged
+        self.dry_run = False
+        self.read_lots_from_db = self.config['lots'].get('read_from_db', False)
+        self.assets_db = None
+        if self.config['assets'].get('db'):
+            assets_db_config = dict(self.config['db'], **self.config['assets']['db'])
+            self.assets_db = prepare_couchdb(couchdb_url(assets_db_config), assets_db_config['name'], logger,
+                                             sync=False)
         self.errors_doc = self.db.get(self.config['errors_doc'])
         self.patch_log_doc = self.db.get('patch_requests')
+        self.errors_writer = BulkDocsWriter(self.db, logger, **self.config.get('bulk_writes', {}))
+        self.compactor = None
+        if self.config.get('compaction'):
+            self.compactor = ErrorsCompactor(self.db, self.errors_writer, self.errors_doc, logger,
+                                             **self.config['compaction'])
+        self.scheduler = LotScheduler(**self.config.get('scheduler', {}))
+        self.pool = WorkerPool(self.handle_lot, logger, self.config.get('workers', 1))
+        self.lag = FeedLag()
+        self.timings = PhaseTimings()
+        self.slo = LatencySLO(**self.config.get('slo', {}))
+        self.records = None
+        if self.config.get('records'):
+            self.records = LotRecordWriter(**self.config['records'])
+        # API calls made for the lot the current thread is processing
+        self.lot_context = threading.local()
+        self.in_flight = {}
+        self.last_error = None
+        self.heartbeat = time.time()
+        self.lag_checked = 0
+        self.status_server = None
+        self.outcomes = Counter()
+        self.api_calls = Counter()
+        self.stats_lock = threading.Lock()
+        self.retries = RetryScheduler(**self.config.get('retry', {}))
+        self.progress = LotProgress(self.db, self.errors_writer, self.config.get('progress_doc', 'lots_progress'),
+                                    logger)
+        checkpoint_doc = self.config.get('checkpoint_doc', 'concierge_checkpoint')
+        self.checkpoint_doc = self.db.get(checkpoint_doc) or {'_id': checkpoint_doc}
+        self.feed_seq = self.previous_seq = self.checkpoint_doc.get('seq', 0)
+        self.rescanned = time.time() if self.feed_seq else 0
+        # Feed position before each lot read but not processed yet
+        self.pending = OrderedDict()
+        self.stopping = threading.Event()
+        self.stop_deadline = None
+        # (index, processes) of a worker process, which only retries the lots of its shard
+        self.shard = shard
+        for key, broken_lot in self.errors_doc.items():
+            if key.startswith('_') or broken_lot.get('resolved', False):
+                continue
+            if shard is None or lot_shard(key, shard[1]) == shard[0]:
+                self.retries.schedule(broken_lot)
+        logger.debug('Worker initialized in %.3f seconds', time.time() - started)
+
+    @property
+    def source(self):
+        """The lot source, created on first use: worker processes and batch runs never read the feed."""
+        if self._source is None:
+            self._source = make_source(self.config, self.db)
+        return self._source
+
+    # openprocurement_client is imported on first use like the clients are
+    # created, so --check-config and a worker waiting for lots don't load it
+    @property
+    def lots_client(self):
+        with self.clients_lock:
+            if self._lots_client is None:
+                from openprocurement_client.resources.lots import LotsClient
+                self._lots_client = self.make_client(LotsClient, 'lots')
+            return self._lots_client
+
+    @property
+    def assets_client(self):
+        with self.clients_lock:
+            if self._assets_client is None:
+                from openprocurement_client.resources.assets import AssetsClient
+                self._assets_client = self.make_client(AssetsClient, 'assets')
+            return self._assets_client
+
+    def make_client(self, client_class, api):
+        """Create an API client on first use, as creating one already talks to the API."""
+        started = time.time()
+        api_config = self.config[api]['api']
+        client = self.throttle.wrap(client_class(
+            key=api_config['token'],
+            host_url=api_config['url'],
+            api_version=api_config['version']
+        ), api_config, on_hedge=lambda: self.count_api_call('GET', api))
+        logger.debug('Created API client for %s in %.3f seconds', api_config['url'], time.time() - started)
+        return client
+
+    def sync_design(self, db):
+        started = time.time()
+        try:
+            sync_design(db)
+        except Exception:
+            logger.exception('Failed to sync design documents')
+        else:
+            logger.debug('Synced design documents in %.3f seconds', time.time() - started)
+        finally:
+            self.design_synced.set()
 
     def run(self):
         logger.info("Starting worker")
-        while True:
-            for lot in self.get_lot():
-                broken_lot = self.errors_doc.get(lot['id'], None)
-                if broken_lot:
-                    if broken_lot['rev'] == lot['rev']:
-                        continue
-                    else:
-                        errors_doc = resolve_broken_lot(self.db, logger, self.errors_doc, lot)
-                        self.process_lots(errors_doc[lot['id']])
-                else:
-                    self.process_lots(lot)
-            time.sleep(self.sleep)
+        self.start_status_server()
+        if self.compactor is not None:
+            self.compactor.start()
+        try:
+            while True:
+                for lot in self.get_lot():
+                    self.heartbeat = time.time()
+                    if self.schedule_lot(lot):
+                        with self.stats_lock:
+                            self.pending.setdefault(lot['id'], self.previous_seq)
+                    self.schedule_retries()
+                    self.dispatch(self.scheduler.window - 1)
+                    self.errors_writer.flush_if_due()
+                    self.check_lag()
+                    self.check_reload()
+                    if self.stopping.is_set():
+                        break
+                if self.stopping.is_set():
+                    break
+                self.heartbeat = time.time()
+                self.check_lag()
+                self.check_reload()
+                self.schedule_retries()
+                self.dispatch(0)
+                self.pool.join()
+                self.errors_writer.flush()
+                if self.records is not None:
+                    self.records.flush()
+                self.save_checkpoint()
+                self.log_stats()
+                if not self.source.blocking and self.stopping.wait(self.sleep):
+                    break
+        finally:
+            self.shutdown()
+
+    def request_stop(self, signum=None, frame=None):
+        if self.stopping.is_set():
+            logger.warning('Stopping right away')
+            sys.exit(1)
+        timeout = self.config.get('shutdown_timeout', 30)
+        logger.info('Stopping, waiting up to %s seconds for lots in flight', timeout)
+        self.stop_deadline = time.time() + timeout
+        self.stopping.set()
+
+    def stop_due(self):
+        return self.stopping.is_set() and time.time() >= self.stop_deadline
+
+    def shutdown(self):
+        """Wait for lots in flight, flush pending writes and store the feed position."""
+        if self.stopping.is_set():
+            self.join_pool()
+        if self.compactor is not None:
+            self.compactor.stop()
+        self.errors_writer.flush()
+        if self.records is not None:
+            self.records.close()
+        self.save_checkpoint()
+        if self._source is not None:
+            self._source.close()
+        if self.status_server is not None:
+            self.status_server.stop()
+        logger.info('Stopped worker at seq %s', self.checkpoint_doc.get('seq', 0))
+
+    def feed_progress(self, seq):
+        self.previous_seq, self.feed_seq = self.feed_seq, seq
+        self.lag.update_seq(seq)
+
+    def checkpoint(self):
+        """Feed position to start from so that no lot read so far is missed."""
+        with self.stats_lock:
+            if self.pending:
+                return min(self.pending.values(), key=seq_number)
+        return self.feed_seq
+
+    def save_checkpoint(self):
+        seq = self.checkpoint()
+        if seq == self.checkpoint_doc.get('seq'):
+            return
+        self.errors_writer.set_item(self.checkpoint_doc, 'seq', seq)
+        self.errors_writer.set_item(self.checkpoint_doc, 'updated', time.time())
+        self.errors_writer.flush()
+
+    def consume(self, lots, reports=None, index=0):
+        """Process ``(seq, lot)`` pairs received from a feed reader process until None is received.
+
+        Used by the worker processes of the multiprocess mode; stats are put
+        into ``reports`` every ``time_to_sleep`` seconds. Once the worker is
+        stopping it takes no more lots, and its last report has the feed
+        position of the first lot it didn't finish as ``unfinished``.
+        """
+        logger.info("Starting worker process %s", index)
+        reported = time.time()
+        stop = False
+        try:
+            while not stop and not self.stopping.is_set():
+                batch = []
+                try:
+                    batch.append(lots.get(True, self.sleep))
+                    while len(batch) < self.scheduler.window:
+                        batch.append(lots.get_nowait())
+                except Empty:
+                    pass
+                for item in batch:
+                    if item is None:
+                        stop = True
+                        break
+                    seq, lot = item
+                    if self.schedule_lot(lot):
+                        with self.stats_lock:
+                            self.pending.setdefault(lot['id'], seq)
+                self.schedule_retries()
+                self.dispatch(0)
+                self.errors_writer.flush_if_due()
+                if reports is not None and time.time() - reported >= self.sleep:
+                    reports.put((index, self.stats()))
+                    reported = time.time()
+            # Lots still in flight after the deadline may be lost, so there's no last report then
+            if self.join_pool() and reports is not None:
+                with self.stats_lock:
+                    unfinished = min(self.pending.values(), key=seq_number) if self.pending else None
+                reports.put((index, dict(self.stats(), unfinished=unfinished)))
+        finally:
+            self.join_pool()
+            self.errors_writer.flush()
+            if self.records is not None:
+                self.records.close()
+
+    def join_pool(self):
+        """Wait for the lots in flight, only until the shutdown deadline once stopping."""
+        if not self.stopping.is_set():
+            return self.pool.join()
+        if self.pool.join(max(self.stop_deadline - time.time(), 0)):
+            return True
+        logger.warning('%s lots are still in flight after the shutdown deadline', self.pool.in_flight)
+        return False
+
+    def dispatch(self, window):
+        """Hand scheduled lots to the pool until at most ``window`` are left queued."""
+        while len(self.scheduler) > max(window, 0):
+            self.pool.submit(self.scheduler.pop())
+            self.errors_writer.flush_if_due()
+
+    def handle_lot(self, lot):
+        self.lot_context.api_calls = 0
+        with self.stats_lock:
+            self.in_flight[lot['id']] = {'status': lot['status'], 'phase': 'wait_assets', 'started': time.time()}
+        if self.asset_index.acquire(lot):
+            logger.debug('Lot %s waited for lots sharing its assets', lot['id'],
+                         extra={'lot_id': lot['id'], 'phase': 'wait_assets'})
+        try:
+            outcome = self.process_lots(lot)
+        except Exception as e:
+            # Retry the lot from the errors doc, so the checkpoint can move past it
+            self.mark_broken(lot, repr(e))
+            with self.stats_lock:
+                self.outcomes['broken'] += 1
+                self.pending.pop(lot['id'], None)
+            raise
+        finally:
+            self.asset_index.release(lot)
+            with self.stats_lock:
+                entry = self.in_flight.pop(lot['id'], None) or {}
+            # A worker busy with a long batch of lots is still alive
+            self.heartbeat = time.time()
+        if self.records is not None:
+            self.records.append(lot['id'], len(lot.get('assets') or []), outcome, lot.get('retries', 0),
+                                self.lot_context.api_calls, entry.get('phases', {}))
+        self.settle_broken_lot(lot, outcome)
+        with self.stats_lock:
+            self.outcomes[outcome] += 1
+            # Interrupted lots are read again from the checkpoint after a restart
+            if outcome != 'interrupted':
+                self.pending.pop(lot['id'], None)
+        if outcome not in UNFINISHED_OUTCOMES:
+            self.finish_lot(lot, outcome)
+        return outcome
+
+    def finish_lot(self, lot, outcome):
+        """Record how long the lot took from the feed to ``outcome`` and warn if it's over the objective."""
+        result = self.slo.finish(lot, outcome)
+        if result is None:
+            return
+        latency, violated = result
+        if violated:
+            logger.warning('Lot %s took %.1f seconds to be %s, the objective is %s seconds', lot['id'], latency,
+                           outcome, self.slo.objectives[outcome], extra={'lot_id': lot['id'], 'phase': 'slo'})
+
+    def count_api_call(self, method, api):
+        """Count a request to the API of ``api`` for the lot of this thread and in total."""
+        self.lot_context.api_calls = getattr(self.lot_context, 'api_calls', 0) + 1
+        with self.stats_lock:
+            self.api_calls['{} {}'.format(method, api)] += 1
+
+    @contextmanager
+    def phase(self, lot, name):
+        """Time a phase of processing ``lot`` and show it among the lots in flight."""
+        with self.stats_lock:
+            if lot['id'] in self.in_flight:
+                self.in_flight[lot['id']]['phase'] = name
+        started = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - started
+            self.timings.record(name, duration)
+            with self.stats_lock:
+                if lot['id'] in self.in_flight:
+                    self.in_flight[lot['id']].setdefault('phases', {})[name] = round(duration, 3)
+
+    def record_error(self, lot, message):
+        self.last_error = {'lot_id': lot['id'], 'message': message, 'time': time.time()}
+
+    def stats(self):
+        with self.stats_lock:
+            outcomes = dict(self.outcomes)
+            api_calls = dict(self.api_calls)
+        return {
+            'outcomes': outcomes,
+            'queued': len(self.scheduler),
+            'scheduler': self.scheduler.stats(),
+            'in_flight': self.pool.in_flight,
+            'retries': len(self.retries),
+            'skipped_patches': self.skipped_patches,
+            'asset_conflicts': self.asset_conflicts,
+            'negative_cache_hits': self.negative_cache_hits,
+            'api_calls': api_calls,
+            'asset_waits': self.asset_index.waits,
+            'api': dict((key, dict(value)) for key, value in self.throttle.stats.items()),
+            'concurrency_limits': self.throttle.limits(),
+            'hedging': self.throttle.hedging(),
+            'feed_lag': self.lag.status(),
+            'errors_doc': self.compactor.report if self.compactor is not None else None
+        }
+
+    def install_signal_handlers(self):
+        install_signal_handler(signal.SIGHUP, self.request_reload)
+        install_signal_handler(signal.SIGTERM, self.request_stop)
+        install_signal_handler(signal.SIGINT, self.request_stop)
+
+    def request_reload(self, signum=None, frame=None):
+        self.reload_requested = True
+
+    def check_reload(self, now=None):
+        """Reload the config if asked to by SIGHUP or, with ``reload.watch``, if the file changed."""
+        if self.config_path is None:
+            return
+        reload_config = self.config.get('reload', {})
+        now = time.time() if now is None else now
+        if reload_config.get('watch') and now - self.config_checked >= reload_config.get('interval', 5):
+            self.config_checked = now
+            try:
+                if os.path.getmtime(self.config_path) != self.config_mtime:
+                    self.reload_requested = True
+            except OSError as e:
+                logger.warning('Failed to check %s: %s', self.config_path, e.strerror)
+        if self.reload_requested:
+            self.reload_requested = False
+            self.reload_config()
+
+    def reload_config(self):
+        """Apply a changed config without losing the feed position or caches.
+
+        In-flight lots are drained first, so new API clients and pool sizes
+        only apply to lots started afterwards. Database and status server
+        settings need a restart.
+        """
+        try:
+            self.config_mtime = os.path.getmtime(self.config_path)
+            with open(self.config_path) as config_file:
+                config = yaml.load(config_file.read())
+        except (IOError, OSError, yaml.YAMLError) as e:
+            logger.error('Failed to reload config from %s: %s', self.config_path, e)
+            return False
+        errors = check_config(config)
+        if errors:
+            logger.error('Not reloading invalid config from %s: %s', self.config_path, '; '.join(errors))
+            return False
+        for key in ('db', 'errors_doc', 'progress_doc', 'checkpoint_doc', 'source', 'status', 'compaction',
+                    'records'):
+            if config.get(key) != self.config.get(key):
+                logger.warning('Changes of "%s" are only applied on restart', key)
+                config[key] = self.config.get(key)
+
+        self.dispatch(0)
+        self.pool.join()
+        self.errors_writer.flush()
+        for listener in self.log_listeners:
+            listener.stop()
+        self.log_listeners[:] = configure_logging(config)
+        self.apply_config(config)
+        logger.info('Reloaded config from %s', self.config_path)
+        return True
+
+    def apply_config(self, config):
+        self.config = config
+        self.sleep = config['time_to_sleep']
+        self.read_lots_from_db = config['lots'].get('read_from_db', False)
+        throttle = Throttle()
+        throttle.stats = self.throttle.stats
+        with self.clients_lock:
+            self.throttle = throttle
+            self._lots_client = None
+            self._assets_client = None
+        for component, section in ((self.retries, 'retry'), (self.errors_writer, 'bulk_writes'),
+                                   (self.asset_states, 'asset_cache'), (self.not_actionable, 'negative_cache'),
+                                   (self.slo, 'slo')):
+            for name, value in config.get(section, {}).items():
+                setattr(component, name, value)
+        if len(self.scheduler) == 0:
+            self.scheduler = LotScheduler(**config.get('scheduler', {}))
+        self.pool.resize(config.get('workers', 1))
+        # Let the feed lag thresholds apply on top of the new pool size
+        self.lag_checked = 0
+
+    def start_status_server(self):
+        if not self.config.get('status'):
+            return
+        try:
+            self.status_server = StatusServer(**self.config['status'])
+        except error as e:
+            logger.error('Failed to start the status server: %s', e.strerror)
+            return
+        self.status_server.route('/lag', lambda: (200, self.lag_status()))
+        self.status_server.route('/health', self.health)
+        self.status_server.route('/ready', self.ready)
+        self.status_server.route('/stats', lambda: (200, self.live_stats()))
+        self.status_server.start()
+
+    def health(self, now=None):
+        """Healthy while the feed loop or a finished lot has been seen within ``heartbeat_timeout`` seconds."""
+        now = time.time() if now is None else now
+        age = now - self.heartbeat
+        healthy = age <= self.config.get('heartbeat_timeout', max(300, 3 * self.sleep))
+        return 200 if healthy else 503, {'healthy': healthy, 'heartbeat_age': round(age, 3)}
+
+    def ready(self):
+        """Ready when CouchDB and both APIs answer."""
+        checks = {}
+        try:
+            self.db.info()
+            checks['couchdb'] = True
+        except error:
+            checks['couchdb'] = False
+        for name in ('lots', 'assets'):
+            try:
+                response = requests.head(self.config[name]['api']['url'], timeout=self.config.get('ready_timeout', 5))
+                checks[name + '_api'] = response.status_code < 500
+            except requests.RequestException:
+                checks[name + '_api'] = False
+        ready = all(checks.values())
+        return 200 if ready else 503, dict(checks, ready=ready)
+
+    def live_stats(self, now=None):
+        now = time.time() if now is None else now
+        stats = self.stats()
+        with self.stats_lock:
+            stats['in_flight_lots'] = dict(
+                (lot_id, dict(lot, elapsed=round(now - lot['started'], 3))) for lot_id, lot in self.in_flight.items()
+            )
+        stats['last_error'] = self.last_error
+        stats['timings'] = self.timings.stats()
+        stats['slo'] = self.slo.stats()
+        stats['heartbeat_age'] = round(now - self.heartbeat, 3)
+        return stats
+
+    def lag_status(self, now=None):
+        status = self.lag.status(now)
+        status['workers'] = self.pool.size
+        return status
+
+    def check_lag(self, now=None):
+        """Poll the database head every ``feed_lag.interval`` seconds and publish the lag.
+
+        The pool is resized to the largest ``workers`` of the ``feed_lag.thresholds``
+        whose ``distance`` (changes) or ``behind`` (seconds) is reached, and back
+        to ``workers`` once the feed catches up.
+        """
+        lag_config = self.config.get('feed_lag', {})
+        now = time.time() if now is None else now
+        if now - self.lag_checked < lag_config.get('interval', 10):
+            return
+        self.lag_checked = now
+        try:
+            self.lag.update_head(self.source.head(), now)
+        except Exception as e:  # the errors depend on the source
+            logger.warning('Failed to get the latest position of the lot source: %s', e)
+            return
+        status = self.lag.status(now)
+
+        workers = self.config.get('workers', 1)
+        for threshold in lag_config.get('thresholds', []):
+            if status['distance'] >= threshold.get('distance', float('inf')) or \
+                    status['behind'] >= threshold.get('behind', float('inf')):
+                workers = max(workers, threshold['workers'])
+        if workers != self.pool.size:
+            logger.info('Feed is %s changes (%.0f seconds) behind, using %s workers instead of %s',
+                        status['distance'], status['behind'], workers, self.pool.size)
+            self.pool.resize(workers)
+
+        if lag_config.get('status_file'):
+            status['workers'] = workers
+            try:
+                write_status_file(lag_config['status_file'], status)
+            except (IOError, OSError) as e:
+                logger.warning('Failed to write status file %s: %s', lag_config['status_file'], e)
+
+    def log_stats(self):
+        logger.debug('Worker stats: %s', self.stats())
+        logger.debug('Lot latencies: %s', self.slo.stats())
+
+    def schedule_lot(self, lot):
+        """Queue a lot from the feed. Returns the queued lot, None if it is skipped."""
+        if self.cached_not_actionable(lot):
+            return None
+        broken_lot = self.errors_doc.get(lot['id'], None)
+        if broken_lot and not broken_lot.get('resolved', False):
+            if broken_lot['rev'] == lot['rev']:
+                # Already waiting in self.retries
+                return None
+            # Changed since it broke, process the new rev now. The entry is
+            # resolved by settle_broken_lot once the lot reaches an outcome.
+            self.retries.discard(lot['id'])
+            broken_lot.update(lot, retries=0)
+            self.errors_writer.set_item(self.errors_doc, lot['id'], broken_lot)
+            lot = broken_lot
+        self.slo.start(lot)
+        self.scheduler.push(lot)
+        return lot
+
+    def cached_not_actionable(self, lot):
+        """Whether the lot is known not to be actionable at this rev. Entries of older revs are dropped."""
+        cached = self.not_actionable.get(lot['id'])
+        if cached is None:
+            return False
+        rev, reason = cached
+        if rev != lot.get('rev'):
+            self.not_actionable.pop(lot['id'])
+            return False
+        self.negative_cache_hits += 1
+        logger.debug('Skipping lot %s, not actionable at rev %s (%s)', lot['id'], rev, reason,
+                     extra={'lot_id': lot['id'], 'phase': 'check_lot'})
+        return True
+
+    def known_not_actionable(self, lot):
+        cached = self.not_actionable.get(lot['id'])
+        return cached is not None and cached[0] == lot.get('rev')
+
+    def mark_not_actionable(self, lot, reason):
+        if lot.get('rev') is not None:
+            self.not_actionable.set(lot['id'], (lot['rev'], reason))
+
+    def schedule_retries(self):
+        for broken_lot in self.retries.due():
+            if broken_lot.get('resolved', False):
+                continue
+            broken_lot['retries'] = broken_lot.get('retries', 0) + 1
+            logger.info("Retrying broken lot %s (attempt %s)", broken_lot['id'], broken_lot['retries'],
+                        extra={'lot_id': broken_lot['id'], 'phase': 'retry'})
+            self.errors_writer.set_item(self.errors_doc, broken_lot['id'], broken_lot)
+            self.scheduler.push(broken_lot)
+
+    def settle_broken_lot(self, lot, outcome):
+        """Retry a lot skipped or deferred because of a failed request, or resolve its errors doc entry.
+
+        Such lots get an errors doc entry like broken lots, so they're
+        retried soon instead of on the next rescan, also after a restart.
+        Lots that reached a final outcome or turned out not to be actionable
+        are resolved. Broken lots were rescheduled by mark_broken,
+        interrupted ones are retried after a restart.
+        """
+        if outcome in ('broken', 'interrupted'):
+            return
+        broken_lot = self.errors_doc.get(lot['id'], None)
+        unresolved = broken_lot is not None and not broken_lot.get('resolved', False)
+        if outcome == 'deferred' or (outcome == 'skipped' and not self.known_not_actionable(lot)):
+            if not unresolved:
+                broken_lot = dict(lot)
+                log_broken_lot(self.errors_writer, logger, self.errors_doc, broken_lot,
+                               'Lot {} after a failed request'.format(outcome))
+            self.retry_later(broken_lot)
+        elif unresolved:
+            resolve_broken_lot(self.errors_writer, logger, self.errors_doc, lot)
+
+    def mark_broken(self, lot, message):
+        self.record_error(lot, message)
+        log_broken_lot(self.errors_writer, logger, self.errors_doc, lot, message)
+        self.retry_later(lot)
+
+    def retry_later(self, lot):
+        if self.retries.schedule(lot) is None:
+            logger.warning("Lot %s will not be retried until it is changed (%s attempts)",
+                           lot['id'], lot.get('retries', 0), extra={'lot_id': lot['id'], 'phase': 'retry'})
 
     def get_lot(self):
         logger.info('Getting Lots')
-        return continuous_changes_feed(
-            self.db, logger,
-            filter_doc=self.config['db']['filter']
-        )
+        # The feed filter is a design document
+        self.design_synced.wait()
+        since = self.feed_seq
+        # Lots skipped or deferred are only seen again on a full rescan
+        if time.time() - self.rescanned >= self.config.get('rescan_interval', 3600):
+            since = 0
+            self.rescanned = time.time()
+        self.feed_seq = self.previous_seq = since
+        return self.source.lots(since, progress=self.feed_progress)
 
     def process_lots(self, lot):
-        lot_available = self.check_lot(lot)
+        """Run the transition for the lot's status and return its outcome."""
+        exceptions = api_exceptions()
+        with self.phase(lot, 'check_lot'):
+            lot_available = self.check_lot(lot)
         if not lot_available:
-            logger.info("Skipping lot {}".format(lot['id']))
-            return
-        logger.info("Processing lot {}".format(lot['id']))
-        if lot['status'] == 'verification':
+            logger.info("Skipping lot %s", lot['id'], extra={'lot_id': lot['id'], 'phase': 'check_lot'})
+            return 'skipped'
+        logger.info("Processing lot %s", lot['id'], extra={'lot_id': lot['id'], 'phase': 'process_lot'})
+        transition = LOT_TRANSITIONS.get(lot['status'])
+        if transition is None:
+            return 'skipped'
+        first_step = self.progress.resume(lot)
+        if first_step:
+            logger.info("Resuming lot %s at step '%s'", lot['id'], transition['steps'][first_step]['name'],
+                        extra={'lot_id': lot['id'], 'phase': 'resume'})
+            with self.phase(lot, 'check_assets'):
+                self.refresh_asset_states(lot)
+        else:
+            conflicts = self.asset_index.conflicts(lot)
+            checked_lot = lot
+            if conflicts:
+                # The owners are cached and may be stale, so the assets are fetched before rejecting
+                # the lot. Checking the conflicting assets first makes a real conflict cost one GET.
+                logger.info("Assets of lot %s may belong to other lots: %s", lot['id'],
+                            ', '.join('{} ({})'.format(*item) for item in sorted(conflicts.items())),
+                            extra={'lot_id': lot['id'], 'phase': 'check_assets'})
+                with self.stats_lock:
+                    self.asset_conflicts += 1
+                checked_lot = dict(lot, assets=sorted(conflicts) + [
+                    asset_id for asset_id in lot['assets'] if asset_id not in conflicts
+                ])
             try:
-                assets_available = self.check_assets(lot)
-            except RequestFailed:
-                logger.info("Due to fail in getting assets, lot {} is skipped".format(lot['id']))
-            else:
-                if assets_available:
-                    result, patched_assets = self.patch_assets(lot, 'verification', lot['id'])
-                    if result is False:
-                        if patched_assets:
-                            logger.info("Assets {} will be repatched to 'pending'".format(patched_assets))
-                            result, _ = self.patch_assets({'assets': patched_assets}, 'pending')
-                            if result is False:
-                                log_broken_lot(self.db, logger, self.errors_doc, lot, 'patching assets to verification')
-                    else:
-                        result, _ = self.patch_assets(lot, 'active', lot['id'])
-                        if result is False:
-                            logger.info("Assets {} will be repatched to 'pending'".format(lot['assets']))
-                            result, _ = self.patch_assets(lot, 'pending')
-                            if result is False:
-                                log_broken_lot(self.db, logger, self.errors_doc, lot, 'patching assets to active')
-                        else:
-                            result = self.patch_lot(lot, "active.salable")
-                            if result is False:
-                                log_broken_lot(self.db, logger, self.errors_doc, lot, 'patching lot to active.salable')
+                with self.phase(lot, 'check_assets'):
+                    assets_available = self.check_assets(checked_lot, *transition['check_assets'])
+            except exceptions.RequestFailed:
+                logger.info("Due to fail in getting assets, lot %s is skipped", lot['id'],
+                            extra={'lot_id': lot['id'], 'phase': 'check_assets'})
+                return 'deferred'
+            if not assets_available:
+                if transition['rejected_status']:
+                    self.patch_lot(lot, transition['rejected_status'])
                 else:
-                    self.patch_lot(lot, "pending")
-        elif lot['status'] == 'pending.dissolution':
-            if self.check_assets(lot, 'active'):
-                self.patch_assets(lot, 'pending')
-                self.patch_lot(lot, 'dissolved')
-                logger.info("Assets {} from lot {} will be patched to 'pending'".format(lot['assets'], lot['id']))
-            else:
-                logger.warning("Not valid assets {} in lot {}".format(lot['assets'], lot['id']))
+                    logger.warning("Not valid assets %s in lot %s", lot['assets'], lot['id'],
+                                   extra={'lot_id': lot['id'], 'phase': 'check_assets'})
+                return 'rejected'
 
+        for index in range(first_step, len(transition['steps'])):
+            if index > first_step and self.stop_due():
+                logger.info("Lot %s stopped before step '%s', it will be resumed after restart", lot['id'],
+                            transition['steps'][index]['name'], extra={'lot_id': lot['id'], 'phase': 'shutdown'})
+                return 'interrupted'
+            with self.phase(lot, transition['steps'][index]['name']):
+                outcome = self.run_step(lot, transition['steps'][index])
+            if outcome is not None:
+                self.progress.finish(lot)
+                return outcome
+            if index + 1 < len(transition['steps']):
+                self.progress.save(lot, index + 1)
+        self.progress.finish(lot)
+        return transition['outcome']
 
-    def check_lot(self, lot):
+    def run_step(self, lot, step):
+        """Run one transition step. Returns None if the lot may go on, the outcome otherwise."""
+        if 'message' in step:
+            logger.info(step['message'], lot['assets'], lot['id'], extra={'lot_id': lot['id'], 'phase': step['name']})
+        if step['patch'] == 'lot':
+            result, patched_assets = self.patch_lot(lot, step['status']), []
+        else:
+            related_lot = (lot['id'],) if step.get('related_lot') else ()
+            result, patched_assets = self.patch_assets(lot, step['status'], *related_lot)
+        if result is not False or 'broken' not in step:
+            return None
+
+        rollback = step.get('rollback')
+        if rollback == 'patched' and not patched_assets:
+            return 'failed'
+        if rollback is not None:
+            rollback_lot = {'assets': patched_assets} if rollback == 'patched' else lot
+            logger.info("Assets %s will be repatched to 'pending'", rollback_lot['assets'],
+                        extra={'lot_id': lot['id'], 'phase': 'rollback'})
+            result, _ = self.patch_assets(rollback_lot, 'pending')
+            if result is not False:
+                return 'rolled back'
+        self.mark_broken(lot, step['broken'])
+        return 'broken'
+
+    def get_replica_lot(self, lot):
+        """Read the lot from the local lots database.
+
+        The document is only used if it is at the revision the feed
+        returned, otherwise None is returned and the lot is read from the API.
+        """
         try:
-            lot = self.lots_client.get_lot(lot['id']).data
-            logger.info('Successfully got lot {}'.format(lot['id']))
-        except ResourceNotFound as e:
-            logger.error('Falied to get lot {0}: {1}'.format(lot['id'], e.message))
-            return False
-        except RequestFailed as e:
-            logger.error('Falied to get lot {0}. Status code: {1}'.format(lot['id'], e.status_code))
-            return False
-        if lot.status != 'verification' and lot.status != 'pending.dissolution':
-            logger.warning("Lot {0} can not be processed in current status ('{1}')".format(lot.id, lot.status))
+            lot_doc = self.db.get(lot['id'])
+        except error as e:
+            logger.warning('Failed to get lot %s from the replica: %s', lot['id'], e.strerror,
+                           extra={'lot_id': lot['id'], 'phase': 'check_lot'})
+            return None
+        if lot_doc is None or lot_doc['_rev'] != lot.get('rev'):
+            return None
+        logger.debug('Got lot %s from the replica', lot['id'], extra={'lot_id': lot['id'], 'phase': 'check_lot'})
+        return lot_doc
+
+    def check_lot(self, lot):
+        exceptions = api_exceptions()
+        lot_data = None
+        if self.read_lots_from_db:
+            lot_data = self.get_replica_lot(lot)
+        if lot_data is None:
+            try:
+                self.count_api_call('GET', 'lots')
+                lot_data = self.lots_client.get_lot(lot['id']).data
+                logger.info('Successfully got lot %s', lot['id'], extra={'lot_id': lot['id'], 'phase': 'check_lot'})
+            except exceptions.ResourceNotFound as e:
+                logger.error('Falied to get lot %s: %s', lot['id'], e.message,
+                             extra={'lot_id': lot['id'], 'phase': 'check_lot'})
+                self.mark_not_actionable(lot, 'not found')
+                return False
+            except exceptions.RequestFailed as e:
+                logger.error('Falied to get lot %s. Status code: %s', lot['id'], e.status_code,
+                             extra={'lot_id': lot['id'], 'phase': 'check_lot'})
+                return False
+        if lot_data['status'] != 'verification' and lot_data['status'] != 'pending.dissolution':
+            logger.warning("Lot %s can not be processed in current status ('%s')", lot['id'], lot_data['status'],
+                           extra={'lot_id': lot['id'], 'phase': 'check_lot'})
+            self.mark_not_actionable(lot, "status '{}'".format(lot_data['status']))
             return False
         return True
 
+    def get_replica_assets(self, asset_ids):
+        """Read assets from the local replica in one _all_docs request.
+
+        Assets missing from the replica are left out of the result, so that
+        the caller can fall back to the API for them.
+        """
+        try:
+            rows = self.assets_db.view('_all_docs', keys=asset_ids, include_docs=True)
+            return dict((row.key, row.doc) for row in rows if row.doc is not None)
+        except error as e:
+            logger.warning('Failed to get assets from the replica: %s', e.strerror, extra={'phase': 'check_assets'})
+            return {}
+
     def check_assets(self, lot, status='pending'):
+        exceptions = api_exceptions()
+        replica_assets = {}
+        if self.assets_db is not None:
+            replica_assets = self.get_replica_assets(lot['assets'])
         for asset_id in lot['assets']:
-            try:
-                asset = self.assets_client.get_asset(asset_id).data
-                logger.info('Successfully got asset {}'.format(asset_id))
-            except ResourceNotFound as e:
-                logger.error('Falied to get asset {0}: {1}'.format(asset_id,
-                                                                   e.message))
-                return False
-            except RequestFailed as e:
-                logger.error('Falied to get asset {0}. Status code: {1}'.format(asset_id, e.status_code))
-                raise RequestFailed('Failed to get assets')
-            relatedLot_check = 'relatedLot' in asset and asset.relatedLot != lot['id']
-            if relatedLot_check or asset.status != status:
+            asset = replica_assets.get(asset_id)
+            if asset is not None:
+                logger.debug('Got asset %s from the replica', asset_id,
+                             extra={'lot_id': lot['id'], 'asset_id': asset_id, 'phase': 'check_assets'})
+            else:
+                try:
+                    self.count_api_call('GET', 'assets')
+                    asset = self.assets_client.get_asset(asset_id).data
+                    logger.info('Successfully got asset %s', asset_id,
+                                extra={'lot_id': lot['id'], 'asset_id': asset_id, 'phase': 'check_assets'})
+                except exceptions.ResourceNotFound as e:
+                    logger.error('Falied to get asset %s: %s', asset_id, e.message,
+                                 extra={'lot_id': lot['id'], 'asset_id': asset_id, 'phase': 'check_assets'})
+                    return False
+                except exceptions.RequestFailed as e:
+                    logger.error('Falied to get asset %s. Status code: %s', asset_id, e.status_code,
+                                 extra={'lot_id': lot['id'], 'asset_id': asset_id, 'phase': 'check_assets'})
+                    raise exceptions.RequestFailed('Failed to get assets')
+            self.asset_states.set(asset_id, (asset['status'], asset.get('relatedLot')))
+            relatedLot_check = 'relatedLot' in asset and asset['relatedLot'] != lot['id']
+            if relatedLot_check or asset['status'] != status:
                 return False
         return True
 
+    def refresh_asset_states(self, lot):
+        """Cache the current states of the assets of a resumed lot.
+
+        The cache is empty after a restart, and with the states the resumed
+        step skips the patches it applied before the worker stopped.
+        """
+        exceptions = api_exceptions()
+        replica_assets = {}
+        if self.assets_db is not None:
+            replica_assets = self.get_replica_assets(lot['assets'])
+        for asset_id in lot['assets']:
+            asset = replica_assets.get(asset_id)
+            if asset is None:
+                try:
+                    self.count_api_call('GET', 'assets')
+                    asset = self.assets_client.get_asset(asset_id).data
+                except exceptions.RequestFailed as e:
+                    logger.warning('Failed to get asset %s of resumed lot %s: %s', asset_id, lot['id'], e.message,
+                                   extra={'lot_id': lot['id'], 'asset_id': asset_id, 'phase': 'resume'})
+                    self.asset_states.pop(asset_id)
+                    continue
+            self.asset_states.set(asset_id, (asset['status'], asset.get('relatedLot')))
+
     def patch_assets(self, lot, status, related_lot=None):
+        exceptions = api_exceptions()
         patched_assets = []
         for asset_id in lot['assets']:
+            if self.asset_states.get(asset_id) == (status, related_lot):
+                self.skipped_patches += 1
+                logger.debug("Asset %s is already %s, patch skipped", asset_id, status,
+                             extra={'lot_id': related_lot, 'asset_id': asset_id, 'phase': 'patch_assets'})
+                patched_assets.append(asset_id)
+                continue
+            if self.dry_run:
+                logger.info("Dry run: asset %s would be patched to %s", asset_id, status,
+                            extra={'lot_id': related_lot, 'asset_id': asset_id, 'phase': 'patch_assets'})
+                patched_assets.append(asset_id)
+                continue
             asset = {"data": {"status": status, "relatedLot": related_lot}}
             try:
+                self.count_api_call('PATCH', 'assets')
                 self.assets_client.patch_asset(asset_id, asset)
-            except EXCEPTIONS as e:
+            except (exceptions.Forbidden, exceptions.RequestFailed, exceptions.ResourceNotFound,
+                    exceptions.UnprocessableEntity) as e:
+                self.asset_states.pop(asset_id)
                 message = e.message
                 if e.status_code >= 500:
                     message = 'Server error: {}'.format(e.status_code)
-                logger.error("Failed to patch asset {} to {} ({})".format(asset_id, status, message))
+                logger.error("Failed to patch asset %s to %s (%s)", asset_id, status, message,
+                             extra={'lot_id': related_lot, 'asset_id': asset_id, 'phase': 'patch_assets'})
                 return False, patched_assets
             else:
-                logger.info("Successfully patched asset {} to {}".format(asset_id, status),
-                            extra={'MESSAGE_ID': 'patch_asset'})
+                logger.info("Successfully patched asset %s to %s", asset_id, status,
+                            extra={'MESSAGE_ID': 'patch_asset', 'lot_id': related_lot,
+                                   'asset_id': asset_id, 'phase': 'patch_assets'})
+                self.asset_states.set(asset_id, (status, related_lot))
                 patched_assets.append(asset_id)
         return True, patched_assets
 
     def patch_lot(self, lot, status):
+        exceptions = api_exceptions()
+        if self.dry_run:
+            logger.info("Dry run: lot %s would be patched to %s", lot['id'], status,
+                        extra={'lot_id': lot['id'], 'phase': 'patch_lot'})
+            return True
         try:
+            self.count_api_call('PATCH', 'lots')
             self.lots_client.patch_lot(lot['id'], {"data": {"status": status}})
-        except EXCEPTIONS as e:
+        except (exceptions.Forbidden, exceptions.RequestFailed, exceptions.ResourceNotFound,
+                exceptions.UnprocessableEntity) as e:
             message = e.message
             if e.status_code >= 500:
                 message = 'Server error: {}'.format(e.status_code)
-            logger.error("Failed to patch lot {} to {} ({})".format(lot['id'], status, message))
+            logger.error("Failed to patch lot %s to %s (%s)", lot['id'], status, message,
+                         extra={'lot_id': lot['id'], 'phase': 'patch_lot'})
             return False
         else:
-            logger.info("Successfully patched lot {} to {}".format(lot['id'], status),
-                        extra={'MESSAGE_ID': 'patch_lot'})
+            logger.info("Successfully patched lot %s to %s", lot['id'], status,
+                        extra={'MESSAGE_ID': 'patch_lot', 'lot_id': lot['id'], 'phase': 'patch_lot'})
             return True
 
 
+def run_batch_command(config, params):
+    from .batch import changes_between, format_summary, lots_by_id, run_batch
+    if params.workers:
+        config = dict(config, workers=params.workers)
+    worker = BotWorker(config)
+    missing = []
+    if params.lots:
+        lots = lots_by_id(worker, params.lots, missing)
+    else:
+        lots = changes_between(worker, params.since, params.until)
+    summary = run_batch(worker, lots, dry_run=params.dry_run)
+    if missing:
+        summary['outcomes']['not found'] = len(missing)
+        summary['lots'] += len(missing)
+    print(format_summary(summary))
+
+
 def main():
     parser = argparse.ArgumentParser(description='---- OpenRegistry Concierge ----')
     parser.add_argument('config', type=str, help='Path to configuration file')
+    parser.add_argument('command', nargs='?', choices=('run', 'batch'), default='run',
+                        help="'run' to follow the feed (default), 'batch' to process some lots once and exit")
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Number of worker processes; the feed is read by the main process, '
+                             'which does not reload the config on SIGHUP')
+    parser.add_argument('--check-config', action='store_true',
+                        help='Validate the configuration file without connecting anywhere and exit')
+    batch = parser.add_argument_group('batch', 'Options of the batch command')
+    batch.add_argument('--since', type=str, default='0', help='Process changes after this seq')
+    batch.add_argument('--until', type=int, help='Process changes up to this seq number')
+    batch.add_argument('--lots', nargs='+', metavar='LOT_ID', help='Process these lots instead of a seq range')
+    batch.add_argument('--workers', type=int, help='Lots processed at once, overrides "workers"')
+    batch.add_argument('--dry-run', action='store_true', help='Check lots but do not patch anything')
     params = parser.parse_args()
-    if os.path.isfile(params.config):
+    try:
         with open(params.config) as config_object:
             config = yaml.load(config_object.read())
-        logging.config.dictConfig(config)
-        BotWorker(config).run()
+    except (IOError, yaml.YAMLError) as e:
+        parser.exit(1, 'Failed to load {}: {}\n'.format(params.config, e))
+    if params.check_config:
+        errors = check_config(config)
+        for message in errors:
+            print(message)
+        if errors:
+            sys.exit(1)
+        print('{}: OK'.format(params.config))
+        return
+    listeners = configure_logging(config)
+    try:
+        if params.command == 'batch':
+            run_batch_command(config, params)
+        elif params.processes > 1:
+            from .supervisor import Supervisor
+            supervisor = Supervisor(config, params.processes, BotWorker)
+            supervisor.install_signal_handlers()
+            supervisor.run()
+        else:
+            worker = BotWorker(config, config_path=params.config, log_listeners=listeners)
+            worker.install_signal_handlers()
+            worker.run()
+    finally:
+        for listener in listeners:
+            listener.stop()
 
 
 if __name__ == "__main__":
@@ -20,6 +20,9 @@ test_require = {
         'pytest',
         'pytest-mock',
         'pytest-cov'
+    ],
+    'redis': [
+        'redis<4'
     ]
 }
 
@@ -50,6 +53,6 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=requires,
-    extras_require={'test': test_require['test']},
+    extras_require={'test': test_require['test'], 'redis': test_require['redis']},
     entry_points=entry_points
 )